@@ -1,22 +1,42 @@
+import os
 import sys
+import importlib
 import streamlit as st
-import awesome_streamlit as ast
 
 sys.path.append('src')
-from generate_classification_config import generate_config
-from dolphin.app.functions import homepage, classify, detect, raven_classify, visualize_augmentation
+import generate_classification_config
 
+# Pages are imported the first time they're opened, so starting the app doesn't load tensorflow, librosa
+# and opencv for pages nobody has opened yet (python keeps them imported after that)
 FUNCTIONALITIES = {
-    "Home Page": homepage,
-    "Classification": classify,
-    "Detection" : detect,
-    "Classify Prior Detections": raven_classify,
-    "Visualize Augmentations": visualize_augmentation
+    "Home Page": 'homepage',
+    "Classification": 'classify',
+    "Detection" : 'detect',
+    "Classify Prior Detections": 'raven_classify',
+    "Visualize Augmentations": 'visualize_augmentation'
 }
 
+
+def load_page(name: str):
+    return importlib.import_module('dolphin.app.functions.' + FUNCTIONALITIES[name])
+
+
+@st.experimental_singleton(show_spinner=False)  # no spinner, nothing may come before set_page_config
+def generate_config(generator_mtime: float, config_exists: bool):
+    # Cached per process on its arguments, so it only runs again when the generator changes or config.json is gone
+    generate_classification_config.generate_config()
+
+
+def config_inputs():
+    """
+    What generate_config's output depends on: the generator's own source, and whether its config.json is still there.
+    """
+    return os.path.getmtime(generate_classification_config.__file__), os.path.exists('config.json')
+
+
 def main():
-    
-    generate_config()
+
+    generate_config(*config_inputs())
 
     st.set_page_config(
      page_title="Dolphin Whistles",
@@ -32,7 +52,7 @@ def main():
     st.markdown("""<hr style="height:10px;border:none;color:#333;background-color:#333;" /> """, unsafe_allow_html=True)
 
     if fn:
-        FUNCTIONALITIES[fn].main()
+        load_page(fn).main()
     else:
         st.write("Please make a selection")
 
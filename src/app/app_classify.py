@@ -1,63 +1,100 @@
 import os
-import sys
 import cv2
 import json
-import librosa
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras import optimizers
-from tensorflow.keras.utils import Sequence, to_categorical
+from tensorflow.keras.utils import Sequence
 
 
-import dolphin.utils as utils
-import dolphin.io_utils as io_utils
-from dolphin.models import MODELS
-import dolphin.preprocess.feature_extraction as feature_extraction
+import dolphin.app.pipeline as pipeline
+import dolphin.app.tracing as tracing
+import dolphin.app.spec_render as spec_render
+import dolphin.app.audio_stream as audio_stream
+import dolphin.app.model_registry as model_registry
+import dolphin.app.window_store as window_store
+from dolphin.app.results import Results
 
 
-def generate_features(data_list, savedir, cfg):
-    feature_type = cfg["preprocess"]["features"]
-    spec_max_length = cfg["preprocess"]["spectrogram_max_length"]
+def iter_clips(data_list, cfg, cache=None):
+    """
+    The decode stage of classification: loads each uploaded clip, unless its spectrogram is already cached.
 
+    Yields:
+        (tuple): name of the clip, its time series, its cache key and its cached image (only one of the
+            time series and the cached image is set)
+    """
+    spec_max_length = cfg["preprocess"]["spectrogram_max_length"]
+    res_type = cfg['preprocess'].get('res_type')  # ex. 'polyphase' for fast resampling, librosa's default if not set
     for data in data_list:
         fp = data.name
-        data, sr = librosa.load(data, sr=cfg['preprocess']['sampling_rate'], duration=spec_max_length)
+        key = cache.key(data, cfg) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            yield fp, None, key, cached[0][0]
+            continue
+
+        data, sr = audio_stream.load(data, cfg['preprocess']['sampling_rate'], res_type=res_type, duration=spec_max_length)
+        yield fp, data, key, None
+
+
+def clip_features(clip, cfg, cache=None):
+    """
+    The feature stage of classification: renders the spectrogram of one clip from iter_clips.
+
+    Returns:
+        (list): the single (name, image) pair of the clip
+    """
+    name, wav, key, img = clip
+    if img is None:
+        img = spec_render.compute_images([wav], cfg['preprocess']['sampling_rate'], cfg)[0]
+        if key is not None:
+            cache.put(key, [img])
+    return [(name, img)]
 
-        feature, f, t = feature_extraction.compute_spectrogram(data, sr=sr, cfg=cfg, random_pad=False)
-        savename = savedir + fp[:-3] + 'png'
-        io_utils.save_fig(feature, f, t, output_dir=savename, cfg=cfg)
 
-    return savedir
+def generate_features(data_list, cfg, cache=None):
+    clips = list(iter_clips(data_list, cfg, cache=cache))
+
+    # The spectrograms of all the clips that aren't cached are computed together with shared vectorized FFTs
+    todo = [i for i,clip in enumerate(clips) if clip[3] is None]
+    rendered = spec_render.compute_images([clips[i][1] for i in todo], cfg['preprocess']['sampling_rate'], cfg)
+
+    images = [clip[3] for clip in clips]
+    for i,img in zip(todo, rendered):
+        images[i] = img
+        if clips[i][2] is not None:
+            cache.put(clips[i][2], [img])
+
+    return images, [clip[0] for clip in clips]
 
 
 class InferenceDataGenerator(Sequence):
     """
-    InferenceDataGenerator grabs and loads batches of data.
+    InferenceDataGenerator grabs and loads batches of data, batch_size windows at a time.
     """
 
-    def __init__(self, infer_dir):
+    def __init__(self, feat_images, names, batch_size=32, store=None):
 
-        self.names = []        
-        self.images = []   
-        self.visual_purpose = [] 
-        for fp in os.listdir(infer_dir):
-            img = cv2.imread(infer_dir+fp)
-            datapoint = np.expand_dims(img / 255, axis=0)
-            self.names.append(fp)
-            self.images.append(datapoint)
-            self.visual_purpose.append(img)
+        self.batch_size = batch_size
+        self.names = list(names)
+
+        # Each window is kept once, as uint8, and normalized to float32 a batch at a time in __getitem__
+        self.store = store if store is not None else window_store.WindowStore(capacity=len(feat_images))
+        self.store.extend(feat_images)
+        self.visual_purpose = self.store.array
 
         self.count = 0
 
     def __len__(self):
-        return len(self.images)
+        return int(np.ceil(len(self.store) / self.batch_size))
 
     def __getitem__(self, i):
         self.count += 1
-        return self.images[i], self.names[i]
+        batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+        return self.store.normalized(batch.start, batch.stop), self.names[batch]
 
 
-def run(uploaded_data, model_name, weights, cfg_filename="config.json"):
+def run(uploaded_data, model_name, weights, cfg_filename="config.json", export_dir=None, batch_size=32, pipelined=True,
+        cache=None, store=None, backend='keras', index=None, progress=None):
 
     with open(cfg_filename, "r") as f:
         cfg = json.load(f)
@@ -69,47 +106,75 @@ def run(uploaded_data, model_name, weights, cfg_filename="config.json"):
     for data in uploaded_data:
         splits['inference'].append(data) 
 
-    # -----------------------------------------------------------------------------------------------------------------
-    # Preprocessing
-    # -----------------------------------------------------------------------------------------------------------------
-    inference_dir = 'outputs/ui/classification/spectrograms/'  # for the purpose of running spectrograms through inference
-    if not os.path.exists(inference_dir):
-        os.makedirs(inference_dir)
-
-    generate_features(uploaded_data, inference_dir, cfg)
-    input_shape = utils.get_input_shape(inference_dir)
-
-    # -----------------------------------------------------------------------------------------------------------------
-    # Data Generators
-    # -----------------------------------------------------------------------------------------------------------------
     classes = np.sort(['INSERT_CLASS1', 'INSERT_CLASS2', 'INSERT_CLASS3'])
     n_classes = len(classes)
-    inference_generator = InferenceDataGenerator(inference_dir)    
 
     # -----------------------------------------------------------------------------------------------------------------
     # Model
     # -----------------------------------------------------------------------------------------------------------------
-    model = MODELS[model_name](include_top=True, weights=weights, input_shape=input_shape, classes=n_classes)
-    model.compile(optimizer=optimizers.Adam(learning_rate=cfg["model"]["model_params"]["learning_rate"]),
-                  loss='categorical_crossentropy', metrics=['acc'])
+    def get_model(input_shape):
+        # Built and compiled once per process, then shared across reruns and sessions
+        if index is not None:
+            # Matching against a whistle index needs embeddings, which only the Keras model gives
+            return model_registry.get_embedder(model_name, weights, input_shape, n_classes,
+                                               learning_rate=cfg["model"]["model_params"]["learning_rate"])
+        if backend != 'keras':
+            return model_registry.get_tflite(weights, backend)  # exported with export_tflite.py
+        return model_registry.get_classifier(model_name, weights, input_shape, n_classes,
+                                             learning_rate=cfg["model"]["model_params"]["learning_rate"])
+
+    def predict(batch):
+        # Reports every batch to the job running this (see jobs.py), which is also where a cancel stops the run
+        if progress is not None:
+            progress(len(batch))
+        model = get_model(batch.shape[1:])
+        with tracing.span('predict', items=len(batch)):
+            return np.asarray(model.predict_on_batch(window_store.normalize(batch)))
 
     # -----------------------------------------------------------------------------------------------------------------
-    # Get them predictions!
+    # Preprocessing + Get them predictions!
     # -----------------------------------------------------------------------------------------------------------------
-    predictions = []
-    confidences = []
-    for img in inference_generator.images:
-        output = model.predict(img).squeeze(0)  # get model prediction
-        ind = np.argpartition(output, -3)[-3:]  # get indices of top 3 predictions
-
-        confidence = [format(output[ind[2]], '.2%'), format(output[ind[1]], '.2%'), format(output[ind[0]], '.2%')]  # confidence scores of top 3 predictions  
-        prediction = [classes[ind[2]], classes[ind[1]], classes[ind[0]]]  # extract the actual classnames of these 3 predictions
-        confidence, prediction = (list(t) for t in zip(*sorted(zip(confidence, prediction))))
-
-        predictions.append(prediction[::-1])
-        confidences.append(confidence[::-1])   
- 
-    return predictions, confidences, inference_generator.visual_purpose, inference_generator.names
+    if pipelined:
+        # Decoding, spectrograms and the model all run at once, connected by bounded queues
+        store = store if store is not None else window_store.WindowStore()
+        names, outputs = [], []
+        clips = iter_clips(uploaded_data, cfg, cache=cache)
+        featurize = lambda clip: clip_features(clip, cfg, cache=cache)
+        for (name, img), output in pipeline.run(clips, featurize, predict, batch_size=batch_size):
+            names.append(name)
+            store.append(img)
+            outputs.append(output)
+        visuals = store.array
+    else:
+        feat_images, names = generate_features(uploaded_data, cfg, cache=cache)
+        input_shape = feat_images[0].shape
+        inference_generator = InferenceDataGenerator(feat_images, names, batch_size=batch_size, store=store)
+
+        model = get_model(input_shape)
+        outputs = []
+        for b in range(len(inference_generator)):
+            batch, _ = inference_generator[b]
+            if progress is not None:
+                progress(len(batch))
+            with tracing.span('predict', items=len(batch)):
+                outputs.extend(np.asarray(model.predict_on_batch(batch)))  # get model predictions for the whole batch
+        visuals, names = inference_generator.visual_purpose, inference_generator.names
+
+    # Every clip gets shown to the user, so optionally keep a PNG of each one
+    if export_dir is not None:
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+        with tracing.span('export_png', items=len(visuals)):
+            for i,img in enumerate(visuals):
+                cv2.imwrite(export_dir + names[i][:-3] + 'png', img)
+
+    # The index's individuals replace the classifier's classes, scored by cosine similarity to their closest whistle
+    if index is not None:
+        results = Results(index.individuals, index.individual_similarities(outputs), names, score_format='.3f')
+    else:
+        results = Results.from_outputs(classes, outputs, names)
+
+    return results, visuals
         
 
 
@@ -1,49 +1,133 @@
 import os
 import sys
 import cv2
+import bisect
 import json
-import librosa
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras import optimizers
-from tensorflow.keras.utils import Sequence, to_categorical
+from tensorflow.keras.utils import Sequence
 
 sys.path.insert(1, os.path.join(sys.path[0], 'src'))
-import dolphin.utils as utils
-import dolphin.io_utils as io_utils
-from dolphin.models import MODELS
-import dolphin.preprocess.feature_extraction as feature_extraction
+import dolphin.app.pipeline as pipeline
+import dolphin.app.tracing as tracing
+import dolphin.app.prefilter as prefilter
+import dolphin.app.spec_render as spec_render
+import dolphin.app.batch_features as batch_features
+import dolphin.app.model_registry as model_registry
+import dolphin.app.window_store as window_store
+import dolphin.app.audio_stream as audio_stream
+from dolphin.app.results import Results
 
 
+# How many windows the decode stage hands over at once, see iter_spans
+SPAN_WINDOWS = 32
 
-def generate_features(data, savedir, cfg):
-    feature_type = cfg["preprocess"]["features"]
 
-    # Note: The number of seconds in the loaded wav file is data.shape[0] / sr
-    fp = data.name
-    data, sr = librosa.load(data, sr=cfg['preprocess']['sampling_rate'])
+def iter_spans(data, cfg, stream=True, hop_sec=3, multichannel=False, start_window=0):
+    """
+    The decode stage of detection: yields the recording in spans of up to 32 windows each.
 
-    # Chunk the potentially long audio file into 3sec windows
-    three_second_wavs = chunk(data, sr)
+    Args:
+        data (str or file-like): the uploaded audio file
+        cfg (dict): the config
+        stream (bool): decode and resample block by block instead of loading the whole file
+        hop_sec (float): seconds between the starts of consecutive 3sec windows
+        multichannel (bool): keep every channel of the recording, the spans are then (channels, samples)
+            instead of a mono downmix
+        start_window (int): window to start from, a multiple of the 32 windows of a span, ex. to resume an
+            interrupted run (the spans are the same ones a run from the start gives from there on)
+
+    Yields:
+        (tuple): start sample of the span, its time series, how many windows start in it and the hop in samples
+    """
+    sr = cfg['preprocess']['sampling_rate']
+    window = sr * 3
+    hop = int(round(hop_sec * sr))
+
+    # Overlapping spectrogram windows are cut from the STFT frames of the span they sit in, instead of
+    # recomputing them per window, which needs the hop to land on the STFT frame grid
+    if hop < window and cfg["preprocess"]["features"] == 'spec':
+        hop = batch_features.frame_aligned_hop(hop, sr, cfg)
+
+    # Consecutive spans overlap like the windows do
+    span_len, span_step = (SPAN_WINDOWS - 1) * hop + window, SPAN_WINDOWS * hop
+    res_type = cfg['preprocess'].get('res_type')  # ex. 'polyphase' for fast resampling, librosa's default if not set
+    first = start_window * hop
+    if stream:
+        # Decode and resample block by block, so only a few spans of audio are in memory at once
+        spans = audio_stream.iter_spans(data, sr, span_len, span_step, res_type=res_type, mono=not multichannel, start=first)
+    else:
+        # Note: The number of seconds in the loaded wav file is data.shape[0] / sr
+        data, sr = audio_stream.load(data, sr, res_type=res_type, mono=not multichannel)
+        spans = audio_stream.spans([data[..., first:]], span_len, span_step, start=first)
 
-    # Generate features (ex. spectrograms) for each 3sec window
-    feature_fps, orig_fps = [], []
-    for i,wav in enumerate(three_second_wavs):
-        if feature_type == 'spec':
-            feature, f, t = feature_extraction.compute_spectrogram(wav, sr=sr, cfg=cfg, random_pad=False)
-        elif feature_type == 'melspec':
-            feature = feature_extraction.compute_melspec(wav, sr=sr, cfg=cfg)
-        elif feature_type == 'pcen':
-            melspec = feature_extraction.compute_melspec(wav, sr=sr, cfg=cfg)
-            feature = feature_extraction.compute_pcen(melspec, sr=sr, cfg=cfg)
+    for start, y in spans:
+        # A new window starts every hop until one reaches the end of the recording, like chunk() does
+        n_windows = min(SPAN_WINDOWS, max(0, -(-(y.shape[-1] - window + hop) // hop)))
+        if start == 0:
+            n_windows = max(n_windows, 1)
+        if n_windows > 0:
+            yield start, y, n_windows, hop
 
-        savename = savedir + fp[:-4] + '_' + str(i) + '.png'
-        io_utils.save_fig(feature, f, t, output_dir=savename, cfg=cfg)
 
-        feature_fps.append(savename)
-        orig_fps.append(fp[:-3] + 'png')
+def span_features(span, cfg, prefilter_db=None):
+    """
+    The feature stage of detection: generates features (ex. spectrograms) for each 3sec window of a span,
+    rendered straight to image arrays.
 
-    return feature_fps, orig_fps
+    Args:
+        span (tuple): a span from iter_spans
+        cfg (dict): the config
+        prefilter_db (float): windows less tonal than this in the whistle band (see prefilter.scores) are
+            neither rendered nor passed to the model, None keeps every window
+
+    Returns:
+        (list): ((start time in seconds, prefilter score, channel), image) of each window, the image is
+            None if the window was rejected (the score is None without a prefilter). A multi-channel span
+            gives every channel of a window in a row, channels numbered from 1 like Raven's
+    """
+    start, y, n_windows, hop = span
+    sr = cfg['preprocess']['sampling_rate']
+    window = sr * 3
+    n_channels = y.shape[0] if y.ndim > 1 else 1
+
+    # Every channel of a window is cut, so they're stacked along the batch axis of the FFTs and the model
+    wavs = [y[..., i * hop : i * hop + window] for i in range(n_windows)]
+    if y.ndim > 1:
+        wavs = [wav[c] for wav in wavs for c in range(n_channels)]
+
+    if cfg["preprocess"]["features"] == 'spec':
+        if hop < window:
+            features = batch_features.sliding_spectrograms(y, sr, cfg, hop, n_windows)
+        else:
+            features = batch_features.spectrograms(wavs, sr, cfg)
+
+        # The prefilter reuses the STFT the images are rendered from, so scoring costs next to nothing
+        scores = [None] * len(features)
+        if prefilter_db is not None:
+            scores = prefilter.scores(features, cfg['preprocess'].get('whistle_band', prefilter.WHISTLE_BAND))
+        kept = prefilter.keep(scores, prefilter_db)
+        with tracing.span('render', items=int(np.sum(kept))):
+            images = [spec_render.render(feature, f, t, cfg) if kept[i] else None for i,(feature, f, t) in enumerate(features)]
+    else:
+        # Other features have no STFT to score windows from, so they all go to the model
+        scores = [None] * len(wavs)
+        images = spec_render.compute_images(wavs, sr, cfg)
+
+    return [(((start + (i // n_channels) * hop) / sr, scores[i], i % n_channels + 1), img) for i,img in enumerate(images)]
+
+
+def generate_features(data, cfg, stream=True, hop_sec=3, prefilter_db=None, multichannel=False):
+    fp = data.name
+
+    images, orig_fps, start_times, channels = [], [], [], []
+    for span in iter_spans(data, cfg, stream=stream, hop_sec=hop_sec, multichannel=multichannel):
+        for (start_time, _, channel), img in span_features(span, cfg, prefilter_db=prefilter_db):
+            images.append(img)
+            orig_fps.append(fp[:-3] + 'png')
+            start_times.append(start_time)
+            channels.append(channel)
+
+    return images, orig_fps, start_times, channels
 
 
 def chunk(wav: np.ndarray, sr: int):
@@ -68,80 +152,206 @@ def chunk(wav: np.ndarray, sr: int):
 
 class InferenceDataGenerator(Sequence):
     """
-    InferenceDataGenerator grabs and loads batches of data.
+    InferenceDataGenerator grabs and loads batches of data, batch_size windows at a time.
     """
 
-    def __init__(self, feat_fps, orig_fps):
+    def __init__(self, feat_images, orig_fps, batch_size=32, store=None):
 
-        self.names = []
-        self.images = []   
-        self.visual_purpose = [] 
+        self.batch_size = batch_size
+        self.names = list(orig_fps)
 
-        for i,fp in enumerate(feat_fps):
-            img = cv2.imread(fp)
-            datapoint = np.expand_dims(img / 255, axis=0)
-
-            self.names.append(orig_fps[i])
-            self.images.append(datapoint)
-            self.visual_purpose.append(img)
+        # Each window is kept once, as uint8, and normalized to float32 a batch at a time in __getitem__
+        self.store = store if store is not None else window_store.WindowStore(capacity=len(feat_images))
+        self.store.extend(feat_images)
+        self.visual_purpose = self.store.array
 
         self.count = 0
 
     def __len__(self):
-        return len(self.images)
+        return int(np.ceil(len(self.store) / self.batch_size))
 
     def __getitem__(self, i):
         self.count += 1
-        return self.images[i], self.names[i]
+        batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+        return self.store.normalized(batch.start, batch.stop), self.names[batch]
 
 
-def run(data, model_name, threshold, weights, cfg_filename="config.json"):
+def run(data, model_name, threshold, weights, cfg_filename="config.json", stream=True, export_dir=None, batch_size=32, hop_sec=3,
+        pipelined=True, cache=None, store=None, prefilter_db=None, backend='keras', multichannel=False, progress=None,
+        checkpoint=None, checkpoint_windows=1024):
 
     with open(cfg_filename, "r") as f:
         cfg = json.load(f)
 
-    # -----------------------------------------------------------------------------------------------------------------
-    # Preprocessing
-    # -----------------------------------------------------------------------------------------------------------------
-    inference_dir = 'outputs/ui/detection/spectrograms/'
-    if not os.path.exists(inference_dir):
-        os.makedirs(inference_dir)
-    feat_fps, orig_fps = generate_features(data, inference_dir, cfg)
-    input_shape = utils.get_input_shape(inference_dir)
-
-    # -----------------------------------------------------------------------------------------------------------------
-    # Data Generators
-    # -----------------------------------------------------------------------------------------------------------------
     classes = ['no-whistle', 'whistle']  # 0: no-whistle, 1: whistle
     n_classes = len(classes)
-    inference_generator = InferenceDataGenerator(feat_fps, orig_fps)    
 
     # -----------------------------------------------------------------------------------------------------------------
     # Model
     # -----------------------------------------------------------------------------------------------------------------
-    model_json_path = 'weights/detector_model.json'
-    model_json = open(model_json_path, 'r')
-    loaded_model_json = model_json.read()
-    model = tf.keras.models.model_from_json(loaded_model_json)
-    model.load_weights(weights)
+    # Loaded once per process, either the Keras model or one of its TFLite exports (see export_tflite.py)
+    if backend == 'keras':
+        model = model_registry.get_detector(weights, model_json_path='weights/detector_model.json')
+    else:
+        model = model_registry.get_tflite(weights, backend)
+
+    def predict(batch):
+        # Reports every batch to the job running this (see jobs.py), which is also where a cancel stops the run
+        if progress is not None:
+            progress(len(batch))
+        with tracing.span('predict', items=len(batch)):
+            return np.asarray(model.predict_on_batch(window_store.normalize(batch)))
 
     # -----------------------------------------------------------------------------------------------------------------
-    # Get them predictions!
+    # Checkpoint
     # -----------------------------------------------------------------------------------------------------------------
-    predictions = []
-    confidences = []
-    for img in inference_generator.images:
-        output = model.predict(img).squeeze(0)  # get model prediction
-        for o in output:
-            if float(o) < threshold:
-                predictions.append(0)
-            else:
-                predictions.append(1)
-            confidences.append(format(o, '.2%'))
-            
-    return predictions, confidences, inference_generator.visual_purpose, inference_generator.names
-        
+    # A recording an earlier run committed parts of (see checkpoint.py) resumes after its last part, or comes
+    # straight back if it was finished. Only the streaming pipeline commits parts along the way.
+    ck, start_window, prior = None, 0, (None, None, [])
+    if checkpoint is not None:
+        # The weights' (and architecture's or export's) size and mtime, so retrained weights don't resume old results
+        model_state = checkpoint.file_state(*model_registry.model_files(weights, backend, 'weights/detector_model.json'))
+        ck = checkpoint.key(data, cfg, weights=model_state, backend=backend, threshold=threshold, hop_sec=hop_sec,
+                            prefilter_db=prefilter_db, multichannel=multichannel, batch_size=batch_size,
+                            stream=stream, pipelined=pipelined)
+        if checkpoint.parts(ck):
+            prior = checkpoint.load(ck)
+            start_window = checkpoint.stop(ck)
+    if ck is not None and checkpoint.finished(ck):
+        results, images, rows = prior
+        visuals = [None] * len(results)
+        for j,i in enumerate(rows):
+            visuals[i] = images[j]
+        export_png(results, visuals, threshold, export_dir, data.name)
+        return results, visuals
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # Preprocessing + Get them predictions!
+    # -----------------------------------------------------------------------------------------------------------------
+    # A recording seen before with the same settings skips straight to inference (unless a run of it is being resumed)
+    key = cache.key(data, cfg, hop_sec=hop_sec, prefilter_db=prefilter_db, multichannel=multichannel) \
+        if cache is not None and start_window == 0 else None
+    cached = cache.get(key) if key is not None else None
+
+    # Only the windows the prefilter kept get an image, kept holds their indices among all the windows
+    if cached is not None:
+        images, start_times = cached[0], cached[1]['start_times']
+        kept = cached[1].get('kept', list(range(len(images))))
+        channels = cached[1].get('channels', [1] * len(start_times))
+        outputs = []
+        for b in range(0, len(images), batch_size):
+            outputs.extend(predict(np.asarray(images[b : b + batch_size])))
+    elif pipelined:
+        # Decoding, spectrograms and the model all run at once, connected by bounded queues
+        store = store if store is not None else window_store.WindowStore()
+        start_times, channels, kept, outputs = [], [], [], []
+        committed, n_channels = 0, 1
+        spans = iter_spans(data, cfg, stream=stream, hop_sec=hop_sec, multichannel=multichannel, start_window=start_window)
+        featurize = lambda span: span_features(span, cfg, prefilter_db=prefilter_db)
+        for ((start_time, _, channel), img), output in pipeline.run(spans, featurize, predict, batch_size=batch_size):
+            if img is not None:
+                kept.append(len(start_times))
+                store.append(img)
+                outputs.append(output)
+            start_times.append(start_time)
+            channels.append(channel)
+            n_channels = max(n_channels, channel)
+
+            # Parts end where both a span and a batch do, so a run resumed there cuts and batches the windows
+            # after it exactly like this one does
+            n = len(start_times)
+            if ck is not None and n - committed >= checkpoint_windows and n % (SPAN_WINDOWS * n_channels) == 0 \
+                    and n % batch_size == 0:
+                commit_part(checkpoint, ck, data.name, threshold, start_times, channels, kept, outputs, store,
+                            committed, n, stop=start_window + n // n_channels)
+                committed = n
+        images = store.array
+        if ck is not None:
+            commit_part(checkpoint, ck, data.name, threshold, start_times, channels, kept, outputs, store,
+                        committed, len(start_times), stop=start_window + len(start_times) // n_channels, done=True)
+    else:
+        feat_images, orig_fps, start_times, channels = generate_features(data, cfg, stream=stream, hop_sec=hop_sec,
+                                                                         prefilter_db=prefilter_db, multichannel=multichannel)
+        kept = [i for i,img in enumerate(feat_images) if img is not None]
+        inference_generator = InferenceDataGenerator([feat_images[i] for i in kept], [orig_fps[i] for i in kept],
+                                                     batch_size=batch_size, store=store)
+
+        outputs = []
+        for b in range(len(inference_generator)):
+            batch, _ = inference_generator[b]
+            if progress is not None:
+                progress(len(batch))
+            with tracing.span('predict', items=len(batch)):
+                outputs.extend(np.asarray(model.predict_on_batch(batch)))  # get model predictions for the whole batch
+        images = inference_generator.visual_purpose
+
+    if key is not None and cached is None:
+        cache.put(key, images, {'start_times': start_times, 'kept': kept, 'channels': channels})
+
+    # Windows the prefilter rejected count as no-whistle, have no score and no image
+    visuals = images
+    if len(kept) < len(start_times):
+        visuals = [None] * len(start_times)
+        for j,i in enumerate(kept):
+            visuals[i] = images[j]
+    results = window_results(data.name, start_times, channels, kept, outputs)
+
+    # Runs that didn't stream through the pipeline commit the whole recording at once
+    if ck is not None and not (pipelined and cached is None):
+        detected = np.flatnonzero(results.above(threshold))
+        checkpoint.commit(ck, results, len(start_times), images=[visuals[i] for i in detected], rows=detected, done=True)
+
+    # Windows of the parts an earlier run committed only have their image if they were detected
+    if prior[0] is not None:
+        prior_results, prior_images, prior_rows = prior
+        prior_visuals = [None] * len(prior_results)
+        for j,i in enumerate(prior_rows):
+            prior_visuals[i] = prior_images[j]
+        results = Results.concat([prior_results, results])
+        visuals = prior_visuals + list(visuals)
+
+    export_png(results, visuals, threshold, export_dir, data.name)
+    return results, visuals
+
+
+def window_results(name: str, start_times: list, channels: list, kept: list, outputs: list):
+    """
+    Results of detection windows, the ones not in kept (rejected by the prefilter) count as no-whistle
+    and have no score.
+    """
+    window_outputs = [None] * len(start_times)
+    for i,output in zip(kept, outputs):
+        window_outputs[i] = output
+    start_times = np.asarray(start_times, dtype=np.float64)
+    return Results.from_outputs(['whistle'], window_outputs, [name] * len(start_times),
+                                start=start_times, end=start_times + 3, channel=channels)
+
+
+def commit_part(checkpoint, ck: str, name: str, threshold: float, start_times: list, channels: list, kept: list,
+                outputs: list, store, lo: int, hi: int, stop: int, done: bool = False):
+    """
+    Commits windows [lo, hi) of a run to its checkpoint, with the images of the detected ones (the ones the
+    verification page shows).
+    """
+    first, last = bisect.bisect_left(kept, lo), bisect.bisect_left(kept, hi)
+    part = window_results(name, start_times[lo:hi], channels[lo:hi], [i - lo for i in kept[first:last]], outputs[first:last])
+    slots = {i - lo: first + j for j,i in enumerate(kept[first:last])}  # window of the part -> its place in the store
+    detected = np.flatnonzero(part.above(threshold))
+    checkpoint.commit(ck, part, stop, images=[store[slots[i]] for i in detected], rows=detected, done=done)
+
+
+def export_png(results: Results, visuals: list, threshold: float, export_dir: str, name: str):
+    """
+    Only the windows the model thinks contain a whistle get shown to the user, so only those are saved.
+    """
+    if export_dir is None:
+        return
+    detected = results.above(threshold)
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    with tracing.span('export_png', items=int(detected.sum())):
+        for i in np.flatnonzero(detected):
+            cv2.imwrite(export_dir + name[:-4] + '_' + str(i) + '.png', visuals[i])
 
 if __name__ == "__main__":
     run()
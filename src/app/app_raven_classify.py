@@ -1,79 +1,133 @@
 import os
-import sys
 import cv2
 import json
-import math
-import librosa
 import numpy as np
-import pandas as pd
-import tensorflow as tf
-from io import StringIO
-from tensorflow.keras import optimizers
-from tensorflow.keras.utils import Sequence, to_categorical
+from tensorflow.keras.utils import Sequence
 
-import dolphin.utils as utils
-import dolphin.io_utils as io_utils
-from dolphin.models import MODELS
-import dolphin.preprocess.feature_extraction as feature_extraction
+import dolphin.app.pipeline as pipeline
+import dolphin.app.tracing as tracing
+import dolphin.app.spec_render as spec_render
+import dolphin.app.audio_stream as audio_stream
+import dolphin.app.model_registry as model_registry
+import dolphin.app.window_store as window_store
+from dolphin.app.results import Results
+from dolphin.app.selection_table import SelectionTable
 
 
-def generate_features(data_list, fns_to_times, savedir, cfg):
-    feature_type = cfg["preprocess"]["features"]
+def iter_selections(data_list, tables, cfg, cache=None, multichannel=False, starts=None):
+    """
+    The decode stage of Raven classification: reads each wav's selections out of it, unless their
+    spectrograms are already cached.
+
+    Args:
+        data_list (list): the wav files
+        tables (dict): basename -> SelectionTable of the wav's selections
+        cfg (dict): the config
+        cache (FeatureCache): where spectrograms are looked up and saved, optional
+        multichannel (bool): cut each selection from the channel its Channel column names, instead of the
+            mono mix of the recording
+        starts (dict): basename -> the first selection to read of that wav, ex. to resume an interrupted run
+
+    Yields:
+        (tuple): basename of the wav, the time series of each of its selections, its cache key, its cached
+            images (only one of the time series and the cached images is set) and the index of its first selection
+    """
     spec_max_length = cfg["preprocess"]["spectrogram_max_length"]
+    res_type = cfg['preprocess'].get('res_type')  # ex. 'polyphase' for fast resampling, librosa's default if not set
+    sr = cfg['preprocess']['sampling_rate']
 
     for data in data_list:
-        fp = data.name
-        data, sr = librosa.load(data, sr=cfg['preprocess']['sampling_rate'])
+        basename = data.name[:-4]
+        table = tables.get(basename)
+        first = (starts or {}).get(basename, 0)
+        if table is None or len(table) <= first:
+            continue  # no selections (left) in this wav
+
+        begin, window_starts, table_channels = table.begin[first:], table.window_starts(sr)[first:], table.channels[first:]
+        channels = table_channels.tolist() if multichannel else None
+        key = cache.key(data, cfg, selections=begin.tolist(), channels=channels) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            yield basename, None, key, cached[0], first
+            continue
+
+        # Only the selected stretches of the recording are decoded, each with a seek
+        chunks = audio_stream.read_segments(data, sr, window_starts, int(spec_max_length) * sr, res_type=res_type,
+                                            mono=not multichannel)
+        if multichannel:
+            # Every channel was decoded in the same reads, each selection keeps its own
+            n_channels = chunks[0].shape[0] if chunks else 1
+            if table_channels.max(initial=1) > n_channels or table_channels.min(initial=1) < 1:
+                raise ValueError(f"{table.name} has selections on channels {sorted(set(channels))}, but {data.name} "
+                                 f"has {n_channels} channel(s)")
+            chunks = [chunk[c - 1] for chunk, c in zip(chunks, table_channels)]
+
+        yield basename, chunks, key, None, first
+
+
+def selection_features(selections, cfg, cache=None):
+    """
+    The feature stage of Raven classification: renders the spectrograms of one wav's selections.
+
+    Returns:
+        (list): ((basename, selection index), image) of each selection
+    """
+    basename, chunks, key, images, first = selections
+    if images is None:
+        # All the selections' spectrograms are computed together with shared vectorized FFTs
+        images = spec_render.compute_images(chunks, cfg['preprocess']['sampling_rate'], cfg)
+        if key is not None:
+            cache.put(key, images)
+    return [((basename, first + i), img) for i,img in enumerate(images)]
+
 
-        for i,time in enumerate(fns_to_times[fp[:-4]]):
-            start = math.floor(float(time[0]) * sr)
-            dur = int(spec_max_length) * sr
-            chunk = data[start : start + dur]
-            
-            feature, f, t = feature_extraction.compute_spectrogram(chunk, sr=sr, cfg=cfg, random_pad=False)
-            savename = savedir + fp[:-4] + str(i) + '.png'
-            io_utils.save_fig(feature, f, t, output_dir=savename, cfg=cfg)
+def generate_features(data_list, tables, cfg, cache=None, multichannel=False):
+    images = {}
+    for selections in iter_selections(data_list, tables, cfg, cache=cache, multichannel=multichannel):
+        images[selections[0]] = [img for _, img in selection_features(selections, cfg, cache=cache)]
 
-    return savedir
+    return images
 
 
 class InferenceDataGenerator(Sequence):
     """
-    InferenceDataGenerator grabs and loads batches of data.
+    InferenceDataGenerator grabs and loads batches of data, batch_size windows at a time.
     """
 
-    def __init__(self, infer_dir, wav_files, fns_to_times):
+    def __init__(self, feat_images, wav_files, tables, batch_size=32, store=None):
+
+        self.batch_size = batch_size
 
         self.names = []       
         self.indices = []
-        self.images = []   
-        self.visual_purpose = []
+
+        # Each window is kept once, as uint8, and normalized to float32 a batch at a time in __getitem__
+        self.store = store if store is not None else window_store.WindowStore()
 
         for wav in wav_files:
             basename = wav.name[:-4]
-            n_chunks = len(fns_to_times[basename])
+            n_chunks = len(tables[basename]) if basename in tables else 0
 
             for n in range(n_chunks):
-                fp = infer_dir + basename + str(n) + '.png'
-
-                img = cv2.imread(fp)
-                datapoint = np.expand_dims(img / 255, axis=0)
                 self.names.append(basename)
                 self.indices.append(n)
-                self.images.append(datapoint)
-                self.visual_purpose.append(img)
+                self.store.append(feat_images[basename][n])
 
+        self.visual_purpose = self.store.array
         self.count = 0
 
     def __len__(self):
-        return len(self.images)
+        return int(np.ceil(len(self.store) / self.batch_size))
 
     def __getitem__(self, i):
         self.count += 1
-        return self.images[i], self.names[i]
+        batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+        return self.store.normalized(batch.start, batch.stop), self.names[batch]
 
 
-def run(uploaded_data, model_name, weights, cfg_filename="config.json"):
+def run(uploaded_data, model_name, weights, cfg_filename="config.json", export_dir=None, batch_size=32, pipelined=True,
+        cache=None, store=None, backend='keras', index=None, multichannel=False, progress=None, checkpoint=None,
+        checkpoint_windows=1024):
 
     with open(cfg_filename, "r") as f:
         cfg = json.load(f)
@@ -81,70 +135,175 @@ def run(uploaded_data, model_name, weights, cfg_filename="config.json"):
     # -----------------------------------------------------------------------------------------------------------------
     # Organize the uploaded data
     # -----------------------------------------------------------------------------------------------------------------
-    fns_to_times = {}
+    tables = {}
     wav_files = []
-    dfs = []
 
     for data in uploaded_data:
         basename = data.name[:-4]
 
-        # If the list of chunks for this file hasn't yet been defined, initialize it
-        if not basename in fns_to_times:
-            fns_to_times[basename] = []
-
-        # Read in the annotations file, extracting the start/stop time of each detected whistle
-        if data.name.endswith('.csv'):
-            df = pd.read_csv(data)
-            dfs.append(df)
-            for i,row in df.iterrows():
-                fns_to_times[basename].append([row['Begin Time (s)'], row['End Time (s)']])
+        # Read in the annotations file in bulk, its begin/end times become arrays the windows are cut from
+        if data.name.endswith('.csv') or data.name.endswith('.txt'):
+            tables[basename] = SelectionTable.read(data)
 
         # Append the data (UploadedData type) to the list of whistles that need to be loaded in
         if data.name.endswith('.wav'):
             wav_files.append(data)     
 
-    # -----------------------------------------------------------------------------------------------------------------
-    # Preprocessing
-    # -----------------------------------------------------------------------------------------------------------------
-    inference_dir = 'outputs/ui/raven_classification/spectrograms/'  # for the purpose of running spectrograms through inference
-    if not os.path.exists(inference_dir):
-        os.makedirs(inference_dir)
-
-    generate_features(wav_files, fns_to_times, inference_dir, cfg)
-    input_shape = utils.get_input_shape(inference_dir)
-
-    # -----------------------------------------------------------------------------------------------------------------
-    # Data Generators
-    # -----------------------------------------------------------------------------------------------------------------
     classes = np.sort(['INSERT_CLASS1', 'INSERT_CLASS2', 'INSERT_CLASS3'])
     n_classes = len(classes)
-    inference_generator = InferenceDataGenerator(inference_dir, wav_files, fns_to_times)    
 
     # -----------------------------------------------------------------------------------------------------------------
     # Model
     # -----------------------------------------------------------------------------------------------------------------
-    model = MODELS[model_name](include_top=True, weights=weights, input_shape=input_shape, classes=n_classes)
-    model.compile(optimizer=optimizers.Adam(learning_rate=cfg["model"]["model_params"]["learning_rate"]),
-                  loss='categorical_crossentropy', metrics=['acc'])
+    def get_model(input_shape):
+        # Built and compiled once per process, then shared across reruns and sessions
+        if index is not None:
+            # Matching against a whistle index needs embeddings, which only the Keras model gives
+            return model_registry.get_embedder(model_name, weights, input_shape, n_classes,
+                                               learning_rate=cfg["model"]["model_params"]["learning_rate"])
+        if backend != 'keras':
+            return model_registry.get_tflite(weights, backend)  # exported with export_tflite.py
+        return model_registry.get_classifier(model_name, weights, input_shape, n_classes,
+                                             learning_rate=cfg["model"]["model_params"]["learning_rate"])
+
+    def predict(batch):
+        # Reports every batch to the job running this (see jobs.py), which is also where a cancel stops the run
+        if progress is not None:
+            progress(len(batch))
+        model = get_model(batch.shape[1:])
+        with tracing.span('predict', items=len(batch)):
+            return np.asarray(model.predict_on_batch(window_store.normalize(batch)))
 
     # -----------------------------------------------------------------------------------------------------------------
-    # Get them predictions!
+    # Checkpoint
     # -----------------------------------------------------------------------------------------------------------------
-    predictions = []
-    confidences = []
-    for img in inference_generator.images:
-        output = model.predict(img).squeeze(0)  # get model prediction
-        ind = np.argpartition(output, -3)[-3:]  # get indices of top 3 predictions
-
-        confidence = [format(output[ind[2]], '.2%'), format(output[ind[1]], '.2%'), format(output[ind[0]], '.2%')]  # confidence scores of top 2 predictions  
-        prediction = [classes[ind[2]], classes[ind[1]], classes[ind[0]]]  # extract the actual classnames of these 2 predictions
-
-        predictions.append(prediction)
-        confidences.append(confidence)
-    
-    return predictions, confidences, inference_generator.visual_purpose, inference_generator.names, inference_generator.indices, dfs
-        
+    # Recordings an earlier run finished (see checkpoint.py) aren't classified again, and ones it committed
+    # parts of resume after their last committed selection. Only the streaming pipeline commits parts along the way.
+    keys, starts, prior = {}, {}, {}
+    if checkpoint is not None:
+        # Size and mtime of the weights (or export) and index files, so retraining or rebuilding them in place
+        # doesn't resume old results
+        model_state = checkpoint.file_state(*model_registry.model_files(weights, backend if index is None else 'keras'))
+        index_state = checkpoint.file_state(*(index.path + fn for fn in ('index.json', 'vectors.f32', 'labels.i32'))) \
+            if index is not None else None
+        for data in wav_files:
+            basename = data.name[:-4]
+            if basename not in tables:
+                continue
+            table = tables[basename]
+            keys[basename] = checkpoint.key(data, cfg, selections=table.begin.tolist(), ends=table.end.tolist(),
+                                            channels=table.channels.tolist(), model_name=model_name, weights=model_state,
+                                            backend=backend, batch_size=batch_size, pipelined=pipelined,
+                                            multichannel=multichannel, index=index_state)
+            if checkpoint.parts(keys[basename]):
+                prior[basename] = checkpoint.load(keys[basename])
+                starts[basename] = checkpoint.stop(keys[basename])
+    todo = [data for data in wav_files if data.name[:-4] not in keys or not checkpoint.finished(keys[data.name[:-4]])]
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # Preprocessing + Get them predictions!
+    # -----------------------------------------------------------------------------------------------------------------
+    if pipelined or not todo:
+        # Decoding, spectrograms and the model all run at once, connected by bounded queues
+        store = store if store is not None else window_store.WindowStore()
+        names, indices, outputs = [], [], []
+        committed = 0
+        selections = iter_selections(todo, tables, cfg, cache=cache, multichannel=multichannel, starts=starts)
+        featurize = lambda sel: selection_features(sel, cfg, cache=cache)
+        for ((basename, n), img), output in pipeline.run(selections, featurize, predict, batch_size=batch_size):
+            names.append(basename)
+            indices.append(n)
+            store.append(img)
+            outputs.append(output)
+
+            # Parts end on batch boundaries, so a run resumed there batches the selections after it exactly
+            # like this one does
+            if keys and len(names) - committed >= checkpoint_windows and len(names) % batch_size == 0:
+                commit_parts(checkpoint, keys, tables, classes, index, names, indices, outputs, store, committed, len(names))
+                committed = len(names)
+        if keys:
+            commit_parts(checkpoint, keys, tables, classes, index, names, indices, outputs, store, committed, len(names))
+        visuals = store.array
+    else:
+        feat_images = generate_features(todo, tables, cfg, cache=cache, multichannel=multichannel)
+        input_shape = next(img for imgs in feat_images.values() for img in imgs).shape
+        inference_generator = InferenceDataGenerator(feat_images, todo, tables, batch_size=batch_size, store=store)
+
+        model = get_model(input_shape)
+        outputs = []
+        for b in range(len(inference_generator)):
+            batch, _ = inference_generator[b]
+            if progress is not None:
+                progress(len(batch))
+            with tracing.span('predict', items=len(batch)):
+                outputs.extend(np.asarray(model.predict_on_batch(batch)))  # get model predictions for the whole batch
+        visuals, names, indices = inference_generator.visual_purpose, inference_generator.names, inference_generator.indices
+        if keys:
+            commit_parts(checkpoint, keys, tables, classes, index, names, indices, outputs, inference_generator.store, 0, len(names))
+
+    results = selection_results(classes, index, outputs, names, indices, tables)
+
+    # The parts earlier runs committed go back in front of what this run added, a recording at a time in upload order
+    if prior:
+        pieces, images = [], []
+        for data in wav_files:
+            basename = data.name[:-4]
+            if basename in prior:
+                pieces.append(prior[basename][0])
+                images.append(prior[basename][1])
+            rows = np.flatnonzero(results.files == basename)
+            if len(rows):
+                pieces.append(results.subset(rows))
+                images.append(visuals[rows[0] : rows[-1] + 1])
+        results, visuals = Results.concat(pieces), np.concatenate(images)
+
+    # Every selection gets shown to the user, so optionally keep a PNG of each one
+    if export_dir is not None:
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+        with tracing.span('export_png', items=len(visuals)):
+            for i,img in enumerate(visuals):
+                cv2.imwrite(export_dir + results.files[i] + str(results.selection[i]) + '.png', img)
+
+    return results, visuals, tables
+
+
+def selection_results(classes, index, outputs: list, names: list, indices: list, tables: dict):
+    """
+    Results of classified selections, placed in their recordings with their selection tables.
+    """
+    # Where each window sits in its recording, gathered from its selection table a file at a time
+    names, indices = np.asarray(names, dtype=object), np.asarray(indices, dtype=np.int64)
+    start, end = np.full(len(names), np.nan), np.full(len(names), np.nan)
+    channel = np.ones(len(names), dtype=np.int64)
+    for basename,table in tables.items():
+        rows = names == basename
+        start[rows], end[rows] = table.begin[indices[rows]], table.end[indices[rows]]
+        channel[rows] = table.channels[indices[rows]]
+
+    # The index's individuals replace the classifier's classes, scored by cosine similarity to their closest whistle
+    if index is not None:
+        return Results(index.individuals, index.individual_similarities(outputs), names, start=start, end=end,
+                       selection=indices, channel=channel, score_format='.3f')
+    return Results.from_outputs(classes, outputs, names, start=start, end=end, selection=indices, channel=channel)
+
+
+def commit_parts(checkpoint, keys: dict, tables: dict, classes, index, names: list, indices: list, outputs: list, store,
+                 lo: int, hi: int):
+    """
+    Commits selections [lo, hi) of a run to its checkpoint, a part per recording they come from, with their images
+    (the labeling page shows every selection).
+    """
+    while lo < hi:
+        basename = names[lo]
+        stop = lo
+        while stop < hi and names[stop] == basename:
+            stop += 1
+        part = selection_results(classes, index, outputs[lo:stop], names[lo:stop], indices[lo:stop], tables)
+        next_selection = indices[stop - 1] + 1
+        checkpoint.commit(keys[basename], part, next_selection, images=store[lo:stop], rows=np.arange(stop - lo),
+                          done=next_selection == len(tables[basename]))
+        lo = stop
 
 if __name__ == "__main__":
     run()
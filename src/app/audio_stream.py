@@ -0,0 +1,425 @@
+import math
+import struct
+import functools
+import librosa
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+import dolphin.app.tracing as tracing
+
+
+def load(data, sr: int, res_type: str = None, duration: float = None, mono: bool = True, mmap: bool = True):
+    """
+    librosa.load with a choice of resampler, and no resampling at all when the file is already at sr.
+
+    Args:
+        data (str or file-like): path to the audio file or the streamlit UploadedFile
+        sr (int): sampling rate to resample to
+        res_type (str): 'polyphase' for the fast resampler, otherwise passed on to librosa.resample
+            (None is librosa's own high quality default)
+        duration (float): only load this many seconds
+        mono (bool): downmix to mono, otherwise every channel is kept
+        mmap (bool): read 16-bit PCM WAV files already at sr through map_pcm16, without librosa
+
+    Returns:
+        (np.ndarray, int): float32 time series and its sampling rate, (channels, samples) if not mono
+    """
+    pcm = map_pcm16(data, sr) if mmap else None
+    if pcm is not None:
+        return pcm_to_float(pcm[:None if duration is None else int(duration * sr)], mono=mono), sr
+
+    with tracing.span('decode') as span:
+        y, orig_sr = librosa.load(data, sr=None, duration=duration, mono=mono)
+        y = y if mono else np.atleast_2d(y)
+        span.add(y.shape[-1])
+    return resample(y, orig_sr, sr, res_type=res_type), sr
+
+
+def n_channels(data):
+    """
+    How many channels an audio file has, 1 if soundfile can't read its header.
+    """
+    try:
+        channels = sf.info(data).channels
+    except RuntimeError:
+        channels = 1
+    if hasattr(data, 'seek'):
+        data.seek(0)
+    return channels
+
+
+def duration(data):
+    """
+    Length of an audio file in seconds, from its header, None if soundfile can't read it.
+    """
+    try:
+        seconds = sf.info(data).duration
+    except RuntimeError:
+        seconds = None
+    if hasattr(data, 'seek'):
+        data.seek(0)
+    return seconds
+
+
+def map_pcm16(data, sr: int):
+    """
+    Maps the samples of a 16-bit PCM WAV file that is already at sr, without decoding or copying them.
+
+    Most recordings are stored like this, and for them decoding is nothing but a copy and a conversion
+    to float of the whole file. A path or an open file (ex. batch detection's recordings) is memory-mapped
+    read-only, so slicing it only reads the pages the slice touches, and the OS page cache holding them is
+    shared by every process reading the same file (ex. batch detection's workers). An uploaded file is
+    already in memory and is viewed in place. pcm_to_float turns a slice into exactly what soundfile
+    would have decoded.
+
+    Args:
+        data (str or file-like): path to the audio file, a file opened in binary mode or the streamlit UploadedFile
+        sr (int): the sampling rate the samples are needed at
+
+    Returns:
+        (np.ndarray): read-only int16 (samples, channels) view of the file's samples, None if the file isn't
+            a 16-bit PCM WAV at sr (or is empty), it then has to be decoded
+    """
+    if not isinstance(data, str) and not hasattr(data, 'getbuffer') and _fileno(data) is None:
+        return None
+    try:
+        info = sf.info(data)
+    except RuntimeError:
+        info = None
+    finally:
+        if hasattr(data, 'seek'):
+            data.seek(0)
+    if info is None or info.format != 'WAV' or info.subtype != 'PCM_16' or info.samplerate != sr or info.frames == 0:
+        return None
+
+    if isinstance(data, str):
+        with open(data, 'rb') as f:
+            offset = _wav_data_offset(f)
+        if offset is None:
+            return None
+        return np.memmap(data, dtype='<i2', mode='r', offset=offset, shape=(info.frames, info.channels))
+
+    offset = _wav_data_offset(data)
+    data.seek(0)
+    if offset is None:
+        return None
+    if not hasattr(data, 'getbuffer'):
+        # An open file, mapped through its descriptor (the map stays valid once the file is closed)
+        pcm = np.memmap(data, dtype='<i2', mode='r', offset=offset, shape=(info.frames, info.channels))
+        data.seek(0)
+        return pcm
+    pcm = np.frombuffer(data.getbuffer(), dtype='<i2', count=info.frames * info.channels, offset=offset)
+    return pcm.reshape(info.frames, info.channels)
+
+
+def pcm_to_float(pcm: np.ndarray, mono: bool = True):
+    """
+    Converts a slice of map_pcm16's samples to float32 the way soundfile does (x / 32768, which is exact),
+    downmixed like librosa does, so the result is bit for bit what decoding the same samples gives.
+
+    Args:
+        pcm (np.ndarray): int16 (samples, channels)
+        mono (bool): downmix to mono, otherwise (channels, samples)
+
+    Returns:
+        (np.ndarray): float32 time series, (channels, samples) if not mono
+    """
+    with tracing.span('decode', items=pcm.shape[0], source='mmap'):
+        y = pcm.astype(np.float32)
+        y *= np.float32(1 / 32768)
+    return librosa.to_mono(y.T) if mono else np.ascontiguousarray(y.T)
+
+
+def _fileno(data):
+    """
+    The OS file descriptor behind a file object, None if it has none (ex. an in-memory upload).
+    """
+    try:
+        return data.fileno()
+    except (AttributeError, OSError, ValueError):  # io.UnsupportedOperation is an OSError
+        return None
+
+
+def _wav_data_offset(f):
+    """
+    Byte offset of the samples in a RIFF WAV file, walking its chunks to the data chunk.
+
+    Returns:
+        (int): offset of the data chunk's first byte, None if there is no data chunk
+    """
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    offset = 12
+    while True:
+        f.seek(offset)
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'data':
+            return offset + 8
+        offset += 8 + size + (size & 1)  # chunks are padded to an even length
+
+
+def resample(y: np.ndarray, orig_sr: int, sr: int, res_type: str = None):
+    """
+    Resamples a time series, passing it through untouched when the rates already match.
+
+    'polyphase' uses scipy's polyphase resampler with its low-pass filter designed once per rate pair
+    and reused for every file and block after that, which is much faster than librosa's default
+    high-quality resampler. Any other res_type goes to librosa, None meaning librosa's default.
+
+    Args:
+        y (np.ndarray): time series, resampled along its last axis (ex. (channels, samples))
+        orig_sr (int): sampling rate of y
+        sr (int): sampling rate to resample to
+        res_type (str): 'polyphase', any librosa res_type (ex. 'kaiser_fast') or None for librosa's default
+
+    Returns:
+        (np.ndarray): the resampled float32 time series
+    """
+    if orig_sr == sr:
+        return y
+    with tracing.span('resample', items=y.shape[-1], res_type=str(res_type)):
+        return _resample(y, orig_sr, sr, res_type)
+
+
+def _resample(y: np.ndarray, orig_sr: int, sr: int, res_type: str):
+    if res_type == 'polyphase':
+        g = math.gcd(orig_sr, sr)
+        up, down = sr // g, orig_sr // g
+        return signal.resample_poly(y, up, down, axis=-1, window=_polyphase_filter(up, down)).astype(np.float32)
+    if res_type is None:
+        return librosa.resample(y, orig_sr=orig_sr, target_sr=sr)
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=sr, res_type=res_type)
+
+
+@functools.lru_cache(maxsize=32)
+def _polyphase_filter(up: int, down: int):
+    """
+    The anti-aliasing filter scipy.signal.resample_poly would design for up / down.
+    """
+    max_rate = max(up, down)
+    return signal.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+
+def iter_spans(data, sr: int, span_len: int, span_step: int, block_sec: float = 12, margin_sec: float = 0.1,
+               res_type: str = None, mono: bool = True, start: int = 0, mmap: bool = True):
+    """
+    Decodes and resamples an audio file block by block, yielding overlapping spans of it.
+
+    Spans start every span_step samples and are span_len samples long (the last ones may be
+    shorter), so a span can hold several, possibly overlapping, windows. Only about one block plus
+    one span of audio is ever held in memory, no matter how long the recording is.
+
+    Args:
+        data (str or file-like): path to the audio file or the streamlit UploadedFile
+        sr (int): sampling rate to resample to
+        span_len (int): length of each span, in samples at sr
+        span_step (int): samples between the starts of consecutive spans, at most span_len
+        block_sec (float): seconds of audio decoded and resampled at once
+        margin_sec (float): seconds of context read on each side of a block for resampling
+        res_type (str): resampler, see resample()
+        mono (bool): downmix to mono, otherwise the spans hold every channel
+        start (int): sample at sr the first span starts on, ex. to resume an interrupted run (the spans are
+            the ones a run from the start would give from there on)
+        mmap (bool): slice 16-bit PCM WAV files already at sr straight from map_pcm16 instead of decoding them
+
+    Yields:
+        (int, np.ndarray): start sample of the span and its float32 time series, (channels, samples) if not mono
+    """
+    pcm = map_pcm16(data, sr) if mmap else None
+    if pcm is not None:
+        # Nothing to decode or resample: the spans are views of the mapped samples, only converted as they're used
+        for span_start, span in spans([pcm.T[..., start:]], span_len, span_step, start=start):
+            yield span_start, pcm_to_float(span.T, mono=mono)
+        return
+
+    blocks = iter_samples(data, sr, block_sec=block_sec, margin_sec=margin_sec, res_type=res_type, mono=mono, start=start)
+    yield from spans(blocks, span_len, span_step, start=start)
+
+
+def iter_samples(data, sr: int, block_sec: float = 12, margin_sec: float = 0.1, res_type: str = None, mono: bool = True,
+                 start: int = 0):
+    """
+    Decodes and resamples an audio file block by block, yielding consecutive pieces of the time series.
+
+    Each block is read with a small margin of audio on either side so that the resampling filter
+    sees the same neighbourhood it would when resampling the whole file. The margin is then trimmed
+    off, so the concatenated pieces match load(data, sr, res_type). Formats that soundfile can't
+    read fall back to a single load.
+
+    Starting part way in only decodes from the block holding start on. Blocks are always laid out from
+    the beginning of the file, so the samples match load(data, sr, res_type)[start:] exactly.
+
+    Args:
+        data (str or file-like): path to the audio file or the streamlit UploadedFile
+        sr (int): sampling rate to resample to
+        block_sec (float): seconds of audio decoded and resampled at once
+        margin_sec (float): seconds of context read on each side of a block for resampling
+        res_type (str): resampler, see resample()
+        mono (bool): downmix to mono, otherwise the blocks hold every channel
+        start (int): first sample to yield, at sr
+
+    Yields:
+        (np.ndarray): float32 time series of each consecutive block, (channels, samples) if not mono
+    """
+    try:
+        sfile = sf.SoundFile(data)
+    except RuntimeError:
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        wav, _ = load(data, sr, res_type=res_type, mono=mono)
+        yield wav[..., start:]
+        return
+
+    with sfile:
+        orig_sr = sfile.samplerate
+        n_frames = sfile.frames
+
+        # Block starts and margins must map to a whole number of output samples so the trim is exact
+        step = orig_sr // math.gcd(orig_sr, sr)
+        block_len = max(step, int(block_sec * orig_sr) // step * step)
+        margin = int(margin_sec * orig_sr) // step * step if orig_sr != sr else 0
+        block_out = block_len * sr // orig_sr  # block length in output samples, exact since block_len is a multiple of step
+
+        for block_start in range(start // block_out * block_len, max(n_frames, 1), block_len):
+            lo = max(0, block_start - margin)
+            hi = min(n_frames, block_start + block_len + margin)
+            block = _read(sfile, lo, hi, orig_sr, sr, res_type, mono=mono)
+
+            # Trim the margins back off, in output samples, and whatever comes before start
+            offset = (block_start - lo) * sr // orig_sr
+            length = int(math.ceil(min(block_len, n_frames - block_start) * sr / orig_sr))
+            skip = max(0, start - block_start * sr // orig_sr)
+            yield block[..., offset + skip : offset + length]
+
+
+def read_segments(data, sr: int, starts: list, length: int, res_type: str = None, margin_sec: float = 0.1,
+                  merge_gap_sec: float = 1.0, mono: bool = True, mmap: bool = True):
+    """
+    Decodes and resamples only the parts of an audio file that hold the given segments.
+
+    The segments are sorted and the ones that overlap or sit within merge_gap_sec of each other are
+    merged, then each merged range is read with a seek, plus a small margin on either side so the
+    resampling filter sees the same neighbourhood it would when resampling the whole file. The result
+    matches load(data, sr, res_type) cut into segments, without decoding the rest of the recording.
+    Formats that soundfile can't seek in fall back to a single load.
+
+    Args:
+        data (str or file-like): path to the audio file or the streamlit UploadedFile
+        sr (int): sampling rate to resample to
+        starts (list): start of each segment, in samples at sr
+        length (int): length of every segment, in samples at sr (segments at the end of the file are shorter)
+        res_type (str): resampler, see resample()
+        margin_sec (float): seconds of context read on each side of a merged range for resampling
+        merge_gap_sec (float): segments closer than this are read together, one read being cheaper than two seeks
+        mono (bool): downmix to mono, otherwise the segments hold every channel
+        mmap (bool): slice 16-bit PCM WAV files already at sr straight from map_pcm16, which only reads the
+            pages the segments are on
+
+    Returns:
+        (list): float32 time series of each segment, in the order of starts, (channels, samples) if not mono
+    """
+    pcm = map_pcm16(data, sr) if mmap else None
+    if pcm is not None:
+        n = pcm.shape[0]
+        return [pcm_to_float(pcm[max(0, start) : max(0, min(start + length, n))], mono=mono) for start in starts]
+
+    try:
+        sfile = sf.SoundFile(data)
+    except RuntimeError:
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        wav, _ = load(data, sr, res_type=res_type, mono=mono)
+        return [wav[..., start : start + length] for start in starts]
+
+    segments = [None] * len(starts)
+    with sfile:
+        orig_sr = sfile.samplerate
+        n_frames = sfile.frames
+        n_out = int(math.ceil(n_frames * sr / orig_sr))  # length of the whole file at sr
+
+        # Reads start on input samples that map to a whole output sample, so the cut is exact
+        step = orig_sr // math.gcd(orig_sr, sr)
+        margin = int(margin_sec * orig_sr) // step * step if orig_sr != sr else 0
+
+        for lo_out, hi_out, indices in _merge_segments(starts, length, int(merge_gap_sec * sr)):
+            lo = max(0, (lo_out * orig_sr // sr) // step * step - margin)
+            hi = min(n_frames, int(math.ceil(hi_out * orig_sr / sr)) + margin)
+            if lo >= hi:  # past the end of the file
+                for i in indices:
+                    segments[i] = np.zeros(0 if mono else (sfile.channels, 0), dtype=np.float32)
+                continue
+
+            block = _read(sfile, lo, hi, orig_sr, sr, res_type, mono=mono)
+            base = lo * sr // orig_sr  # output sample block[0] lands on
+            for i in indices:
+                start = starts[i]
+                segments[i] = block[..., max(0, start - base) : max(0, min(start + length, n_out) - base)]
+
+    return segments
+
+
+def _merge_segments(starts: list, length: int, gap: int):
+    """
+    Groups segments whose ranges overlap or are less than gap samples apart.
+
+    Returns:
+        (list): (start, stop, indices into starts) of each group, by start
+    """
+    groups = []
+    for i in sorted(range(len(starts)), key=lambda i: starts[i]):
+        start, stop = starts[i], starts[i] + length
+        if groups and start <= groups[-1][1] + gap:
+            groups[-1][1] = max(groups[-1][1], stop)
+            groups[-1][2].append(i)
+        else:
+            groups.append([start, stop, [i]])
+    return groups
+
+
+def spans(blocks, span_len: int, span_step: int, start: int = 0):
+    """
+    Cuts consecutive blocks of a time series into spans, carrying the overlap over between blocks.
+
+    Args:
+        blocks (iterable): consecutive pieces of a time series, ex. from iter_samples or [wav], cut along
+            their last axis (so (channels, samples) blocks give (channels, samples) spans)
+        span_len (int): length of each span, in samples
+        span_step (int): samples between the starts of consecutive spans, at most span_len
+        start (int): sample the blocks start on, the first span starts there too
+
+    Yields:
+        (int, np.ndarray): start sample of the span and the span itself
+    """
+    buf, buf_start, next_start = np.zeros(0, dtype=np.float32), start, start
+    for block in blocks:
+        buf = block if buf.shape[-1] == 0 else np.concatenate([buf, block], axis=-1)
+        while buf_start + buf.shape[-1] >= next_start + span_len:
+            offset = next_start - buf_start
+            yield next_start, buf[..., offset : offset + span_len]
+            next_start += span_step
+
+        # Drop the samples no later span needs
+        buf, buf_start = buf[..., next_start - buf_start :], next_start
+
+    # Whatever is left at the end of the file goes into shorter spans
+    while next_start < buf_start + buf.shape[-1] or next_start == start:
+        yield next_start, buf[..., next_start - buf_start :]
+        next_start += span_step
+
+
+def _read(sfile: sf.SoundFile, start: int, stop: int, orig_sr: int, sr: int, res_type: str, mono: bool = True):
+    """
+    Reads frames [start, stop) from an open SoundFile, downmixes to mono (unless mono is False, which
+    gives (channels, samples)) and resamples.
+    """
+    with tracing.span('decode', items=stop - start):
+        sfile.seek(start)
+        y = sfile.read(stop - start, dtype='float32', always_2d=True)
+    y = librosa.to_mono(y.T) if mono else np.ascontiguousarray(y.T)
+    return resample(y, orig_sr, sr, res_type=res_type)
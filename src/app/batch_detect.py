@@ -0,0 +1,249 @@
+"""
+Headless whistle detection over directories of recordings, without the streamlit UI.
+
+Files are sharded across a pool of worker processes, each holding its own warm detector. Every
+recording gets a Raven selection table like the Detection page writes (minus the human verification
+step, so every window the model is confident about is kept), and a run summary is written next to them.
+
+Run from the dolphin_whistles directory, ex.
+    python src/dolphin/app/batch_detect.py /data/deployment1 "/data/2021/*.wav" --out-dir outputs/batch_detection/
+"""
+import io
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append('src/')
+
+
+def find_recordings(inputs: list, extensions: tuple = ('.wav',)):
+    """
+    Expands directories (searched recursively) and glob patterns into a sorted list of audio files.
+
+    Args:
+        inputs (list): directories, files or glob patterns
+        extensions (tuple): file extensions counted as audio when searching directories
+
+    Returns:
+        (list): paths to the recordings, without duplicates
+    """
+    fps = set()
+    for pattern in inputs:
+        for path in glob.glob(pattern, recursive=True) or [pattern]:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    fps.update(os.path.join(root, fn) for fn in files if fn.lower().endswith(extensions))
+            elif os.path.isfile(path):
+                fps.add(path)
+    return sorted(fps)
+
+
+def output_names(fps: list):
+    """
+    Where each recording's outputs go under the output directory: its path relative to the deepest directory
+    holding all of the recordings, without the extension. Recordings with the same name in different folders
+    (ex. day1/rec.wav and day2/rec.wav) then get their own tables, in the same folders under the output directory.
+
+    Args:
+        fps (list): paths to the recordings
+
+    Returns:
+        (list): name of each recording's outputs, ex. day1/rec
+
+    Raises:
+        ValueError: if two recordings would still get the same name (ex. when they're on different drives)
+    """
+    paths = [os.path.abspath(fp) for fp in fps]
+    try:
+        root = os.path.commonpath([os.path.dirname(path) for path in paths])
+        names = [os.path.splitext(os.path.relpath(path, root))[0] for path in paths]
+    except ValueError:
+        names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+
+    seen = {}
+    for fp, name in zip(fps, names):
+        if name in seen:
+            raise ValueError(f"{seen[name]} and {fp} would both write {name}.csv")
+        seen[name] = fp
+    return names
+
+
+def open_named(fp: str):
+    """
+    Opens a recording the way the runners expect an upload: a seekable file whose name is the basename.
+    """
+    data = io.FileIO(fp, 'rb')
+    data.name = os.path.basename(fp)
+    return data
+
+
+def _init_worker(weights: str, threads: int, backend: str = 'keras'):
+    import tensorflow as tf
+    import dolphin.app.model_registry as model_registry
+
+    # Split the cores between the workers instead of every worker trying to use all of them
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    if backend == 'keras':
+        model_registry.get_detector(weights)
+    else:
+        model_registry.get_tflite(weights, backend, threads=threads)
+
+
+def detect_file(fp: str, name: str, out_dir: str, args: dict):
+    """
+    Runs detection on one recording and writes its selection table.
+
+    Args:
+        fp (str): path to the recording
+        name (str): where its outputs go under out_dir, see output_names
+        out_dir (str): directory the selection tables are written to
+        args (dict): threshold, weights, config, batch_size, hop_sec and the optional cache_dir, cache_gb and
+            prefilter_db, backend, trace, scores, multichannel and checkpoint_dir, as given on the command line
+
+    Returns:
+        (dict): the file, its number of windows, detections and prefilter skips, and how long it took
+    """
+    import dolphin.app.app_detect as app_detect
+    import dolphin.app.feature_cache as feature_cache
+    import dolphin.app.tracing as tracing
+    import dolphin.app.audio_stream as audio_stream
+    import dolphin.app.selection_table as selection_table
+    from dolphin.app.checkpoint import Checkpoint
+
+    cache = None
+    if args.get('cache_dir') and args.get('cache_gb', 0) > 0:
+        cache = feature_cache.FeatureCache(args['cache_dir'], max_bytes=int(args['cache_gb'] * 1e9))
+    checkpoint = Checkpoint(args['checkpoint_dir']) if args.get('checkpoint_dir') else None
+
+    # Each file gets its own trace, so a slow recording can be looked at on its own
+    trace = tracing.Collector() if args.get('trace') else None
+    tracing.activate(trace)
+
+    start = time.perf_counter()
+    with open_named(fp) as data:
+        windows, _ = app_detect.run(data, 'mobilenetv2', args['threshold'], args['weights'],
+                                    cfg_filename=args['config'], batch_size=args['batch_size'],
+                                    hop_sec=args['hop_sec'], cache=cache,
+                                    prefilter_db=args.get('prefilter_db'),
+                                    backend=args.get('backend', 'keras'),
+                                    multichannel=args.get('multichannel', False), checkpoint=checkpoint)
+
+    with open(args['config'], 'r') as f:
+        sr = json.load(f)['preprocess']['sampling_rate']
+
+    # Without a human in the loop, every window the model flagged is kept (label False == whistle)
+    detected = windows.above(args['threshold'])
+    pos_start_times = windows.start[detected].tolist()
+    table_dir = os.path.join(out_dir, os.path.dirname(name), '')
+    os.makedirs(table_dir, exist_ok=True)
+    with tracing.span('write_csv', items=1):
+        selection_table.write_detections(table_dir, [[False] * len(pos_start_times)], [[os.path.basename(name) + '.wav']],
+                                         [pos_start_times], sr, channels=[windows.channel[detected].tolist()],
+                                         durations=[audio_stream.duration(fp)])
+    # The score of every window, not only the detections, for looking at later
+    if args.get('scores'):
+        with tracing.span('write_results', items=len(windows)):
+            scores_fp = os.path.join(out_dir, name) + '.scores.' + args['scores']
+            if args['scores'] == 'parquet':
+                windows.to_parquet(scores_fp)
+            else:
+                windows.to_csv(scores_fp)
+    if trace is not None:
+        trace.export(os.path.join(out_dir, name) + '.trace.json')
+
+    return {'file': fp, 'table': name + '.csv', 'windows': len(windows), 'detections': len(pos_start_times),
+            'skipped': int(windows.skipped.sum()), 'seconds': time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='directories, files or glob patterns of recordings')
+    parser.add_argument('--out-dir', default='outputs/batch_detection/', help='where the selection tables and summary go')
+    parser.add_argument('--weights', default='weights/detector_weights.h5', help='path to the detector weights')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--threshold', type=float, default=0.5, help='how confident the model has to be')
+    parser.add_argument('--batch-size', type=int, default=32, help='how many spectrograms the model processes at once')
+    parser.add_argument('--hop', type=float, default=3.0, help='seconds between the starts of the 3 second windows')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--cache-dir', default=None, help='cache the spectrograms here, so re-runs with new weights or thresholds skip them')
+    parser.add_argument('--cache-gb', type=float, default=5.0, help='disk budget of the spectrogram cache, in GB')
+    parser.add_argument('--prefilter-db', type=float, default=None,
+                        help='skip windows whose loudest tone in the whistle band is less than this many dB above the background')
+    parser.add_argument('--backend', default='keras', choices=['keras', 'float32', 'float16', 'int8'],
+                        help='run the Keras model or one of its TFLite exports (see export_tflite.py)')
+    parser.add_argument('--trace', action='store_true', help='write a Chrome trace of the stages of every file next to its table')
+    parser.add_argument('--scores', default=None, choices=['csv', 'parquet'],
+                        help='also write the score of every window next to the table (parquet needs pyarrow)')
+    parser.add_argument('--multichannel', action='store_true',
+                        help='detect on every channel of multi-channel recordings separately, instead of their mono mix')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help="don't checkpoint progress through each recording (re-running an interrupted run then starts over)")
+    parser.add_argument('--ext', nargs='+', default=['.wav'], help='audio extensions to look for in directories')
+    args = parser.parse_args()
+
+    fps = find_recordings(args.inputs, tuple(ext.lower() for ext in args.ext))
+    if not fps:
+        sys.exit('No recordings found in ' + ', '.join(args.inputs))
+    try:
+        names = output_names(fps)
+    except ValueError as e:
+        sys.exit(f"Recordings would overwrite each other's outputs: {e}")
+    out_dir = os.path.join(args.out_dir, '')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    run_args = {'threshold': args.threshold, 'weights': args.weights, 'config': args.config,
+                'batch_size': args.batch_size, 'hop_sec': args.hop, 'cache_dir': args.cache_dir,
+                'cache_gb': args.cache_gb, 'prefilter_db': args.prefilter_db, 'backend': args.backend, 'trace': args.trace,
+                'scores': args.scores, 'multichannel': args.multichannel,
+                'checkpoint_dir': None if args.no_checkpoint else out_dir + 'checkpoints/'}
+    workers = max(1, min(args.workers, len(fps)))
+    threads = max(1, os.cpu_count() // workers)
+
+    results, failures = [], []
+    start = time.perf_counter()
+    # spawn, so every worker initializes tensorflow itself instead of inheriting a forked copy
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(args.weights, threads, args.backend)) as pool:
+        futures = {pool.submit(detect_file, fp, name, out_dir, run_args): fp for fp, name in zip(fps, names)}
+        for i,future in enumerate(as_completed(futures)):
+            try:
+                result = future.result()
+                results.append(result)
+                print(f"[{i + 1}/{len(fps)}] {result['file']}: {result['detections']} of {result['windows']} windows")
+            except Exception as e:
+                failures.append({'file': futures[future], 'error': repr(e)})
+                print(f"[{i + 1}/{len(fps)}] {futures[future]} FAILED: {e!r}")
+    elapsed = time.perf_counter() - start
+
+    n_windows = sum(r['windows'] for r in results)
+    summary = {
+        'files': len(results),
+        'failed': len(failures),
+        'windows': n_windows,
+        'detections': sum(r['detections'] for r in results),
+        'skipped_fraction': sum(r['skipped'] for r in results) / max(1, n_windows),
+        'workers': workers,
+        'seconds': elapsed,
+        'files_per_second': len(results) / elapsed,
+        'windows_per_second': n_windows / elapsed,
+        'args': vars(args),
+        'results': sorted(results, key=lambda r: r['file']),
+        'failures': failures,
+    }
+    with open(out_dir + 'summary.json', 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    print(f"{len(results)} files ({len(failures)} failed), {n_windows} windows in {elapsed:.1f}s: "
+          f"{summary['files_per_second']:.2f} files/s, {summary['windows_per_second']:.1f} windows/s")
+    print("Summary written to " + out_dir + 'summary.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import json
+import warnings
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft, signal
+
+import dolphin.app.tracing as tracing
+import dolphin.preprocess.feature_extraction as feature_extraction
+
+
+# Largest difference from compute_spectrogram allowed, in dB (float32 FFTs against scipy's float64)
+ATOL_DB = 1e-3
+
+# What _probe measured of compute_spectrogram, per preprocess config and sampling rate
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+def spectrograms(wavs: list, sr: int, cfg: dict, batch_size: int = 32):
+    """
+    Computes the spectrogram of many windows with a handful of large vectorized FFT calls.
+
+    This is the batched equivalent of calling feature_extraction.compute_spectrogram(wav, sr, cfg,
+    random_pad=False) on each window: every window is zero padded to spectrogram_max_length, framed
+    with a strided view (no copies), detrended and windowed, and the FFTs of batch_size windows are
+    taken at once. The dB conversion, contrast and dynamic range steps are then applied per window.
+    If a window checked against compute_spectrogram on first use didn't match (see _probe), every window
+    goes through compute_spectrogram instead.
+
+    Args:
+        wavs (list): time series of each window, none longer than spectrogram_max_length seconds
+        sr (int): sampling rate
+        cfg (dict): the config, uses the preprocess section
+        batch_size (int): how many windows go through the FFT together, bounds the memory used
+
+    Returns:
+        (list): a (feature, f, t) tuple per window, as returned by compute_spectrogram
+    """
+    window_len = int(cfg["preprocess"]["spectrogram_max_length"] * sr)
+    if not _probe(cfg, sr)[1]:
+        return _per_window(wavs, sr, cfg)
+
+    features = []
+    for b in range(0, len(wavs), batch_size):
+        batch = np.zeros((len(wavs[b : b + batch_size]), window_len), dtype=np.float32)
+        for i, wav in enumerate(wavs[b : b + batch_size]):
+            batch[i, : min(len(wav), window_len)] = wav[:window_len]
+        features.extend(windowed_spectrograms(batch, sr, cfg))
+
+    return features
+
+
+def sliding_spectrograms(y: np.ndarray, sr: int, cfg: dict, hop: int, n_windows: int, batch_size: int = 32):
+    """
+    Spectrograms of n_windows overlapping windows starting every hop samples of y, sharing STFT frames.
+
+    The frames of the whole span are computed once and each window takes a strided view of the ones
+    it covers, so 50% overlap costs little more FFT work than no overlap. hop has to be a multiple of
+    the STFT frame step (see frame_aligned_hop) for the windows' frames to line up with the shared
+    ones; the result then matches spectrograms() of each window cut out separately (which it falls back
+    to, like spectrograms(), if the batched spectrograms don't match compute_spectrogram).
+
+    A multi-channel span, (channels, samples), goes through the same FFT calls for all its channels.
+
+    Args:
+        y (np.ndarray): the span's time series, zero padded here if the last windows run past its end,
+            either (samples,) or (channels, samples)
+        sr (int): sampling rate
+        cfg (dict): the config, uses the preprocess section
+        hop (int): samples between window starts
+        n_windows (int): how many windows to take from the span
+        batch_size (int): how many windows are post-processed together, bounds the memory used
+
+    Returns:
+        (list): a (feature, f, t) tuple per window, as returned by compute_spectrogram, window by
+            window and for a multi-channel span every channel of a window in a row
+    """
+    nfft, step, win, scale = _stft_setup(cfg, sr)
+    window_len = int(cfg["preprocess"]["spectrogram_max_length"] * sr)
+    assert hop % step == 0, "hop must be a multiple of the STFT frame step to share frames"
+
+    span_len = (n_windows - 1) * hop + window_len
+    if y.shape[-1] < span_len:
+        y = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(0, span_len - y.shape[-1])])
+    if not _probe(cfg, sr)[1]:
+        return _per_window([channel for k in range(n_windows) for channel in
+                            np.atleast_2d(y[..., k * hop : k * hop + window_len])], sr, cfg)
+
+    with tracing.span('stft', items=n_windows * (y.shape[0] if y.ndim > 1 else 1)):
+        frames = sliding_window_view(y[..., :span_len], nfft, axis=-1)[..., ::step, :]
+        frames = frames - frames.mean(axis=-1, keepdims=True)  # detrend='constant'
+        spectrum = fft.rfft(frames * win, n=nfft, axis=-1, workers=-1)
+        power = np.swapaxes((spectrum.real ** 2 + spectrum.imag ** 2) * scale, -1, -2)  # (..., n_freqs, n_frames of the span)
+
+    # (n_windows, ..., n_freqs, n_frames) view, window k starting hop // step frames after window k - 1
+    n_frames = (window_len - nfft) // step + 1
+    windows = sliding_window_view(power, n_frames, axis=-1)[..., :: hop // step, :][..., :n_windows, :]
+    windows = np.moveaxis(windows, -2, 0)
+    windows = windows.reshape((-1,) + windows.shape[-2:])  # channels of a window next to each other
+
+    f = np.fft.rfftfreq(nfft, 1 / sr)
+    t = (np.arange(n_frames) * step + nfft / 2) / sr
+    features = []
+    for b in range(0, len(windows), batch_size):
+        features.extend((feature, f, t) for feature in postprocess(windows[b : b + batch_size], cfg))
+    return features
+
+
+def frame_aligned_hop(hop: int, sr: int, cfg: dict):
+    """
+    Rounds a window hop, in samples, to the nearest non-zero multiple of the STFT frame step.
+    """
+    step = _stft_setup(cfg, sr)[1]
+    return max(step, int(round(hop / step)) * step)
+
+
+def windowed_spectrograms(batch: np.ndarray, sr: int, cfg: dict):
+    """
+    Computes the spectrogram of each row of a (n_windows, window_len) array.
+
+    Args:
+        batch (np.ndarray): equal length windows, one per row
+        sr (int): sampling rate
+        cfg (dict): the config, uses the preprocess section
+
+    Returns:
+        (list): a (feature, f, t) tuple per row
+    """
+    return _windowed(batch, sr, cfg, _stft_setup(cfg, sr))
+
+
+def _windowed(batch: np.ndarray, sr: int, cfg: dict, setup: tuple):
+    nfft, step, win, scale = setup
+
+    with tracing.span('stft', items=len(batch)):
+        # (n_windows, n_frames, nfft) view onto the batch, each frame starting step samples after the last
+        frames = sliding_window_view(batch, nfft, axis=-1)[:, ::step]
+        frames = frames - frames.mean(axis=-1, keepdims=True)  # detrend='constant'
+        spectrum = fft.rfft(frames * win, n=nfft, axis=-1, workers=-1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * scale
+        power = np.ascontiguousarray(np.swapaxes(power, 1, 2))  # (n_windows, n_freqs, n_frames)
+
+    f = np.fft.rfftfreq(nfft, 1 / sr)
+    t = (np.arange(power.shape[-1]) * step + nfft / 2) / sr
+    return [(feature, f, t) for feature in postprocess(power, cfg)]
+
+
+def postprocess(power: np.ndarray, cfg: dict):
+    """
+    Converts power spectrograms to dB and applies the contrast and dynamic range settings.
+
+    Args:
+        power (np.ndarray): power spectrograms, shape (..., n_freqs, n_frames)
+        cfg (dict): the config, uses contrast_percentile and dynamic_range
+
+    Returns:
+        (np.ndarray): the features, same shape as power
+    """
+    with tracing.span('postprocess', items=int(np.prod(power.shape[:-2]))):
+        spec = 10 * np.log10(power + np.finfo(power.dtype).eps)
+
+        # Remove each frequency bin's background level, then keep only dynamic_range dB below the peak
+        spec = spec - _percentile(spec, cfg["preprocess"]["contrast_percentile"])
+        floor = spec.max(axis=(-2, -1), keepdims=True) - cfg["preprocess"]["dynamic_range"]
+        return np.maximum(spec, floor)
+
+
+def _percentile(x: np.ndarray, q: float):
+    """
+    np.percentile(x, q, axis=-1, keepdims=True) with linear interpolation, but partitioning only the
+    two order statistics needed, which is several times faster on large batches.
+    """
+    pos = q / 100 * (x.shape[-1] - 1)
+    lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+    parts = np.partition(x, sorted({lo, hi}), axis=-1)
+    return parts[..., lo : lo + 1] + (parts[..., hi : hi + 1] - parts[..., lo : lo + 1]) * (pos - lo)
+
+
+def _per_window(wavs: list, sr: int, cfg: dict):
+    with tracing.span('stft', items=len(wavs), path='per_window'):
+        return [feature_extraction.compute_spectrogram(wav, sr=sr, cfg=cfg, random_pad=False) for wav in wavs]
+
+
+def _stft_setup(cfg: dict, sr: int, step: int = None):
+    """
+    FFT length, frame step, analysis window and PSD scaling of compute_spectrogram's scipy.signal.spectrogram call.
+    """
+    nfft = cfg["preprocess"]["nfft"]
+    win = signal.get_window(cfg["preprocess"]["window"], nfft).astype(np.float32)
+
+    # scaling='density', one sided, so every bin but DC (and Nyquist for even nfft) is doubled
+    scale = np.full(nfft // 2 + 1, 2 / (sr * (win ** 2).sum()), dtype=np.float32)
+    scale[0] /= 2
+    if nfft % 2 == 0:
+        scale[-1] /= 2
+
+    return nfft, _probe(cfg, sr)[0] if step is None else step, win, scale
+
+
+def _probe(cfg: dict, sr: int):
+    """
+    Runs compute_spectrogram on one window, once per config, and checks the batched path against it.
+
+    compute_spectrogram leaves the overlap to scipy unless the config says otherwise, so rather than second
+    guessing it the frame step is read off the frame times it returns. Raises ValueError if its frames
+    aren't nfft long or don't tile a window the way the batched framing does. The same window then goes
+    through the batched FFT and postprocess, which reimplement compute_spectrogram's dB conversion,
+    contrast and dynamic range: if that lands more than ATOL_DB away, the batched path isn't used (with
+    a warning) and spectrograms are computed a window at a time.
+
+    Returns:
+        (tuple): the frame step, in samples, and whether the batched spectrograms match
+    """
+    key = (json.dumps(cfg["preprocess"], sort_keys=True, default=str), sr)
+    with _probes_lock:
+        if key in _probes:
+            return _probes[key]
+
+    nfft = cfg["preprocess"]["nfft"]
+    window_len = int(cfg["preprocess"]["spectrogram_max_length"] * sr)
+    # A tone over noise, so the contrast and dynamic range steps both change something
+    rng = np.random.default_rng(0)
+    probe = (0.1 * np.sin(2 * np.pi * sr / 8 * np.arange(window_len) / sr) + 0.02 * rng.standard_normal(window_len))
+    probe = probe.astype(np.float32)
+    feature, f, t = feature_extraction.compute_spectrogram(probe, sr=sr, cfg=cfg, random_pad=False)
+    if len(f) != nfft // 2 + 1 or len(t) < 2 or int(round(2 * t[0] * sr)) != nfft:
+        raise ValueError(f"compute_spectrogram doesn't frame {nfft} sample segments with nfft={nfft}, "
+                         f"got {len(f)} frequencies and frames centred from {t[0]:.6f}s")
+    step = int(round((t[1] - t[0]) * sr))
+    if step <= 0 or (window_len - nfft) // step + 1 != len(t):
+        raise ValueError(f"compute_spectrogram gives {len(t)} frames per window, a step of {step} samples would give "
+                         f"{(window_len - nfft) // step + 1 if step > 0 else 0}")
+
+    batched = _windowed(probe[None], sr, cfg, _stft_setup(cfg, sr, step))[0][0]
+    feature = np.asarray(feature)
+    diff = float(np.abs(feature - batched).max()) if feature.shape == batched.shape else np.inf
+    if diff > ATOL_DB:
+        warnings.warn(f"Batched spectrograms differ from compute_spectrogram by up to {diff:.2e} dB, "
+                      f"computing them a window at a time instead")
+
+    with _probes_lock:
+        _probes[key] = step, diff <= ATOL_DB
+    return _probes[key]
@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark of the detection, classification and Raven classification runners on synthetic
+whistle recordings (see synthetic.py).
+
+For every recording length, each runner is measured stage by stage. Each stage is its own pass that
+includes the stages before it, so the difference between two stages is what the later one costs:
+    decode     - reading and resampling the audio into windows
+    features   - decode plus rendering every window's spectrogram
+    end_to_end - the runner's run() as the pages call it, with the model
+Each stage reports its wall time, windows per second and peak memory (resident set size above what the
+process held when the stage started). The results are saved as json; pass an earlier json as
+--baseline to see how every number moved.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_end_to_end.py --durations 5 60 600 3600 --out outputs/benchmarks/e2e.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import resource
+
+sys.path.append('src/')
+import dolphin.app.app_detect as app_detect
+import dolphin.app.app_classify as app_classify
+import dolphin.app.app_raven_classify as app_raven_classify
+from dolphin.app.selection_table import SelectionTable
+from dolphin.app.benchmarks.synthetic import write_recording, UploadedFile, selection_table
+
+
+class PeakMemory:
+    """
+    Samples the process' resident set size in a background thread while the with block runs.
+
+    ru_maxrss only ever reports the peak of the whole process, so it can't tell stages apart; reading
+    /proc/self/statm every few milliseconds can. Where /proc doesn't exist the ru_maxrss growth is used.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start = self.peak = _rss()
+        self._maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+        if self.start == 0:  # no /proc, fall back to how much the lifetime peak grew (in KB on Linux)
+            self.peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._maxrss) * 1024
+
+    @property
+    def peak_mb(self):
+        return (self.peak - self.start) / 1e6
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def measure(stage: str, fn):
+    """
+    Runs fn once, timing it and tracking its peak memory.
+
+    Args:
+        stage (str): name of the stage
+        fn (callable): runs the stage and returns how many windows it went through
+
+    Returns:
+        (dict): stage, windows, seconds, windows_per_second and peak_mb
+    """
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        n_windows = fn()
+        elapsed = time.perf_counter() - start
+    return {'stage': stage, 'windows': n_windows, 'seconds': elapsed,
+            'windows_per_second': n_windows / elapsed if elapsed > 0 else 0.0, 'peak_mb': memory.peak_mb}
+
+
+def bench_detect(fp: str, cfg: dict, args):
+    def decode():
+        return sum(span[2] for span in app_detect.iter_spans(UploadedFile(fp), cfg, hop_sec=args.hop))
+
+    def features():
+        return sum(len(app_detect.span_features(span, cfg)) for span in app_detect.iter_spans(UploadedFile(fp), cfg, hop_sec=args.hop))
+
+    def end_to_end():
+        results = app_detect.run(UploadedFile(fp), 'mobilenetv2', args.threshold, args.detector_weights,
+                                 cfg_filename=args.config, batch_size=args.batch_size, hop_sec=args.hop)[0]
+        return len(results)
+
+    return [measure('decode', decode), measure('features', features)] + \
+           ([measure('end_to_end', end_to_end)] if not args.no_model else [])
+
+
+def bench_classify(fps: list, cfg: dict, args):
+    def decode():
+        return sum(1 for _ in app_classify.iter_clips([UploadedFile(fp) for fp in fps], cfg))
+
+    def features():
+        return sum(len(app_classify.clip_features(clip, cfg)) for clip in app_classify.iter_clips([UploadedFile(fp) for fp in fps], cfg))
+
+    def end_to_end():
+        results = app_classify.run([UploadedFile(fp) for fp in fps], 'mobilenetv2', args.classifier_weights,
+                                   cfg_filename=args.config, batch_size=args.batch_size)[0]
+        return len(results)
+
+    return [measure('decode', decode), measure('features', features)] + \
+           ([measure('end_to_end', end_to_end)] if not args.no_model else [])
+
+
+def bench_raven(fp: str, events: list, cfg: dict, args):
+    basename = os.path.basename(fp)[:-4]
+    tables = {basename: SelectionTable.read(selection_table(events, basename + '.csv'))}
+
+    def decode():
+        return sum(len(chunks) for _, chunks, _, _, _ in app_raven_classify.iter_selections([UploadedFile(fp)], tables, cfg))
+
+    def features():
+        selections = app_raven_classify.iter_selections([UploadedFile(fp)], tables, cfg)
+        return sum(len(app_raven_classify.selection_features(sel, cfg)) for sel in selections)
+
+    def end_to_end():
+        uploads = [UploadedFile(fp), selection_table(events, basename + '.csv')]
+        results = app_raven_classify.run(uploads, 'mobilenetv2', args.classifier_weights,
+                                         cfg_filename=args.config, batch_size=args.batch_size)[0]
+        return len(results)
+
+    return [measure('decode', decode), measure('features', features)] + \
+           ([measure('end_to_end', end_to_end)] if not args.no_model else [])
+
+
+def compare(results: list, baseline_fp: str):
+    """
+    Prints how every stage's time and memory moved since an earlier run of the benchmark.
+    """
+    with open(baseline_fp, 'r') as f:
+        baseline = {(r['runner'], r['seconds_of_audio'], r['stage']): r for r in json.load(f)['results']}
+
+    print(f"Compared to {baseline_fp}:")
+    for r in results:
+        old = baseline.get((r['runner'], r['seconds_of_audio'], r['stage']))
+        if old is None or old['seconds'] == 0:
+            continue
+        print(f"    {r['runner']:>6} {r['seconds_of_audio']:>7.0f}s {r['stage']:>10}: time x{r['seconds'] / old['seconds']:.2f}, "
+              f"peak memory {r['peak_mb'] - old['peak_mb']:+.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=float, nargs='+', default=[5, 60, 600], help='seconds of audio per recording')
+    parser.add_argument('--runners', nargs='+', default=['detect', 'classify', 'raven'], choices=['detect', 'classify', 'raven'])
+    parser.add_argument('--native-sr', type=int, default=96000, help='sampling rate the recordings are written at')
+    parser.add_argument('--snr-db', type=float, default=0, help='whistle power relative to the noise')
+    parser.add_argument('--whistles-per-minute', type=float, default=6)
+    parser.add_argument('--clip-sec', type=float, default=3, help='length of each classification clip')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--detector-weights', default='weights/detector_weights.h5')
+    parser.add_argument('--classifier-weights', default='weights/classifier_weights.h5')
+    parser.add_argument('--threshold', type=float, default=0.5, help='detector confidence threshold')
+    parser.add_argument('--hop', type=float, default=3.0, help='seconds between detection window starts')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--no-model', action='store_true', help='only benchmark decoding and features')
+    parser.add_argument('--out', default='outputs/benchmarks/end_to_end.json', help='where the results are saved')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i,seconds in enumerate(args.durations):
+            fp = os.path.join(tmp, f'synthetic_{int(seconds)}s.wav')
+            events = write_recording(fp, seconds, sr=args.native_sr, snr_db=args.snr_db,
+                                     whistles_per_minute=args.whistles_per_minute, seed=i)
+
+            runs = {}
+            if 'detect' in args.runners:
+                runs['detect'] = bench_detect(fp, cfg, args)
+            if 'classify' in args.runners:
+                # The same amount of audio, as the short clips the classification page takes
+                n_clips = max(1, int(seconds // args.clip_sec))
+                clips = []
+                for j in range(n_clips):
+                    clips.append(os.path.join(tmp, f'clip_{int(seconds)}s_{j}.wav'))
+                    write_recording(clips[-1], args.clip_sec, sr=args.native_sr, snr_db=args.snr_db,
+                                    whistles_per_minute=60 / args.clip_sec, seed=1000 * i + j)
+                runs['classify'] = bench_classify(clips, cfg, args)
+                for clip in clips:
+                    os.remove(clip)
+            if 'raven' in args.runners and events:
+                runs['raven'] = bench_raven(fp, events, cfg, args)
+            os.remove(fp)
+
+            for runner, stages in runs.items():
+                for r in stages:
+                    results.append({'runner': runner, 'seconds_of_audio': seconds, **r})
+                    print(f"{runner:>8} {seconds:>7.0f}s {r['stage']:>10}: {r['seconds']:7.2f}s, "
+                          f"{r['windows_per_second']:8.1f} windows/s, peak {r['peak_mb']:7.1f} MB")
+
+    out_dir = os.path.dirname(args.out)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(args.out, 'w') as f:
+        json.dump({'args': vars(args), 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+                   'cpus': os.cpu_count(), 'results': results}, f, indent=4)
+    print("Results written to " + args.out)
+
+    if args.baseline is not None:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
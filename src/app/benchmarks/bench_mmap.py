@@ -0,0 +1,97 @@
+"""
+Benchmark of reading 16-bit PCM WAV recordings already at the configured rate through the memory map
+(audio_stream.map_pcm16) against decoding them with soundfile.
+
+Writes a synthetic recording at the configured rate, then for both paths times:
+    spans    - iter_spans over the whole recording, as detection reads it (from a path and from an upload)
+    segments - read_segments of a few clips spread over the recording, as Classify Prior Detections reads it
+along with the peak of the arrays allocated on the way (tracemalloc, mapped pages don't count), and
+checks both paths give the same samples.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_mmap.py --minutes 30 --channels 1 2
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import soundfile as sf
+
+sys.path.append('src/')
+import dolphin.app.audio_stream as audio_stream
+from dolphin.app.benchmarks.synthetic import write_recording, UploadedFile
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+def checksum(spans):
+    """
+    CRC of every span's samples, so the two paths can be compared without holding the whole recording.
+    """
+    crc = 0
+    for _, y in spans:
+        crc = zlib.crc32(np.ascontiguousarray(y).view(np.uint8), crc)
+    return crc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, default=30, help='length of the synthetic recording')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 2], help='channel counts to write recordings with')
+    parser.add_argument('--segments', type=int, default=50, help='clips read by the segments benchmark')
+    parser.add_argument('--config', default='config.json', help='config the sampling rate is read from')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        sr = json.load(f)['preprocess']['sampling_rate']
+    hours = args.minutes / 60
+    window, hop = 3 * sr, 3 * sr
+    span_len, span_step = 31 * hop + window, 32 * hop
+
+    for channels in args.channels:
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'bench.wav')
+            write_recording(fp, args.minutes * 60, sr=sr)
+            if channels > 1:
+                # Every channel a shifted copy of the first, enough for timing
+                y, _ = sf.read(fp, dtype='int16')
+                sf.write(fp, np.stack([np.roll(y, c) for c in range(channels)], axis=1), sr, subtype='PCM_16')
+
+            audio_stream.read_segments(fp, sr, [0], sr, mono=channels == 1, mmap=False)  # warm up librosa's jitted downmix
+            starts = np.sort(np.random.default_rng(0).integers(0, int(args.minutes * 60 * sr), args.segments)).tolist()
+            print(f'{channels} channel(s), {args.minutes:g} minutes at {sr} Hz:')
+            for name, data in (('path', lambda: fp), ('upload', lambda: UploadedFile(fp))):
+                reference = None
+                for mmap in (False, True):
+                    crc, elapsed, peak = measure(lambda: checksum(audio_stream.iter_spans(
+                        data(), sr, span_len, span_step, mono=channels == 1, mmap=mmap)))
+                    label = 'mmap' if mmap else 'decode'
+                    same = '' if reference is None else f', same samples: {crc == reference}'
+                    reference = crc if reference is None else reference
+                    print(f'    spans from {name:>6} ({label:>6}): {elapsed / hours:.2f}s per audio-hour, '
+                          f'peak {peak / 2 ** 20:.1f} MiB allocated{same}')
+
+            reference = None
+            for mmap in (False, True):
+                clips, elapsed, peak = measure(lambda: audio_stream.read_segments(fp, sr, starts, 3 * sr, mono=channels == 1, mmap=mmap))
+                label = 'mmap' if mmap else 'decode'
+                same = '' if reference is None else f', same samples: {all(np.array_equal(a, b) for a, b in zip(clips, reference))}'
+                reference = clips if reference is None else reference
+                print(f'    {len(starts)} segments ({label:>6}): {elapsed * 1000:.1f} ms, peak {peak / 2 ** 20:.1f} MiB allocated{same}')
+
+
+if __name__ == '__main__':
+    main()
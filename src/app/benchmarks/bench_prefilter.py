@@ -0,0 +1,84 @@
+"""
+Evaluation of the band-energy prefilter against the detector run on every window.
+
+Runs the detector over the given recordings with the prefilter off, keeping every window's prefilter
+score, then reports for each threshold the fraction of windows it would skip and its recall, the
+fraction of the detector's whistle windows it would still pass on. Also times scoring against the
+rest of the feature stage, to show what the prefilter costs when it doesn't skip anything.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_prefilter.py /data/deployment1 --thresholds 9.5 10 11 12
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append('src/')
+import dolphin.app.app_detect as app_detect
+import dolphin.app.batch_features as batch_features
+import dolphin.app.model_registry as model_registry
+import dolphin.app.prefilter as prefilter
+import dolphin.app.window_store as window_store
+from dolphin.app.batch_detect import find_recordings, open_named
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='directories, files or glob patterns of recordings')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[9.5, 10, 11, 12, 14], help='prefilter thresholds in dB')
+    parser.add_argument('--weights', default='weights/detector_weights.h5', help='path to the detector weights')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--threshold', type=float, default=0.5, help='detector confidence threshold')
+    parser.add_argument('--hop', type=float, default=3.0, help='seconds between window starts')
+    parser.add_argument('--out', default=None, help='optionally write the results to this json')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+    sr = cfg['preprocess']['sampling_rate']
+    band = cfg['preprocess'].get('whistle_band', prefilter.WHISTLE_BAND)
+    model = model_registry.get_detector(args.weights, model_json_path='weights/detector_model.json')
+
+    scores, predictions = [], []
+    score_time, feature_time = 0.0, 0.0
+    for fp in find_recordings(args.inputs):
+        with open_named(fp) as data:
+            for span in app_detect.iter_spans(data, cfg, hop_sec=args.hop):
+                start = time.perf_counter()
+                windows = app_detect.span_features(span, cfg)
+                feature_time += time.perf_counter() - start
+
+                # The spectrograms are recomputed here only so scoring can be timed on its own
+                _, y, n_windows, hop = span
+                if hop < sr * 3:
+                    features = batch_features.sliding_spectrograms(y, sr, cfg, hop, n_windows)
+                else:
+                    features = batch_features.spectrograms([y[i * hop : i * hop + sr * 3] for i in range(n_windows)], sr, cfg)
+                start = time.perf_counter()
+                scores.extend(prefilter.scores(features, band))
+                score_time += time.perf_counter() - start
+
+                batch = window_store.normalize(np.stack([img for _, img in windows]))
+                predictions.extend(int(float(o[0]) >= args.threshold) for o in np.asarray(model.predict_on_batch(batch)))
+        print(f'{fp}: {len(predictions)} windows so far')
+
+    results = [prefilter.metrics(scores, predictions, threshold) for threshold in args.thresholds]
+    print(f'{len(predictions)} windows, {sum(predictions)} detected; scoring took {score_time:.2f}s '
+          f'against {feature_time:.2f}s for the rest of the feature stage')
+    for r in results:
+        print(f"    {r['threshold_db']:>5.1f} dB: skips {r['skipped_fraction']:.1%} of windows, recall {r['recall']:.1%}")
+
+    if args.out is not None:
+        out_dir = os.path.dirname(args.out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'score_seconds': score_time, 'feature_seconds': feature_time,
+                       'results': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
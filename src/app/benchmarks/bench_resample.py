@@ -0,0 +1,61 @@
+"""
+Benchmark of decoding and resampling time per audio-hour for each resampling backend.
+
+Writes a synthetic 16-bit wav at each native rate, then times reading it (decode) and resampling it
+to the configured rate with every backend, and how far each backend lands from librosa's default.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_resample.py --minutes 10 --rates 96000 192000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import soundfile as sf
+
+sys.path.append('src/')
+import dolphin.app.audio_stream as audio_stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, default=10, help='length of the synthetic recordings')
+    parser.add_argument('--rates', type=int, nargs='+', default=[48000, 60000, 96000, 192000], help='native sampling rates')
+    parser.add_argument('--backends', nargs='+', default=['default', 'polyphase', 'kaiser_fast'],
+                        help="res_type values to compare, 'default' being librosa's default resampler")
+    parser.add_argument('--config', default='config.json', help='config the target sampling rate is read from')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        sr = json.load(f)['preprocess']['sampling_rate']
+    hours = args.minutes / 60
+    rng = np.random.default_rng(0)
+
+    for orig_sr in args.rates:
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'bench.wav')
+            sf.write(fp, 0.1 * rng.standard_normal(int(args.minutes * 60 * orig_sr)), orig_sr, subtype='PCM_16')
+
+            start = time.perf_counter()
+            y, _ = sf.read(fp, dtype='float32')
+            decode = time.perf_counter() - start
+            print(f'{orig_sr} Hz -> {sr} Hz: decode {decode / hours:.1f}s per audio-hour')
+
+            reference = None
+            for backend in args.backends:
+                start = time.perf_counter()
+                res_type = None if backend == 'default' else backend
+                resampled = audio_stream.resample(y, orig_sr, sr, res_type=res_type)
+                elapsed = time.perf_counter() - start
+
+                if reference is None:
+                    reference = resampled
+                diff = float(np.abs(resampled - reference).max())
+                print(f'    {backend:>10}: resample {elapsed / hours:.1f}s per audio-hour, max diff from {args.backends[0]} {diff:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of how long the app takes to start and to open each page.
+
+Every measurement runs in a fresh python process, so nothing is imported yet (a cold start; the OS file
+cache stays warm after the first repeat, like it would on a server):
+    startup       - running app.py up to main(), what every new streamlit session process pays
+    open <page>   - the first time a page is opened, importing it and whatever it needs
+    reopen <page> - opening it again in the same process, what switching between pages costs after that
+    all pages     - startup plus every page, what startup cost when app.py imported all of them
+    config        - generate_config the first time, and once it's cached (what every rerun pays now)
+The medians over the repeats are printed and saved as json.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_startup.py --repeats 5 --out outputs/benchmarks/startup.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+
+# Runs in the fresh process: times app.py's top level, then opening the given pages, and prints the timings as json
+CHILD = '''
+import sys, json, time, runpy
+start = time.perf_counter()
+sys.path.append('src/')
+app = runpy.run_path(sys.argv[1], run_name='bench_startup')
+timings = {'startup': time.perf_counter() - start}
+for page in sys.argv[2:]:
+    start = time.perf_counter()
+    app['load_page'](page)
+    timings['open ' + page] = time.perf_counter() - start
+    start = time.perf_counter()
+    app['load_page'](page)
+    timings['reopen ' + page] = time.perf_counter() - start
+if len(sys.argv) > 3:
+    timings['all pages'] = sum(timings.values()) - sum(t for name, t in timings.items() if name.startswith('reopen'))
+if len(sys.argv) == 2:
+    for name in ('config', 'config (cached)'):
+        start = time.perf_counter()
+        app['generate_config'](*app['config_inputs']())
+        timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def measure(app_fp: str, pages: list):
+    out = subprocess.run([sys.executable, '-c', CHILD, app_fp] + pages, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"Starting {app_fp} with pages {pages} failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='src/dolphin/app.py', help='path to the streamlit app')
+    parser.add_argument('--pages', nargs='+', default=None, help='pages to open, by their name in the app (default: all)')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh processes per measurement')
+    parser.add_argument('--out', default='outputs/benchmarks/startup.json', help='where the results are saved')
+    args = parser.parse_args()
+
+    sys.path.append('src/')
+    if args.pages is None:
+        import runpy
+        args.pages = list(runpy.run_path(args.app, run_name='bench_startup')['FUNCTIONALITIES'])
+
+    timings = {}
+    for _ in range(args.repeats):
+        runs = [measure(args.app, [])] + [measure(args.app, [page]) for page in args.pages]
+        # Only the one-page runs count for opening a page, in the all-pages run the others were imported already
+        if len(args.pages) > 1:
+            runs.append({'all pages': measure(args.app, args.pages)['all pages']})
+        for run in runs:
+            for name, seconds in run.items():
+                timings.setdefault(name, []).append(seconds)
+
+    results = {name: statistics.median(values) for name, values in timings.items()}
+    for name, seconds in results.items():
+        print(f"{name:>40}: {seconds * 1000:8.1f} ms")
+
+    if os.path.dirname(args.out):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump({'args': vars(args), 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'median_seconds': results,
+                   'seconds': timings}, f, indent=4)
+    print("Results written to " + args.out)
+
+
+if __name__ == '__main__':
+    main()
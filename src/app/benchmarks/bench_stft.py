@@ -0,0 +1,66 @@
+"""
+Parity check and benchmark of the batched spectrogram stage against per-window compute_spectrogram.
+
+Run from the dolphin_whistles directory:
+    python src/dolphin/app/benchmarks/bench_stft.py --minutes 60
+
+Exits with status 1 if any window differs from compute_spectrogram by more than --atol. The input is
+whistle-like sweeps over noise, with a short last window that gets zero padded.
+"""
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append('src/')
+import dolphin.app.app_detect as app_detect
+import dolphin.app.batch_features as batch_features
+import dolphin.preprocess.feature_extraction as feature_extraction
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10, 60], help='lengths of the synthetic recordings')
+    parser.add_argument('--config', default='config.json', help='config the spectrogram settings are read from')
+    parser.add_argument('--atol', type=float, default=1e-3, help='largest allowed difference, in dB')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+    sr = cfg['preprocess']['sampling_rate']
+    rng = np.random.default_rng(0)
+
+    # The batched path checks itself against compute_spectrogram and falls back to it on a mismatch
+    mismatch = not batch_features._probe(cfg, sr)[1]
+    if mismatch:
+        print('Batched spectrograms differ from compute_spectrogram, the comparison below is of the per-window fallback')
+    for minutes in args.minutes:
+        # A sweep repeating every window plus a steady tone over noise, and a couple of seconds more than a
+        # whole number of windows so the last one is short
+        t = np.arange(int(minutes * 60 * sr) + int(1.3 * sr)) / sr
+        sweep = 0.2 * np.sin(2 * np.pi * (6000 * (t % 3) + 800 * (t % 3) ** 2))
+        wav = (sweep + 0.1 * np.sin(2 * np.pi * 12000 * t) + 0.02 * rng.standard_normal(len(t))).astype(np.float32)
+        windows = app_detect.chunk(wav, sr)
+
+        start = time.perf_counter()
+        reference = [feature_extraction.compute_spectrogram(w, sr=sr, cfg=cfg, random_pad=False) for w in windows]
+        per_window = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = batch_features.spectrograms(windows, sr, cfg)
+        vectorized = time.perf_counter() - start
+
+        max_diff = max(float(np.abs(np.asarray(ref[0]) - feat[0]).max()) if np.shape(ref[0]) == feat[0].shape else np.inf
+                       for ref, feat in zip(reference, batched))
+        status = 'OK' if max_diff <= args.atol else 'MISMATCH'
+        mismatch = mismatch or max_diff > args.atol
+        print(f'{minutes:g} min, {len(windows)} windows: per-window {per_window:.2f}s, '
+              f'batched {vectorized:.2f}s, speedup {per_window / vectorized:.1f}x, max diff {max_diff:.2e} dB {status}')
+
+    if mismatch:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
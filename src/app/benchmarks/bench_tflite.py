@@ -0,0 +1,113 @@
+"""
+Parity and speed of the TFLite exports against the Keras detector or classifier.
+
+Runs the same spectrogram windows, sampled from real recordings with a different seed than the int8
+calibration, through the Keras model and every exported backend. Reports how often each backend
+agrees with Keras (top-1 and top-3 for the classifier, which side of the threshold for the detector,
+plus the largest output difference), and the latency per batch and throughput of each.
+
+Run from the dolphin_whistles directory, after export_tflite.py:
+    python src/dolphin/app/benchmarks/bench_tflite.py detector /data/deployment2 --out outputs/bench_tflite.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append('src/')
+import dolphin.app.model_registry as model_registry
+import dolphin.app.tflite_backend as tflite_backend
+import dolphin.app.window_store as window_store
+from dolphin.app.batch_detect import find_recordings
+from dolphin.app.export_tflite import DEFAULT_WEIGHTS, sample_windows, load_keras
+
+
+def run_model(model, windows: np.ndarray, batch_size: int):
+    """
+    Returns:
+        (np.ndarray, list): outputs for every window and the seconds each batch took
+    """
+    model.predict_on_batch(window_store.normalize(windows[:batch_size]))  # warm up at the benchmark's batch size
+    outputs, latencies = [], []
+    for b in range(0, len(windows), batch_size):
+        batch = window_store.normalize(windows[b : b + batch_size])
+        start = time.perf_counter()
+        outputs.append(np.asarray(model.predict_on_batch(batch)))
+        latencies.append(time.perf_counter() - start)
+    return np.concatenate(outputs), latencies
+
+
+def agreement(task: str, reference: np.ndarray, outputs: np.ndarray, threshold: float):
+    """
+    How closely a backend's outputs match the Keras model's on the same windows.
+    """
+    result = {'max_abs_diff': float(np.abs(outputs - reference).max())}
+    if task == 'detector':
+        result['threshold_agreement'] = float(np.mean((reference[:, 0] >= threshold) == (outputs[:, 0] >= threshold)))
+    else:
+        top3_ref = np.sort(np.argpartition(reference, -3, axis=1)[:, -3:], axis=1)
+        top3_out = np.sort(np.argpartition(outputs, -3, axis=1)[:, -3:], axis=1)
+        result['top1_agreement'] = float(np.mean(reference.argmax(axis=1) == outputs.argmax(axis=1)))
+        result['top3_agreement'] = float(np.mean((top3_ref == top3_out).all(axis=1)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('task', choices=['detector', 'classifier'], help='which model to compare')
+    parser.add_argument('inputs', nargs='+', help='directories, files or glob patterns of recordings')
+    parser.add_argument('--weights', default=None, help='path to the .h5 weights, the default weights of the task otherwise')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--backends', nargs='+', default=['float32', 'float16', 'int8'], choices=tflite_backend.BACKENDS[1:])
+    parser.add_argument('--n-windows', type=int, default=512, help='how many windows to compare on')
+    parser.add_argument('--batch-size', type=int, default=32, help='how many windows go through the models at once')
+    parser.add_argument('--threshold', type=float, default=0.5, help='detector confidence threshold')
+    parser.add_argument('--n-classes', type=int, default=3, help='number of classes the classifier was trained on')
+    parser.add_argument('--out', default=None, help='optionally write the results to this json')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+    weights = args.weights or DEFAULT_WEIGHTS[args.task]
+
+    windows = sample_windows(find_recordings(args.inputs), args.task, cfg, n=args.n_windows, seed=1)
+    if len(windows) == 0:
+        sys.exit('The recordings had no windows to compare on')
+
+    models = {'keras': load_keras(args.task, weights, cfg, windows.shape[1:], n_classes=args.n_classes)}
+    for backend in args.backends:
+        if os.path.exists(tflite_backend.tflite_path(weights, backend)):
+            models[backend] = model_registry.get_tflite(weights, backend, warmup=False)
+        else:
+            print(f"Skipping {backend}, {tflite_backend.tflite_path(weights, backend)} hasn't been exported")
+
+    results, reference = {}, None
+    for backend, model in models.items():
+        outputs, latencies = run_model(model, windows, args.batch_size)
+        if reference is None:
+            reference = outputs
+        results[backend] = {
+            'ms_per_batch': 1000 * float(np.median(latencies)),
+            'windows_per_second': len(windows) / sum(latencies),
+            **agreement(args.task, reference, outputs, args.threshold),
+        }
+
+    print(f"{len(windows)} windows of shape {windows.shape[1:]}, batch size {args.batch_size}")
+    for backend, r in results.items():
+        agree = ', '.join(f'{k} {v:.2%}' for k, v in r.items() if k.endswith('agreement'))
+        speedup = r['windows_per_second'] / results['keras']['windows_per_second']
+        print(f"    {backend:>8}: {r['ms_per_batch']:.1f} ms/batch, {r['windows_per_second']:.1f} windows/s "
+              f"({speedup:.2f}x), {agree}, max diff {r['max_abs_diff']:.2e}")
+
+    if args.out is not None:
+        out_dir = os.path.dirname(args.out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'n_windows': len(windows), 'results': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
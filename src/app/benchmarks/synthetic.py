@@ -0,0 +1,115 @@
+"""
+Synthetic whistle recordings for the benchmarks: frequency modulated chirps in the 5-20 kHz whistle band
+mixed into white noise at a controlled SNR, from 5 second clips to multi-hour files.
+"""
+import io
+import os
+import numpy as np
+import soundfile as sf
+
+
+def whistle_events(seconds: float, whistles_per_minute: float = 6, seed: int = 0):
+    """
+    Draws random whistles: when they start, how long they last and how their frequency moves.
+
+    Half of the whistles are linear up or down sweeps, the other half wobble sinusoidally around a
+    center frequency, both kept inside 5-20 kHz.
+
+    Args:
+        seconds (float): length of the recording
+        whistles_per_minute (float): average number of whistles per minute of audio
+        seed (int): seed of the draw
+
+    Returns:
+        (list): a dict per whistle, sorted by start time (begin and end in seconds, kind and its parameters)
+    """
+    rng = np.random.default_rng(seed)
+    n = rng.poisson(whistles_per_minute * seconds / 60)
+    events = []
+    for begin in np.sort(rng.uniform(0, max(0.0, seconds - 0.3), n)):
+        duration = min(float(rng.uniform(0.3, 1.5)), seconds - begin)
+        if rng.random() < 0.5:
+            f0, f1 = rng.uniform(5000, 20000, 2)
+            events.append({'begin': float(begin), 'end': float(begin + duration), 'kind': 'sweep',
+                           'f0': float(f0), 'f1': float(f1)})
+        else:
+            depth = float(rng.uniform(500, 3000))
+            center = float(rng.uniform(5000 + depth, 20000 - depth))
+            events.append({'begin': float(begin), 'end': float(begin + duration), 'kind': 'wobble',
+                           'center': center, 'depth': depth, 'rate': float(rng.uniform(1, 6))})
+    return events
+
+
+def write_recording(fp: str, seconds: float, sr: int = 96000, snr_db: float = 0, whistles_per_minute: float = 6,
+                    seed: int = 0, block_sec: float = 60):
+    """
+    Writes a 16-bit wav of white noise with whistles mixed in, a block at a time so any length fits in memory.
+
+    Args:
+        fp (str): path of the wav to write
+        seconds (float): length of the recording
+        sr (int): sampling rate of the file
+        snr_db (float): power of each whistle relative to the noise, over the full band
+        whistles_per_minute (float): average number of whistles per minute of audio
+        seed (int): seed of the noise and the whistles
+        block_sec (float): seconds generated at once
+
+    Returns:
+        (list): the whistles in the recording, see whistle_events
+    """
+    events = whistle_events(seconds, whistles_per_minute, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    noise_std = 0.05
+    amplitude = noise_std * np.sqrt(2 * 10 ** (snr_db / 10))  # a sine's power is amplitude ** 2 / 2
+
+    n_samples = int(seconds * sr)
+    block_len = int(block_sec * sr)
+    with sf.SoundFile(fp, 'w', samplerate=sr, channels=1, subtype='PCM_16') as f:
+        for start in range(0, n_samples, block_len):
+            stop = min(n_samples, start + block_len)
+            block = noise_std * rng.standard_normal(stop - start)
+            for event in events:
+                lo, hi = max(start, int(event['begin'] * sr)), min(stop, int(event['end'] * sr))
+                if lo < hi:
+                    block[lo - start : hi - start] += amplitude * _whistle(event, np.arange(lo, hi) / sr)
+            f.write(np.clip(block, -1, 1))
+    return events
+
+
+def _whistle(event: dict, t: np.ndarray):
+    """
+    The whistle's waveform at absolute times t, phase continuous across blocks, with 10 ms fades.
+    """
+    tau = t - event['begin']
+    duration = event['end'] - event['begin']
+    if event['kind'] == 'sweep':
+        phase = event['f0'] * tau + (event['f1'] - event['f0']) / (2 * duration) * tau ** 2
+    else:
+        phase = event['center'] * tau - event['depth'] / (2 * np.pi * event['rate']) * np.cos(2 * np.pi * event['rate'] * tau)
+    fade = np.clip(np.minimum(tau, duration - tau) / 0.01, 0, 1)
+    return fade * np.sin(2 * np.pi * phase)
+
+
+class UploadedFile(io.BytesIO):
+    """
+    Stand-in for streamlit's UploadedFile: the whole file in memory, with the name and size the runners use.
+    """
+
+    def __init__(self, fp: str, name: str = None):
+        with open(fp, 'rb') as f:
+            super().__init__(f.read())
+        self.name = name or os.path.basename(fp)
+        self.size = self.getbuffer().nbytes
+        self.type = 'text/csv' if self.name.endswith('.csv') else 'audio/wav'
+
+
+def selection_table(events: list, name: str):
+    """
+    A Raven selection table of the whistles, as the comma separated upload app_raven_classify.run reads.
+    """
+    lines = ['Selection,View,Channel,Begin Time (s),End Time (s),Low Freq (Hz),High Freq (Hz)']
+    for i,event in enumerate(events):
+        lines.append(f"{i + 1},Spectrogram 1,1,{event['begin']:.3f},{event['end']:.3f},5000.0,20000.0")
+    table = io.BytesIO(('\n'.join(lines) + '\n').encode())
+    table.name = name
+    return table
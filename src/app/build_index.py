@@ -0,0 +1,94 @@
+"""
+Adds known individuals' whistles to a whistle index, which the classification pages can match new
+whistles against instead of the classifier's fixed classes (see embedding_index.py).
+
+Each clip is rendered like the classification runner renders it and embedded with the classifier's
+penultimate layer. By default a clip's individual is the name of the directory it's in, so a catalogue
+laid out as catalogue/<individual>/*.wav is added in one go. Running it again adds to the index, no
+retraining needed. An individual that has no example image yet gets its first clip's spectrogram as
+one, which is what the labeling section shows next to each match.
+
+Run from the dolphin_whistles directory, ex.
+    python src/dolphin/app/build_index.py weights/whistle_index /data/catalogue
+    python src/dolphin/app/build_index.py weights/whistle_index /data/new_animal/*.wav --individual FB123
+"""
+import os
+import sys
+import json
+import argparse
+import cv2
+import numpy as np
+
+sys.path.append('src/')
+import dolphin.app.app_classify as app_classify
+import dolphin.app.model_registry as model_registry
+import dolphin.app.window_store as window_store
+from dolphin.app.embedding_index import EmbeddingIndex
+from dolphin.app.batch_detect import find_recordings, open_named
+
+
+def embed_clips(fps: list, cfg: dict, weights: str, n_classes: int = 3, batch_size: int = 32):
+    """
+    Renders and embeds clips, batch_size at a time.
+
+    Args:
+        fps (list): paths to the clips
+        cfg (dict): the config
+        weights (str): path to the classifier's .h5 weights
+        n_classes (int): number of classes the classifier was trained on
+        batch_size (int): how many clips are embedded at once
+
+    Yields:
+        (tuple): paths, (n, height, width, 3) uint8 spectrograms and (n, dim) embeddings of each batch
+    """
+    for b in range(0, len(fps), batch_size):
+        paths, images = fps[b : b + batch_size], []
+        for fp in paths:
+            with open_named(fp) as data:
+                for clip in app_classify.iter_clips([data], cfg):
+                    images.extend(img for _, img in app_classify.clip_features(clip, cfg))
+        images = np.stack(images)
+
+        model = model_registry.get_embedder('mobilenetv2', weights, images.shape[1:], n_classes,
+                                            learning_rate=cfg["model"]["model_params"]["learning_rate"])
+        embeddings = np.asarray(model.predict_on_batch(window_store.normalize(images)))
+        yield paths, images, embeddings.reshape(len(embeddings), -1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', help='directory of the index, created if it does not exist')
+    parser.add_argument('inputs', nargs='+', help='directories, files or glob patterns of clips')
+    parser.add_argument('--individual', default=None, help='name of the individual every clip belongs to, otherwise each clip\'s directory name')
+    parser.add_argument('--weights', default='weights/classifier_weights.h5', help='path to the classifier\'s .h5 weights')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--n-classes', type=int, default=3, help='number of classes the classifier was trained on')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--examples-dir', default='data/app/individual_examples/', help='where the example image of each individual is kept')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    fps = find_recordings(args.inputs)
+    if not fps:
+        sys.exit('No clips found in ' + ', '.join(args.inputs))
+
+    index = EmbeddingIndex(args.index, weights=args.weights)
+    before = len(index)
+    for paths, images, embeddings in embed_clips(fps, cfg, args.weights, n_classes=args.n_classes, batch_size=args.batch_size):
+        individuals = [args.individual or os.path.basename(os.path.dirname(os.path.abspath(fp))) for fp in paths]
+        index.add(embeddings, individuals)
+
+        for individual, img in zip(individuals, images):
+            example = os.path.join(args.examples_dir, individual + '.png')
+            if not os.path.exists(example):
+                os.makedirs(args.examples_dir, exist_ok=True)
+                cv2.imwrite(example, img)
+
+    print(f"Added {len(index) - before} whistles, the index at {args.index} now holds {len(index)} whistles "
+          f"of {len(index.individuals)} individuals")
+
+
+if __name__ == '__main__':
+    main()
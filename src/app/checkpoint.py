@@ -0,0 +1,198 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+import dolphin.app.tracing as tracing
+from dolphin.app.results import Results
+from dolphin.app.feature_cache import _content_hash
+
+
+class Checkpoint:
+    """
+    Checkpoint is a durable manifest of how far runs got through each recording, so a run that died part
+    way (out of memory, a refresh, a server restart) picks up where it stopped instead of starting over.
+
+    A runner commits the results of a recording a part at a time as it goes, each part ending where the
+    next run should resume (ex. a window or selection index). Recordings are keyed like the feature cache,
+    by their content plus every setting that affects the results, so only a re-run of the same recording
+    with the same settings resumes. A part's files are written first and then a line is appended to the
+    recording's journal and fsynced; a part only counts once its line is complete, so a crash at any point
+    leaves the last fully committed part to resume from.
+
+    Layout:
+        <root>/<key>/journal.jsonl      one line per committed part
+        <root>/<key>/<part>.npz         the part's Results (see Results.save)
+        <root>/<key>/<part>.images.npz  the images of some of its windows, if the runner kept any
+
+    Every recording is its own directory, so old ones can be cleaned up with workspace.gc (with
+    marker='journal.jsonl', and the keys a running job is using kept, see in_use).
+    """
+
+    def __init__(self, root: str = 'outputs/checkpoints/'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)  # batch workers open the same root at once
+        self._keys = set()
+        self._keys_lock = threading.Lock()
+
+    def key(self, data, cfg: dict, **extra):
+        """
+        Builds the key of a recording.
+
+        Args:
+            data (str or file-like): path to the audio file or the streamlit UploadedFile
+            cfg (dict): the config
+            **extra: every runner setting that affects the results, ex. the threshold, batch size and the
+                file_state of the weights
+
+        Returns:
+            (str): hex digest identifying the audio and settings
+        """
+        settings = {'audio': _content_hash(data), 'cfg': cfg, 'extra': extra}
+        key = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:40]
+        with self._keys_lock:
+            self._keys.add(key)
+        return key
+
+    @staticmethod
+    def file_state(*paths):
+        """
+        What a key should know about model or index files the results depend on: their path, size and
+        modification time, so rewriting one in place (ex. retrained weights, a rebuilt index) starts runs
+        over instead of serving results of the old one. Missing files are None.
+        """
+        states = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                states.append(None)
+                continue
+            states.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        return states
+
+    def in_use(self):
+        """
+        Every key made with this Checkpoint so far, ex. by the job it was handed to, for gc to keep.
+        """
+        with self._keys_lock:
+            return tuple(self._keys)
+
+    def parts(self, key: str):
+        """
+        The committed parts of a recording, in order. Torn lines (a crash mid-append) are skipped, and a
+        part whose files are missing ends the list, everything after it is redone.
+
+        Returns:
+            (list): {'part', 'stop', 'done'} of each part
+        """
+        try:
+            with open(os.path.join(self.root, key, 'journal.jsonl'), 'r') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return []
+
+        parts = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('part') != len(parts):
+                continue
+            if not os.path.exists(self._part_path(key, entry['part'])) or \
+                    (entry.get('images') and not os.path.exists(self._part_path(key, entry['part'], 'images'))):
+                break
+            parts.append(entry)
+        return parts
+
+    def stop(self, key: str):
+        """
+        Where a run of the recording should resume, 0 if nothing was committed.
+        """
+        parts = self.parts(key)
+        return parts[-1]['stop'] if parts else 0
+
+    def finished(self, key: str):
+        parts = self.parts(key)
+        return bool(parts) and parts[-1]['done']
+
+    def load(self, key: str):
+        """
+        Reads back everything committed for a recording.
+
+        Returns:
+            (tuple): the Results of every committed part stacked (None if nothing was committed), the images
+                kept with them as one (n, height, width, 3) array (None if none) and which rows of the results
+                they belong to
+        """
+        results, images, rows, offset = [], [], [], 0
+        with tracing.span('checkpoint.load') as span:
+            for entry in self.parts(key):
+                part = Results.load(self._part_path(key, entry['part']))
+                if entry.get('images'):
+                    with np.load(self._part_path(key, entry['part'], 'images'), allow_pickle=False) as f:
+                        if len(f['rows']):
+                            images.append(f['images'])
+                            rows.append(f['rows'] + offset)
+                results.append(part)
+                offset += len(part)
+            span.add(offset)
+
+        if not results:
+            return None, None, np.zeros(0, dtype=np.int64)
+        images = np.concatenate(images) if images else None
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        return Results.concat(results), images, rows
+
+    def commit(self, key: str, results: Results, stop: int, images=None, rows=None, done: bool = False):
+        """
+        Durably records the next part of a recording.
+
+        Args:
+            key (str): from key()
+            results (Results): the results of the part's windows
+            stop (int): where a run should resume after this part
+            images (np.ndarray): uint8 images to keep of some of the part's windows, ex. the ones shown to the user
+            rows (list): which of the part's windows the images are of
+            done (bool): the recording is finished
+        """
+        directory = os.path.join(self.root, key)
+        os.makedirs(directory, exist_ok=True)
+        part = len(self.parts(key))
+
+        with tracing.span('checkpoint.commit', items=len(results)):
+            _write(self._part_path(key, part), lambda f: results.save(f))
+            if images is not None:
+                _write(self._part_path(key, part, 'images'),
+                       lambda f: np.savez(f, images=np.asarray(images, dtype=np.uint8), rows=np.asarray(rows, dtype=np.int64)))
+
+            # The part counts once this line is on disk, appended in a single write (on a line of its own,
+            # should an earlier append have been torn)
+            line = json.dumps({'part': part, 'stop': int(stop), 'done': done, 'images': images is not None}) + '\n'
+            flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+            fd = os.open(os.path.join(directory, 'journal.jsonl'), flags, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size > 0 and os.lseek(fd, size - 1, os.SEEK_SET) >= 0 and os.read(fd, 1) != b'\n':
+                    line = '\n' + line
+                os.write(fd, line.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _part_path(self, key: str, part: int, kind: str = None):
+        return os.path.join(self.root, key, str(part) + ('.' + kind if kind else '') + '.npz')
+
+
+def _write(path: str, save):
+    """
+    Writes a file under a temporary name, fsyncs it and renames it into place.
+    """
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        save(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
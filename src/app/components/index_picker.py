@@ -0,0 +1,30 @@
+import os
+import streamlit as st
+
+from dolphin.app.embedding_index import EmbeddingIndex
+
+
+def index_picker(key: str, weights: str):
+    """
+    Sidebar input for a whistle index (built with build_index.py) to match whistles against instead of the
+    classifier's classes, returns the opened index or None when the classes should be used.
+    """
+    path = st.sidebar.text_input("Path to a whistle index of known individuals (leave empty to use the classifier's classes)",
+                                 "", key=key + '_index')
+    if not path:
+        return None
+    if not os.path.exists(os.path.join(path, 'index.json')):
+        st.sidebar.warning(f"No whistle index at {path}, build one with build_index.py. Using the classifier's classes.")
+        return None
+
+    try:
+        index = EmbeddingIndex(path, weights=weights)
+    except ValueError as e:
+        st.sidebar.warning(str(e) + ". Using the classifier's classes.")
+        return None
+    if len(index.individuals) < 3:
+        st.sidebar.warning("The whistle index needs at least 3 individuals to show 3 matches. Using the classifier's classes.")
+        return None
+
+    st.sidebar.text(f"Matching against {len(index)} whistles of {len(index.individuals)} individuals")
+    return index
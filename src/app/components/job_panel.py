@@ -0,0 +1,81 @@
+import time
+import streamlit as st
+
+import dolphin.app.jobs as jobs
+
+
+def job_owner():
+    """
+    Who is running jobs: an id kept in the page's address (?owner=...), so a refresh or a reopened link
+    still sees, loads and cancels the jobs started from it, while analysts sharing the server each see only
+    their own and take turns on the workers. The name in the sidebar is only a label in the job list (the
+    same key on every page, so it's asked once per session).
+
+    Returns:
+        (str): the session's owner id
+    """
+    params = st.experimental_get_query_params()
+    token = params.get('owner', [None])[0]
+    owner = jobs.owner_id(token)
+    if owner != token:
+        params['owner'] = owner
+        st.experimental_set_query_params(**params)
+    st.sidebar.text_input("Your name (shown in the job list)", "analyst", key='job_owner')
+    st.sidebar.caption("Your jobs are tied to this page's address: bookmark it to get back to them from another tab.")
+    return owner
+
+
+def job_panel(kind: str, owner: str):
+    """
+    Lists the owner's jobs of one page with their progress and a button to cancel the running ones or
+    load the results of the finished ones.
+
+    Returns:
+        (tuple): (job, result) for the job whose results were asked for on this run, (None, None) otherwise
+    """
+    page_jobs = jobs.get_queue().jobs(owner=owner, kind=kind)
+    if not page_jobs:
+        return None, None
+
+    st.subheader("Jobs")
+    if any(job.active for job in page_jobs):
+        st.button("Refresh progress", key=kind + '_refresh')  # any button press reruns the page
+
+    loaded = None, None
+    for job in page_jobs:
+        started = time.strftime('%H:%M', time.localtime(job.submitted))
+        by = st.session_state.get('job_owner', '').strip()
+        st.write(f"**{job.title}**{' for ' + by if by else ''} (started {started}): {job.status}")
+        if job.status in ('running', 'done') and job.n_files:
+            st.progress(min(1.0, job.files_done / job.n_files))
+            current = f", on {job.current_file}" if job.status == 'running' and job.current_file else ""
+            st.caption(f"{job.files_done} of {job.n_files} files, {job.windows} windows at "
+                       f"{job.windows_per_second:.1f} windows/s{current}")
+
+        if job.active:
+            if st.button("Cancel", key=f'{kind}_cancel_{job.id}'):
+                job.cancel()
+                st.write("Cancelling, the job stops after its current batch.")
+        elif job.status == 'failed':
+            st.error(job.error)
+        elif job.status == 'done' and not job.info.get('collected'):
+            if st.button("Load results", key=f'{kind}_load_{job.id}'):
+                loaded = job, job.collect()
+    return loaded
+
+
+def job_runs(kind: str):
+    """
+    Workspace run ids of every job of one page the queue still knows about, whoever submitted them, so
+    workspace cleanup leaves their outputs alone.
+    """
+    return tuple(job.info['run_id'] for job in jobs.get_queue().jobs(kind=kind) if 'run_id' in job.info)
+
+
+def job_checkpoints(kind: str):
+    """
+    Checkpoint keys the active jobs of one page are reading or appending to, whoever submitted them, so
+    checkpoint cleanup leaves them alone.
+    """
+    return tuple(key for job in jobs.get_queue().jobs(kind=kind) if job.active and job.info.get('checkpoint')
+                 for key in job.info['checkpoint'].in_use())
@@ -0,0 +1,58 @@
+import json
+import pandas as pd
+import streamlit as st
+
+import dolphin.app.tracing as tracing
+
+
+def trace_toggle(key: str):
+    """
+    Sidebar checkbox turning stage timing on or off for this session's page only. The page's spans are
+    recorded into the session's collector (see new_trace), which this makes current for the script run.
+
+    Returns:
+        (bool): whether it's on
+    """
+    on = st.sidebar.checkbox("Record how long each stage takes", value=False, key=key + '_tracing')
+    collector = st.session_state.get(key + '_trace') if on else None
+    if on and collector is None:
+        collector = st.session_state[key + '_trace'] = tracing.Collector()
+    tracing.activate(collector)
+    return on
+
+
+def new_trace(key: str, on: bool):
+    """
+    Starts a new collector for a run of the page (the previous run's spans are let go of), to be handed to
+    its job and shown in the panel.
+
+    Returns:
+        (tracing.Collector): the collector, None if timing is off
+    """
+    collector = tracing.Collector() if on else None
+    st.session_state[key + '_trace'] = collector
+    tracing.activate(collector)
+    return collector
+
+
+def trace_panel(key: str):
+    """
+    Collapsible sidebar panel with the time, throughput and memory of every stage recorded so far,
+    and a download of the spans as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev).
+    """
+    collector = st.session_state.get(key + '_trace')
+    if collector is None or not tracing.enabled():
+        return
+
+    with st.sidebar.expander("Stage timings"):
+        rows = collector.summary()
+        if not rows:
+            st.write("Nothing recorded yet, run the page first.")
+            return
+
+        columns = ['name', 'count', 'total_ms', 'max_ms', 'items', 'items_per_second', 'peak_rss_mb']
+        st.dataframe(pd.DataFrame(rows)[columns].round(1).set_index('name'))
+        if collector.dropped:
+            st.caption(f"Only the first {collector.max_events} spans were kept, {collector.dropped} more were dropped.")
+        st.download_button("Download Chrome trace", json.dumps(collector.chrome_trace(), default=str),
+                           file_name=key + '_trace.json', mime='application/json')
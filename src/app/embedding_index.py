@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+import numpy as np
+
+import dolphin.app.tracing as tracing
+
+
+class EmbeddingIndex:
+    """
+    EmbeddingIndex is a persistent nearest neighbour index of whistle embeddings (the classifier's
+    penultimate layer), labeled with the individual each whistle came from. Whistles are matched by
+    cosine similarity, so new individuals can be added at any time without retraining the classifier.
+
+    On disk the index is a directory of three files:
+        vectors.f32 - the L2 normalized embeddings, float32 rows of dim values, memory-mapped on open
+        labels.i32  - which individual each row belongs to
+        index.json  - dim, the number of rows, the individuals' names and the weights the embeddings came from
+    Rows are only ever appended, and index.json is replaced last (atomically), so a crash mid-add leaves
+    the index as it was before the add.
+
+    Args:
+        path (str): directory of the index, created on the first add
+        weights (str): weights of the model the embeddings come from, checked against the index's own
+    """
+
+    def __init__(self, path: str, weights: str = None):
+        self.path = path if path.endswith('/') else path + '/'
+        self._lock = threading.Lock()
+        self.dim, self.individuals, self.weights = None, [], weights
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.labels = np.zeros(0, dtype=np.int32)
+
+        if os.path.exists(self.path + 'index.json'):
+            with open(self.path + 'index.json', 'r') as f:
+                meta = json.load(f)
+            if weights is not None and meta.get('weights') not in (None, os.path.basename(weights)):
+                raise ValueError(f"The index at {path} holds embeddings of {meta['weights']}, not {os.path.basename(weights)}")
+            self.dim, self.individuals, self.weights = meta['dim'], meta['individuals'], meta.get('weights')
+            self._open(meta['count'])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _open(self, count: int):
+        # Rows past count are from an add that didn't finish, they're ignored and overwritten by the next one
+        if count == 0:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.labels = np.zeros(0, dtype=np.int32)
+            return
+        self.vectors = np.memmap(self.path + 'vectors.f32', dtype=np.float32, mode='r', shape=(count, self.dim))
+        self.labels = np.memmap(self.path + 'labels.i32', dtype=np.int32, mode='r', shape=(count,))
+
+        # Rows grouped by individual, so the best match of each one is a single reduceat over the similarities
+        self._order = np.argsort(self.labels, kind='stable')
+        grouped = self.labels[self._order]
+        self._group_starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+
+    def add(self, embeddings: np.ndarray, individual):
+        """
+        Appends embeddings of known whistles to the index.
+
+        Args:
+            embeddings (np.ndarray): (n, dim) embeddings, see model_registry.get_embedder
+            individual (str or list): name of the individual all the embeddings belong to, or one name per embedding
+        """
+        embeddings = normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        names = [individual] * len(embeddings) if isinstance(individual, str) else list(individual)
+        if len(names) != len(embeddings):
+            raise ValueError(f"Got {len(embeddings)} embeddings but {len(names)} individuals")
+        if len(embeddings) == 0:
+            return
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"The index holds {self.dim}-d embeddings, got {embeddings.shape[1]}-d ones")
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            individuals = list(self.individuals)
+            for name in names:
+                if name not in individuals:
+                    individuals.append(name)
+            ids = {name: i for i,name in enumerate(individuals)}
+            labels = np.array([ids[name] for name in names], dtype=np.int32)
+
+            # The memmaps are let go of first, Windows can't resize a file that's mapped
+            count = len(self)
+            self.vectors = self.labels = None
+            try:
+                for fn, rows, width in (('vectors.f32', embeddings, self.dim * 4), ('labels.i32', labels, 4)):
+                    with open(self.path + fn, 'ab') as f:
+                        f.truncate(count * width)  # drop what an interrupted add left behind
+                        f.write(rows.tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                tmp = self.path + 'index.json.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({'dim': self.dim, 'count': count + len(embeddings), 'individuals': individuals,
+                               'weights': os.path.basename(self.weights) if self.weights else None}, f, indent=4)
+                os.replace(tmp, self.path + 'index.json')
+                self.individuals = individuals
+                count += len(embeddings)
+            finally:
+                self._open(count)
+
+    def search(self, embeddings: np.ndarray, k: int = 3):
+        """
+        The k most similar whistles in the index to each embedding.
+
+        Args:
+            embeddings (np.ndarray): (n, dim) query embeddings
+            k (int): how many neighbours per query
+
+        Returns:
+            (tuple): (n, k) row indices into the index and (n, k) cosine similarities, most similar first
+        """
+        similarities = self._similarities(embeddings)
+        return _top_k(similarities, min(k, len(self)))
+
+    def match(self, embeddings: np.ndarray, k: int = 3):
+        """
+        The k individuals whose closest whistle in the index is most similar to each embedding.
+
+        Args:
+            embeddings (np.ndarray): (n, dim) query embeddings
+            k (int): how many individuals per query
+
+        Returns:
+            (tuple): (n, k) names of the individuals and (n, k) cosine similarities, best match first
+        """
+        best = self.individual_similarities(embeddings)
+        columns, scores = _top_k(best, min(k, best.shape[1]))
+        names = np.asarray(self.individuals, dtype=object)[columns]
+        return names, scores
+
+    def individual_similarities(self, embeddings: np.ndarray):
+        """
+        How similar each embedding is to every individual's closest whistle.
+
+        Returns:
+            (np.ndarray): (n, number of individuals) cosine similarities, columns in the order of self.individuals
+        """
+        similarities = self._similarities(embeddings)
+        if len(self) == 0:
+            return similarities
+        # Every individual has at least one row, so the groups are exactly the individuals, in id order
+        return np.maximum.reduceat(similarities[:, self._order], self._group_starts, axis=1)
+
+    def _similarities(self, embeddings: np.ndarray):
+        embeddings = normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), self.dim or -1))
+        if len(self) == 0:
+            return np.zeros((len(embeddings), 0), dtype=np.float32)
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"The index holds {self.dim}-d embeddings, got {embeddings.shape[1]}-d ones")
+        with tracing.span('index_search', items=len(embeddings)):
+            return embeddings @ self.vectors.T
+
+
+def normalize(embeddings: np.ndarray):
+    """
+    Scales every row to unit length, so dot products are cosine similarities.
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, np.float32(1e-12))
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """
+    Column indices and values of the k largest scores of every row, largest first.
+    """
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=scores.dtype)
+    top = np.argpartition(scores, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
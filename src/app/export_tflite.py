@@ -0,0 +1,110 @@
+"""
+Exports the detector or classifier to TFLite (float32, float16 and/or int8) for faster CPU inference.
+
+int8 is calibrated on spectrogram windows sampled from real recordings, rendered exactly like the
+runners render them. The exports are written next to the weights (ex. weights/detector_weights.int8.tflite),
+which is where the runners look for them when a TFLite backend is picked.
+
+Run from the dolphin_whistles directory, ex.
+    python src/dolphin/app/export_tflite.py detector /data/deployment1 --quantization float16 int8
+    python src/dolphin/app/export_tflite.py classifier /data/clips --weights weights/classifier_weights.h5
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.append('src/')
+import dolphin.app.app_detect as app_detect
+import dolphin.app.app_classify as app_classify
+import dolphin.app.model_registry as model_registry
+import dolphin.app.tflite_backend as tflite_backend
+from dolphin.app.batch_detect import find_recordings, open_named
+
+
+DEFAULT_WEIGHTS = {'detector': 'weights/detector_weights.h5', 'classifier': 'weights/classifier_weights.h5'}
+
+
+def sample_windows(fps: list, task: str, cfg: dict, n: int = 256, seed: int = 0):
+    """
+    Draws n spectrogram windows uniformly at random from recordings, without holding them all in memory.
+
+    Args:
+        fps (list): paths to the recordings (long recordings for the detector, clips for the classifier)
+        task (str): 'detector' or 'classifier', which runner's windows to render
+        cfg (dict): the config
+        n (int): how many windows to draw
+        seed (int): seed of the draw, so calibration and parity checks can use disjoint windows
+
+    Returns:
+        (np.ndarray): (n, height, width, 3) uint8 windows, fewer if the recordings don't have n
+    """
+    rng = np.random.default_rng(seed)
+    sample, seen = [], 0
+
+    def windows(fp):
+        with open_named(fp) as data:
+            if task == 'detector':
+                for span in app_detect.iter_spans(data, cfg):
+                    yield from (img for _, img in app_detect.span_features(span, cfg))
+            else:
+                for clip in app_classify.iter_clips([data], cfg):
+                    yield from (img for _, img in app_classify.clip_features(clip, cfg))
+
+    # Reservoir sampling, every window seen has the same n / seen chance of being in the sample
+    for fp in fps:
+        for img in windows(fp):
+            seen += 1
+            if len(sample) < n:
+                sample.append(img)
+            else:
+                j = rng.integers(seen)
+                if j < n:
+                    sample[j] = img
+
+    return np.stack(sample) if sample else np.zeros((0, 0, 0, 3), dtype=np.uint8)
+
+
+def load_keras(task: str, weights: str, cfg: dict, input_shape: tuple, n_classes: int = 3):
+    """
+    Loads the Keras model a runner would use for task.
+    """
+    if task == 'detector':
+        return model_registry.get_detector(weights, model_json_path='weights/detector_model.json', warmup=False)
+    return model_registry.get_classifier('mobilenetv2', weights, input_shape, n_classes,
+                                         learning_rate=cfg["model"]["model_params"]["learning_rate"], warmup=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('task', choices=['detector', 'classifier'], help='which model to export')
+    parser.add_argument('inputs', nargs='+', help='directories, files or glob patterns of recordings to calibrate on')
+    parser.add_argument('--weights', default=None, help='path to the .h5 weights, the default weights of the task otherwise')
+    parser.add_argument('--config', default='config.json', help='path to the config')
+    parser.add_argument('--quantization', nargs='+', default=['float16', 'int8'], choices=tflite_backend.BACKENDS[1:])
+    parser.add_argument('--n-calibration', type=int, default=256, help='how many windows int8 is calibrated on')
+    parser.add_argument('--n-classes', type=int, default=3, help='number of classes the classifier was trained on')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+    weights = args.weights or DEFAULT_WEIGHTS[args.task]
+
+    fps = find_recordings(args.inputs)
+    if not fps:
+        sys.exit('No recordings found in ' + ', '.join(args.inputs))
+    calibration = sample_windows(fps, args.task, cfg, n=args.n_calibration)
+    if len(calibration) == 0:
+        sys.exit('The recordings had no windows to calibrate on')
+    print(f"Sampled {len(calibration)} calibration windows of shape {calibration.shape[1:]} from {len(fps)} recordings")
+
+    model = load_keras(args.task, weights, cfg, calibration.shape[1:], n_classes=args.n_classes)
+    for quantization in args.quantization:
+        path = tflite_backend.tflite_path(weights, quantization)
+        size = tflite_backend.export(model, path, quantization=quantization, calibration=calibration)
+        print(f"{quantization}: {path} ({size / 1e6:.1f} MB, Keras weights {os.path.getsize(weights) / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+import dolphin.app.tracing as tracing
+
+
+# The config fields that change what the spectrogram images of a recording look like (or which get kept)
+PREPROCESS_FIELDS = ('sampling_rate', 'nfft', 'noverlap', 'window', 'contrast_percentile', 'dynamic_range',
+                     'spectrogram_max_length', 'features', 'res_type', 'whistle_band')
+
+# How many bytes each cache directory holds as far as this process knows, and how many entries it put
+# there since it last looked, shared by every FeatureCache of the directory (pages make one per rerun)
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+# Entries put between two full scans of the directory, which catch what other processes added
+RESCAN_EVERY = 100
+
+# Fraction of max_bytes an over budget cache is evicted down to
+EVICT_TO = 0.9
+
+
+class FeatureCache:
+    """
+    FeatureCache keeps the spectrogram images of recordings on disk, so re-running a recording with a
+    different threshold or weights goes straight to inference.
+
+    Entries are keyed by a hash of the audio content plus every setting that affects the images, so
+    renamed or re-uploaded files still hit and changed settings never return stale images. Each entry
+    is a directory holding the images as one uint8 .npy array, which is memory-mapped on reads, and a
+    json of whatever the runner needs alongside them (ex. start times). Least recently used entries
+    are evicted once the cache grows past max_bytes: the size is kept up to date as entries are put, so
+    the directory is only walked when that goes over budget or every RESCAN_EVERY puts.
+    """
+
+    def __init__(self, cache_dir: str = 'outputs/cache/features/', max_bytes: int = 5 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, data, cfg: dict, **extra):
+        """
+        Builds the cache key of a recording.
+
+        Args:
+            data (str or file-like): path to the audio file or the streamlit UploadedFile
+            cfg (dict): the config, only the fields that affect the images are used
+            **extra: any runner settings that also affect the images, ex. hop_sec or the selection times
+
+        Returns:
+            (str): hex digest identifying the audio and settings
+        """
+        settings = {
+            'audio': _content_hash(data),
+            'preprocess': {field: cfg['preprocess'].get(field) for field in PREPROCESS_FIELDS},
+            'output': cfg.get('output', {}),
+            'extra': extra,
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Looks an entry up, marking it as recently used.
+
+        Returns:
+            (np.ndarray, dict): the memory-mapped (n, height, width, 3) images and the stored meta,
+                or None if the entry isn't cached
+        """
+        entry = os.path.join(self.cache_dir, key)
+        with tracing.span('cache.get') as span:
+            try:
+                images = np.load(os.path.join(entry, 'images.npy'), mmap_mode='r')
+                with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                    meta = json.load(f)
+                os.utime(entry)
+            except (OSError, ValueError):
+                return None
+            span.add(len(images))
+        return images, meta
+
+    def put(self, key: str, images, meta: dict = None):
+        """
+        Stores the images of a recording, then evicts old entries if the cache is over budget.
+
+        Args:
+            key (str): from key()
+            images (list or np.ndarray): the uint8 images, all of the same shape
+            meta (dict): json serializable info to store alongside them
+        """
+        if self.max_bytes <= 0 or len(images) == 0:
+            return
+        entry = os.path.join(self.cache_dir, key)
+        tmp = entry + '.tmp' + uuid.uuid4().hex  # unique per put, threads of one process put at once too
+
+        with tracing.span('cache.put', items=len(images)):
+            # Written under a temporary name and renamed, so readers never see a half written entry
+            os.makedirs(tmp, exist_ok=True)
+            np.save(os.path.join(tmp, 'images.npy'), np.asarray(images, dtype=np.uint8))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta or {}, f)
+            size = sum(os.path.getsize(os.path.join(tmp, fn)) for fn in os.listdir(tmp))
+            try:
+                os.rename(tmp, entry)
+            except OSError:  # another run cached the same recording first
+                shutil.rmtree(tmp, ignore_errors=True)
+                return
+
+            root = os.path.abspath(self.cache_dir)
+            with _sizes_lock:
+                known = _sizes.get(root)
+                if known is not None:
+                    known[0] += size
+                    known[1] += 1
+                    if known[0] <= self.max_bytes and known[1] < RESCAN_EVERY:
+                        return
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used entries once the cache is over max_bytes, down to EVICT_TO of it so the
+        next puts have room before the directory is walked again.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if '.tmp' in name or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:  # evicted by another run while we looked
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes if total <= self.max_bytes else EVICT_TO * self.max_bytes
+        for _, size, entry in sorted(entries):
+            if total <= target:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+        with _sizes_lock:
+            _sizes[os.path.abspath(self.cache_dir)] = [total, 0]
+
+
+def _content_hash(data):
+    """
+    Hashes the bytes of an audio file, leaving file-like objects rewound for the runners.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(data, str):
+        with open(data, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        data.seek(0)
+        for block in iter(lambda: data.read(1 << 20), b''):
+            digest.update(block)
+        data.seek(0)
+    return digest.hexdigest()
@@ -6,7 +6,14 @@ import streamlit as st
 
 # Internal packages
 sys.path.append('src/')
-import dolphin.app.app_classify as app_classify
+import dolphin.app.feature_cache as feature_cache
+import dolphin.app.workspace as workspace
+import dolphin.app.window_store as window_store
+import dolphin.app.tracing as tracing
+import dolphin.app.jobs as jobs
+from dolphin.app.components.trace_panel import trace_toggle, trace_panel, new_trace
+from dolphin.app.components.index_picker import index_picker
+from dolphin.app.components.job_panel import job_owner, job_panel, job_runs
 
 
 def write_to_csv(annots, savename):
@@ -20,11 +27,53 @@ def write_to_csv(annots, savename):
             writer.writerow(row) 
 
 
+def classify_clips(job, uploaded_data: list, run, model: str, weights: str, save_pngs: bool = False, batch_size: int = 32,
+                   backend: str = 'keras', cache=None, index=None):
+    """
+    Classifies the uploaded clips as a background job (so no streamlit calls in here), writing the results
+    and the run's manifest to its workspace.
+
+    Args:
+        job (jobs.Job): the job this runs as, every clip is one file and one window
+        uploaded_data (list): the streamlit UploadedFiles
+        run (workspace.Workspace): where the windows, results and spectrograms go
+
+    Returns:
+        (tuple): png name, image, 3 best predictions and their confidences, and the csv row of every clip
+    """
+    # The runner brings in tensorflow, so it's only imported once there's something to run
+    import dolphin.app.app_classify as app_classify
+
+    export_dir = run.spectrogram_dir if save_pngs else None
+    store = window_store.WindowStore(run.path + 'windows.u8')  # memory-mapped, the labeling section shows views of it
+    with tracing.span('classify.run', items=len(uploaded_data)):
+        results, images = app_classify.run(uploaded_data, model, weights=weights, export_dir=export_dir, batch_size=batch_size,
+                                           cache=cache, store=store, backend=backend, index=index,
+                                           progress=lambda n: job.progress(windows=n, files_done=n))
+    run.write_manifest(run.write_results(results), weights=weights, backend=backend)
+
+    # The scores are kept as numbers in results, only what's shown and written out is formatted
+    predictions, confidences = results.formatted(k=3)
+    names = [name[:-3] + 'png' for name in results.files]
+
+    # Format the model predicted labels and confidence scores for ultimately writing to csv
+    model_info = []
+    for i,img in enumerate(images):
+        entry = {
+            'Filename': names[i],
+            '1st Prediction, Confidence': predictions[i][0] + ", " + str(confidences[i][0]),
+            '2nd Prediction, Confidence': predictions[i][1] + ", " + str(confidences[i][1]),
+            '3rd Prediction, Confidence': predictions[i][2] + ", " + str(confidences[i][2])
+        }
+        model_info.append(entry)
+    return names, images, predictions, confidences, model_info
+
+
 def main():
 
-    ui_dir = 'outputs/ui/classification/spectrograms/'
-    if not os.path.exists(ui_dir):
-        os.makedirs(ui_dir)
+    runs_dir = 'outputs/ui/classification/runs/'
+    # Every run exports into its own workspace, the one this session has open is marked as in use
+    workspace.touch(runs_dir, st.session_state.get("classify_run"))
     annots_dir = 'outputs/ui/classification/annotations/'
     if not os.path.exists(annots_dir):
         os.makedirs(annots_dir)
@@ -45,25 +94,35 @@ def main():
         weights = uploaded_weights 
 
     annots_savename = st.sidebar.text_input("What would you like the annotations file to be named?", 'example_name') + '.csv'
-
-    global names
-    global predictions
-    global confidences
-    global model_info
-    if upload_button:
-        predictions, confidences, images, names = app_classify.run(uploaded_data, model, weights=weights)
+    save_pngs = st.sidebar.checkbox("Also save the spectrogram images to disk", value=False)
+    batch_size = int(st.sidebar.number_input("How many spectrograms should the model process at once?", min_value=1, max_value=512, value=32))
+    backend = st.sidebar.selectbox("Which inference backend should run the model? (TFLite ones must be exported first with export_tflite.py)", ('keras', 'float16', 'int8', 'float32'))
+    index = index_picker('classify', weights)
+    tracing_on = trace_toggle('classify')
+    cache_gb = st.sidebar.number_input("How many GB of rendered spectrograms should be cached for re-runs? (0 turns the cache off)", min_value=0.0, value=5.0)
+    cache = feature_cache.FeatureCache('outputs/ui/cache/', max_bytes=int(cache_gb * 1e9)) if cache_gb > 0 else None
+
+    # Classification runs as a background job, the page only submits it and picks up its results when it's done
+    owner = job_owner()
+    if upload_button and uploaded_data:
+        # Runs older than a week or past 2GB are cleaned up when a new one starts
+        workspace.gc(runs_dir, keep=(st.session_state.get("classify_run"),) + job_runs('classify'))
+        run = workspace.Workspace(runs_dir)
+        # The job records its stages into a collector of its own, shown in this session's panel
+        new_trace('classify', tracing_on)
+        jobs.get_queue().submit(owner, 'classify', tracing.bind(lambda job: classify_clips(
+                                    job, uploaded_data, run, model, weights, save_pngs=save_pngs, batch_size=batch_size,
+                                    backend=backend, cache=cache, index=index)),
+                                n_files=len(uploaded_data), title=f"{len(uploaded_data)} clips", info={'run_id': run.run_id})
+
+    job, classified = job_panel('classify', owner)
+    if classified is not None:
+        st.session_state["classify_run"] = job.info['run_id']
+        st.session_state["classified"] = classified
+        st.session_state.pop("annotations", None)  # start annotating the new predictions from scratch
         st.success("""Predictions are complete! Go to Spectrogram Labeling section to annotate.""")
 
-        # Format the model predicted labels and confidence scores for ultimately writing to csv
-        model_info = []
-        for i,img in enumerate(images):
-            entry = {
-                'Filename': names[i],
-                '1st Prediction, Confidence': predictions[i][0] + ", " + str(confidences[i][0]),
-                '2nd Prediction, Confidence': predictions[i][1] + ", " + str(confidences[i][1]),
-                '3rd Prediction, Confidence': predictions[i][2] + ", " + str(confidences[i][2])
-            }
-            model_info.append(entry)
+    names, images, predictions, confidences, model_info = st.session_state.get("classified", ([], [], [], [], []))
     
     st.markdown("""<hr style="height:10px;border:none;color:#333;background-color:#333;" /> """, unsafe_allow_html=True)    
 
@@ -79,6 +138,7 @@ def main():
         if "annotations" not in st.session_state:
             st.session_state.annotations = {}
             st.session_state.files = names
+            st.session_state.images = images
             st.session_state.predictions = predictions
             st.session_state.confidences = confidences
             st.session_state.current_prediction = predictions[0]
@@ -96,8 +156,6 @@ def main():
                 st.session_state.current_prediction = st.session_state.predictions[st.session_state.count]
                 st.session_state.current_confidence = st.session_state.confidences[st.session_state.count]
 
-        image_path = ui_dir + st.session_state.current_image
-        
 
         if st.session_state.count < st.session_state.len:
             st.write(
@@ -114,7 +172,7 @@ def main():
         if st.session_state.count < st.session_state.len:
             st.subheader("Current spectrogram...")
             col1, col2, col3 = st.columns([1,6,1])
-            col2.image(image_path)
+            col2.image(st.session_state.images[st.session_state.count], channels='BGR')
 
             st.subheader("The model's predicted matches...", st.session_state.current_prediction)
             col2, col3, col4 = st.columns(3)
@@ -142,10 +200,13 @@ def main():
 
         st.header("Annotations")
         st.write(st.session_state.annotations)
-        write_to_csv(model_info, annots_dir+annots_savename)
+        with tracing.span('write_csv', items=len(model_info)):
+            write_to_csv(model_info, annots_dir+annots_savename)
         st.write("To access these annotations, click on your dolphin_whistles folder.")
         st.write("These are being written to... **dolphin_whistles/" + annots_dir + annots_savename, "**")
 
+    trace_panel('classify')
+
 
 if __name__ == "__main__":
     main()
@@ -1,54 +1,98 @@
 import os
 import sys
-import csv
+import numpy as np
 import streamlit as st
 
 # Internal packages
 sys.path.append('src/')
-import dolphin.app.app_detect as app_detect
-
-
-def write_to_csv(savedir: str, user_labels: list, fps: list, start_times: list, sr: int):
+import dolphin.app.feature_cache as feature_cache
+import dolphin.app.workspace as workspace
+import dolphin.app.window_store as window_store
+import dolphin.app.tracing as tracing
+import dolphin.app.audio_stream as audio_stream
+import dolphin.app.jobs as jobs
+import dolphin.app.selection_table as selection_table
+from dolphin.app.checkpoint import Checkpoint
+from dolphin.app.components.trace_panel import trace_toggle, trace_panel, new_trace
+from dolphin.app.components.job_panel import job_owner, job_panel, job_runs, job_checkpoints
+
+
+# What the verification section starts from before any detection job's results are loaded
+EMPTY_DETECTIONS = {'predictions': [], 'images': [], 'visuals': [], 'start_times': [], 'channels': [], 'wav_fps': [],
+                    'durations': [], 'messages': []}
+
+
+def detect_files(job, uploaded_data: list, run, model: str, threshold: float, weights: str, save_pngs: bool = False,
+                 hop_sec: float = 3, batch_size: int = 32, backend: str = 'keras', cache=None, prefilter_db: float = None,
+                 multichannel: bool = False, checkpoint=None):
     """
-    Takes the model predictions, user boolean labels, and filepaths and writes to csv file.
+    Runs the detector over the uploaded recordings one at a time, as a background job (so no streamlit calls
+    in here, what the page should say is returned as messages). The results of every file and the run's
+    manifest are written to its workspace.
 
     Args:
-        savedir (str): where to save the csvfile
-        user_labels (list): list of lists, holding the boolean values for whether user thinks there's NOT a whistle
-        fps (list): list of lists, holding the filepaths to original wav files
-        start_times (list): list of lists, holding the start times of whistles, relative to original wav file
+        job (jobs.Job): the job this runs as, told about every file and batch of windows
+        uploaded_data (list): the streamlit UploadedFiles
+        run (workspace.Workspace): where the windows, results and spectrograms go
+        checkpoint (Checkpoint): where progress through each recording is committed, so a re-run resumes it
+
+    Returns:
+        (dict): the windows the model found a whistle in, as lists of lists with one list per file that has any
+            (predictions, images, visuals, start_times, channels, wav_fps, and the duration of each of those files),
+            and the messages for the page
     """
+    # The runner brings in tensorflow, so it's only imported once there's something to run
+    import dolphin.app.app_detect as app_detect
+
+    detections = {key: [] for key in EMPTY_DETECTIONS}
+    result_files = []
+
+    # Run 1 file through the model at a time
+    # Save the outputs from ALL files at once
+    for data in uploaded_data:
+        job.progress(file=data.name)
+        export_dir = run.spectrogram_dir if save_pngs else None
+        # The windows live in a memory-mapped file in the run's workspace, the verification grid shows views of it
+        store = window_store.WindowStore(run.path + 'windows/' + data.name[:-4] + '.u8')
+        with tracing.span('detect.run', items=1, file=data.name):
+            results, images = app_detect.run(data, model, threshold, weights, export_dir=export_dir,
+                                             batch_size=batch_size, hop_sec=hop_sec, cache=cache,
+                                             store=store, prefilter_db=prefilter_db,
+                                             backend=backend, multichannel=multichannel,
+                                             progress=lambda n: job.progress(windows=n), checkpoint=checkpoint)
+        result_files.append(run.write_results(results, name='results/' + data.name[:-4] + '.csv'))
+        if prefilter_db is not None:
+            detections['messages'].append(f"{data.name}: the prefilter skipped {int(results.skipped.sum())} of {len(results)} windows")
+
+        # We ONLY want to visualize spectrogram windows where the model predicted 1 (whistle)
+        # So we filter out the lists of images, filepaths, and predictions based on that
+        positives = np.flatnonzero(results.above(threshold))
+
+        # Only append info for this file if there is at least 1 chunk that the model thought contained a whistle
+        if len(positives) > 0:
+            detections['predictions'].append([1] * len(positives))
+            detections['images'].append([images[i] for i in positives])
+            detections['visuals'].append([data.name[:-3] + 'png'] * len(positives))
+            detections['start_times'].append(results.start[positives].tolist())  # start time of the window, relative to the wav file
+            detections['channels'].append(results.channel[positives].tolist())  # which channel of the recording, from 1
+            detections['wav_fps'].append([data.name] * len(positives))
+            detections['durations'].append(audio_stream.duration(data))  # selections end with the recording
+        else:
+            detections['messages'].append(f"**There were no whistle instances that the model was sufficiently confident about in {data.name}**")
+        job.progress(files_done=1)
 
-    csvdict = {}
-    columns = ['Selection', 'View', 'Channel', 'Begin Time (s)', 'End Time (s)',
-                'Low Freq (Hz)', 'High Freq (Hz)', 'Filepath', 'Found']
-
-    for i,f in enumerate(fps):
-        fp = f[0][:-4]
-
-        with open(savedir + fp + '.csv', 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=columns)
-            writer.writeheader()
-
-            # Iterate over the list of user labels and write that and all other info to file
-            for j,label in enumerate(user_labels[i]):
-                start_time, end_time = int(start_times[i][j]), int(start_times[i][j]) + 3
-
-                # If label==True then the user said this does NOT contain a whistle
-                if label:
-                    continue
-                # If label==False then the user agrees with the model that there IS a whistle
-                else:
-                    writer.writerow({'Selection': j, 'View': 'Spectrogram 1', 'Channel': '1', 'Begin Time (s)': start_time, 'End Time (s)': end_time,
-                                    'Low Freq (Hz)': 0.0, 'High Freq (Hz)': sr / 2, 'Filepath': fp, 'Found': 'whistle'})
-
+    run.write_manifest(result_files, weights=weights, threshold=threshold, hop_sec=hop_sec, prefilter_db=prefilter_db,
+                       backend=backend, multichannel=multichannel)
+    return detections
 
 
 def main():
 
-    ui_dir = 'outputs/ui/detection/spectrograms/'
-    if not os.path.exists(ui_dir):
-        os.makedirs(ui_dir)
+    runs_dir = 'outputs/ui/detection/runs/'
+    # Every run exports into its own workspace, the one this session has open is marked as in use
+    workspace.touch(runs_dir, st.session_state.get("detect_run"))
+    # One checkpoint directory per recording and settings
+    checkpoints_dir = 'outputs/ui/detection/checkpoints/'
     annots_dir = 'outputs/ui/detection/annotations/'
     if not os.path.exists(annots_dir):
         os.makedirs(annots_dir)
@@ -69,46 +113,47 @@ def main():
     else:
         weights = uploaded_weights 
 
-    global all_predictions
-    global all_images
-    global all_visuals
-    global all_start_times
-    global all_wav_fps
+    save_pngs = st.sidebar.checkbox("Also save the detected spectrogram images to disk", value=False)
+    multichannel = st.sidebar.checkbox("Detect on every channel of multi-channel recordings separately (instead of their mono mix)", value=False)
+    hop_sec = st.sidebar.selectbox("How many seconds apart should the 3 second detection windows start?", (3.0, 1.5, 1.0, 0.5))
+    batch_size = int(st.sidebar.number_input("How many spectrograms should the model process at once?", min_value=1, max_value=512, value=32))
+    backend = st.sidebar.selectbox("Which inference backend should run the model? (TFLite ones must be exported first with export_tflite.py)", ('keras', 'float16', 'int8', 'float32'))
+    tracing_on = trace_toggle('detect')
+    # Plain noise scores around 9 dB (see prefilter.py), so any threshold near it decides on background
+    # variation; it's off until someone picks one from bench_prefilter.py's recall on their own recordings
+    prefilter_db = st.sidebar.slider("Skip windows whose loudest tone in the whistle band is less than this many dB above the background "
+                                     "(0 turns it off; plain noise scores about 9 dB, pick a threshold with benchmarks/bench_prefilter.py "
+                                     "on your recordings)", min_value=0.0, max_value=30.0, value=0.0, step=0.5) or None
+    cache_gb = st.sidebar.number_input("How many GB of rendered spectrograms should be cached for re-runs? (0 turns the cache off)", min_value=0.0, value=5.0)
+    cache = feature_cache.FeatureCache('outputs/ui/cache/', max_bytes=int(cache_gb * 1e9)) if cache_gb > 0 else None
+    resume = st.sidebar.checkbox("Checkpoint progress, so re-running recordings an interrupted run didn't finish picks up where it stopped", value=True)
+    checkpoint = Checkpoint(checkpoints_dir) if resume else None
+
+    # Detection runs as a background job, the page only submits it and picks up its results when it's done
+    owner = job_owner()
     upload_button = st.button("Detect Whistles")
-    if upload_button:
-        all_predictions = []
-        all_images = []
-        all_visuals = []
-        all_start_times = []
-        all_wav_fps = []
-
-        # Run 1 file through the model at a time
-        # Save the outputs from ALL files at once
-        for data in uploaded_data:
-            predictions, confidences, images, visuals = app_detect.run(data, model, confidence_threshold, weights) 
-            
-            # We ONLY want to visualize spectrogram windows where the model predicted 1 (whistle)
-            # So we filter out the lists of images, filepaths, and predictions based on that 
-            pos_predictions, pos_images, pos_visuals = [], [], []
-            pos_start_times, pos_wav_fps = [], []
-            for i,p in enumerate(predictions):
-                if p == 1:
-                    pos_predictions.append(p)
-                    pos_images.append(images[i])
-                    pos_visuals.append(visuals[i])
-                    pos_start_times.append(i * 3)  # start times are in 3 second intervals
-                    pos_wav_fps.append(data.name)
-
-            # Only append info for this file if there is at least 1 chunk that the model thought contained a whistle
-            if len(pos_predictions) > 0:
-                all_predictions.append(pos_predictions)
-                all_images.append(pos_images)
-                all_visuals.append(pos_visuals)
-                all_start_times.append(pos_start_times)
-                all_wav_fps.append(pos_wav_fps)
-            else:
-                st.write("**There were no whistle instances that the model was sufficiently confident about in ", data.name, "**")
-
+    if upload_button and uploaded_data:
+        # Runs older than a week or past 2GB are cleaned up when a new one starts
+        workspace.gc(runs_dir, keep=(st.session_state.get("detect_run"),) + job_runs('detect'))
+        # Checkpoints are cleaned up the same way, except the ones running jobs are using
+        workspace.gc(checkpoints_dir, keep=job_checkpoints('detect'), marker='journal.jsonl')
+        run = workspace.Workspace(runs_dir)
+        # The job records its stages into a collector of its own, shown in this session's panel
+        new_trace('detect', tracing_on)
+        jobs.get_queue().submit(owner, 'detect', tracing.bind(lambda job: detect_files(
+                                    job, uploaded_data, run, model, confidence_threshold, weights, save_pngs=save_pngs,
+                                    hop_sec=hop_sec, batch_size=batch_size, backend=backend, cache=cache,
+                                    prefilter_db=prefilter_db, multichannel=multichannel, checkpoint=checkpoint)),
+                                n_files=len(uploaded_data), title=f"{len(uploaded_data)} recordings",
+                                info={'run_id': run.run_id, 'checkpoint': checkpoint})
+
+    job, detections = job_panel('detect', owner)
+    if detections is not None:
+        st.session_state["detect_run"] = job.info['run_id']
+        st.session_state["detections"] = detections
+        st.session_state.pop("labels", None)  # start verifying the new detections from scratch
+        for message in detections['messages']:
+            st.write(message)
         st.success("Predictions are complete! Go to the Whistle Labeling section to label.")
 
 
@@ -123,12 +168,17 @@ def main():
     if detect_label_button or ("labels" in st.session_state):    
 
         if "labels" not in st.session_state:
+            detections = st.session_state.get("detections", EMPTY_DETECTIONS)
+            all_images, all_predictions = detections['images'], detections['predictions']
+            all_start_times = detections['start_times']
             st.session_state.files = all_images  # list of lists of file chunks
             st.session_state.predictions = all_predictions  # list of lists of predictions
             st.session_state.start_times = all_start_times  # list of lists of start times, relative to original audio file
+            st.session_state.channels = detections['channels']  # list of lists of the channel each window came from
+            st.session_state.durations = detections.get('durations')  # length of each file, in seconds
     
-            st.session_state.visuals = all_visuals  # list of lists of the filepaths to the spectrograms
-            st.session_state.wav_fps = all_wav_fps  # list of lists of filepaths to the original wav
+            st.session_state.visuals = detections['visuals']  # list of lists of the filepaths to the spectrograms
+            st.session_state.wav_fps = detections['wav_fps']  # list of lists of filepaths to the original wav
 
             st.session_state.len = len(all_images)  # this is the number of files
             if len(all_predictions) == 0:
@@ -172,7 +222,10 @@ def main():
             st.header("Annotations")
             st.write("To access these annotations, click on your dolphin_whistles folder.")
             st.write("These are being written to... **dolphin_whistles/" + annots_dir + "**")
-            write_to_csv(annots_dir, st.session_state.labels, st.session_state.wav_fps, st.session_state.start_times, 60000)
+            with tracing.span('write_csv', items=len(st.session_state.wav_fps)):
+                selection_table.write_detections(annots_dir, st.session_state.labels, st.session_state.wav_fps,
+                                                 st.session_state.start_times, 60000, channels=st.session_state.channels,
+                                                 durations=st.session_state.durations)
 
 
         if st.session_state.count < st.session_state.len:
@@ -198,7 +251,9 @@ def main():
 
                 # When the user presses this submit button, all checkbox info is submitted and the script is rerun
                 submit_button = st.form_submit_button(label='Submit', on_click=form_callback)
-    
+
+    trace_panel('detect')
+
 
 if __name__ == '__main__':
     main()
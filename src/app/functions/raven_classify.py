@@ -1,57 +1,121 @@
 import os
 import sys
-import csv
 import random
+import numpy as np
 import streamlit as st
 
 # Internal packages
 sys.path.append('src/')
-import dolphin.app.app_raven_classify as app_raven_classify
-
-
-def write_to_raven(orig_dfs: list, model_info: dict, savedir: str, fns: str):
+import dolphin.app.feature_cache as feature_cache
+import dolphin.app.workspace as workspace
+import dolphin.app.window_store as window_store
+import dolphin.app.tracing as tracing
+import dolphin.app.jobs as jobs
+from dolphin.app.checkpoint import Checkpoint
+from dolphin.app.selection_table import RAVEN_COLUMNS, SelectionTable
+from dolphin.app.components.trace_panel import trace_toggle, trace_panel, new_trace
+from dolphin.app.components.index_picker import index_picker
+from dolphin.app.components.job_panel import job_owner, job_panel, job_runs, job_checkpoints
+
+
+def write_to_raven(tables: dict, model_info: list, savedir: str, fns: list, indices: list):
     """
     Takes the model predictions, user boolean labels, and filepaths and writes to csv file.
 
+    The predictions are joined back onto each selection table by column and every table is written in one pass.
+
     Args:
-        orig_df (list): list of dictionaries of the original csv files
-        model_info (dict): the saved model predictions and user label for the file
+        tables (dict): basename -> SelectionTable of the original csv files
+        model_info (list): the saved model predictions and user label of each classified selection
         savedir (str): directory where the new raven files will be saved
-        fns (list): list of filenames of the original audio files
+        fns (list): basename of the audio file of each classified selection
+        indices (list): which row of its file's table each classified selection is
     """
-    columns = ['Selection', 'View', 'Channel', 'Begin Time (s)', 'End Time (s)',
-                'Low Freq (Hz)', 'High Freq (Hz)', 'Filepath', 'Label',
-                '1st Prediction, Confidence', '2nd Prediction, Confidence',
-                '3rd Prediction, Confidence']
-
-    count = 0
-    for j,orig_df in enumerate(orig_dfs):
-        fn = fns[count]
-
-        with open(savedir + fn + '.csv', 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=columns, delimiter='\t')
-            writer.writeheader()
-
-            for i,row in orig_df.iterrows():
-                count += 1 # increment how many spectrogram chunks we've looked at
-
-                row = row.to_dict()
-                writer.writerow({'Selection': row['Selection'], 'View': row['View'], 'Channel': row['Channel'], 
-                                'Begin Time (s)': row['Begin Time (s)'], 'End Time (s)': row['End Time (s)'],
-                                'Low Freq (Hz)': row['Low Freq (Hz)'], 'High Freq (Hz)': row['High Freq (Hz)'],
-                                'Filepath': fn, 'Label': model_info[i]['User Label'],
-                                '1st Prediction, Confidence': model_info[i]['1st Prediction, Confidence'], 
-                                '2nd Prediction, Confidence': model_info[i]['2nd Prediction, Confidence'],
-                                '3rd Prediction, Confidence': model_info[i]['3rd Prediction, Confidence']
-                                })
+    columns = RAVEN_COLUMNS + ['Filepath', 'Label', '1st Prediction, Confidence', '2nd Prediction, Confidence',
+                               '3rd Prediction, Confidence']
+
+    fns = np.asarray(fns)
+    indices = np.asarray(indices, dtype=np.int64)
+    for fn,table in tables.items():
+        which = np.flatnonzero(fns == fn)
+        info = [model_info[k] for k in which]
+        table = table.join(indices[which],
+                           **{'Label': [entry.get('User Label', '') for entry in info],
+                              '1st Prediction, Confidence': [entry['1st Prediction, Confidence'] for entry in info],
+                              '2nd Prediction, Confidence': [entry['2nd Prediction, Confidence'] for entry in info],
+                              '3rd Prediction, Confidence': [entry['3rd Prediction, Confidence'] for entry in info]})
+        table.df['Filepath'] = fn
+        table.write(savedir + fn + '.csv', columns=columns)
         
 
 
+def classify_selections(job, uploaded_data: list, run, model: str, weights: str, save_pngs: bool = False,
+                        batch_size: int = 32, backend: str = 'keras', cache=None, index=None, multichannel: bool = False,
+                        checkpoint=None):
+    """
+    Classifies the selections of the uploaded recordings as a background job (so no streamlit calls in here),
+    writing the results and the run's manifest to its workspace.
+
+    Args:
+        job (jobs.Job): the job this runs as, told about every batch of selections
+        uploaded_data (list): the streamlit UploadedFiles, recordings and their selection tables
+        run (workspace.Workspace): where the windows, results and spectrograms go
+        checkpoint (Checkpoint): where progress through each recording is committed, so a re-run resumes it
+
+    Returns:
+        (tuple): basename, selection index, image, 3 best predictions and their confidences, and the csv row
+            of every selection, then the selection tables by basename
+    """
+    # The runner brings in tensorflow, so it's only imported once there's something to run
+    import dolphin.app.app_raven_classify as app_raven_classify
+
+
+    # Selections are classified a recording at a time in upload order, so a recording is done once the count of
+    # windows passes the selections of it and every recording before it
+    n_selections = {data.name[:-4]: len(SelectionTable.read(data)) for data in uploaded_data
+                    if data.name.endswith('.csv') or data.name.endswith('.txt')}
+    for data in uploaded_data:
+        if hasattr(data, 'seek'):
+            data.seek(0)
+    file_ends = np.cumsum([n_selections.get(data.name[:-4], 0) for data in uploaded_data if data.name.endswith('.wav')])
+
+    def progress(n):
+        done = int(np.searchsorted(file_ends, job.windows + n, side='right'))
+        job.progress(windows=n, files_done=done - job.files_done)
+
+    export_dir = run.spectrogram_dir if save_pngs else None
+    store = window_store.WindowStore(run.path + 'windows.u8')  # memory-mapped, the labeling section shows views of it
+    with tracing.span('raven_classify.run', items=len(uploaded_data)):
+        results, images, tables = app_raven_classify.run(uploaded_data, model, weights=weights, export_dir=export_dir,
+                                                         batch_size=batch_size, cache=cache, store=store, backend=backend,
+                                                         index=index, multichannel=multichannel, progress=progress,
+                                                         checkpoint=checkpoint)
+    run.write_manifest(run.write_results(results), weights=weights, backend=backend, multichannel=multichannel)
+
+    # The scores are kept as numbers in results, only what's shown and written out is formatted
+    predictions, confidences = results.formatted(k=3)
+    basenames, indices = results.files.tolist(), results.selection.tolist()
+
+    # Format the model predicted labels and confidence scores for ultimately writing to csv
+    model_info = []
+    for i,img in enumerate(images):
+        entry = {
+            'Filename': basenames[i],
+            '1st Prediction, Confidence': predictions[i][0] + ", " + str(confidences[i][0]),
+            '2nd Prediction, Confidence': predictions[i][1] + ", " + str(confidences[i][1]),
+            '3rd Prediction, Confidence': predictions[i][2] + ", " + str(confidences[i][2])
+        }
+        model_info.append(entry)
+    return basenames, indices, images, predictions, confidences, model_info, tables
+
+
 def main():
 
-    ui_dir = 'outputs/ui/raven_classification/spectrograms/'
-    if not os.path.exists(ui_dir):
-        os.makedirs(ui_dir)
+    runs_dir = 'outputs/ui/raven_classification/runs/'
+    # Every run exports into its own workspace, the one this session has open is marked as in use
+    workspace.touch(runs_dir, st.session_state.get("raven_classify_run"))
+    # One checkpoint directory per recording and settings
+    checkpoints_dir = 'outputs/ui/raven_classification/checkpoints/'
     annots_dir = 'outputs/ui/raven_classification/annotations/'
     if not os.path.exists(annots_dir):
         os.makedirs(annots_dir)
@@ -59,7 +123,7 @@ def main():
     config = {}
 
     st.header("Classify Whistles in Long Recordings")
-    uploaded_data = st.file_uploader("Choose audio files and their respective csv file. \nEach audio file + csv file pair should share the same basename (ex. audio_file.wav + audio_file.csv). \nRequired columns of the csv file: Selection, View, Channel, Begin Time (s), End Time (s), Low Freq (Hz), High Freq (Hz)", accept_multiple_files=True)
+    uploaded_data = st.file_uploader("Choose audio files and their respective csv file. \nEach audio file + csv file pair should share the same basename (ex. audio_file.wav + audio_file.csv), the csv can be comma or tab delimited. \nRequired columns of the csv file: Selection, View, Channel, Begin Time (s), End Time (s), Low Freq (Hz), High Freq (Hz)", accept_multiple_files=True)
 
     upload_button = st.button("Classify")
     st.sidebar.title('Experiment Settings')
@@ -73,27 +137,43 @@ def main():
     else:
         weights = uploaded_weights 
 
-    global basenames
-    global indices
-    global predictions
-    global confidences
-    global model_info
-    global dfs
-    if upload_button:
-        predictions, confidences, images, basenames, indices, dfs = app_raven_classify.run(uploaded_data, model, weights=weights)
-        
+    save_pngs = st.sidebar.checkbox("Also save the spectrogram images to disk", value=False)
+    multichannel = st.sidebar.checkbox("Classify each selection on its own channel (the Channel column) of multi-channel recordings, instead of their mono mix", value=False)
+    batch_size = int(st.sidebar.number_input("How many spectrograms should the model process at once?", min_value=1, max_value=512, value=32))
+    backend = st.sidebar.selectbox("Which inference backend should run the model? (TFLite ones must be exported first with export_tflite.py)", ('keras', 'float16', 'int8', 'float32'))
+    index = index_picker('raven_classify', weights)
+    tracing_on = trace_toggle('raven_classify')
+    cache_gb = st.sidebar.number_input("How many GB of rendered spectrograms should be cached for re-runs? (0 turns the cache off)", min_value=0.0, value=5.0)
+    cache = feature_cache.FeatureCache('outputs/ui/cache/', max_bytes=int(cache_gb * 1e9)) if cache_gb > 0 else None
+    resume = st.sidebar.checkbox("Checkpoint progress, so re-running recordings an interrupted run didn't finish picks up where it stopped", value=True)
+    checkpoint = Checkpoint(checkpoints_dir) if resume else None
+
+    # Classification runs as a background job, the page only submits it and picks up its results when it's done
+    owner = job_owner()
+    if upload_button and uploaded_data:
+        # Runs older than a week or past 2GB are cleaned up when a new one starts
+        workspace.gc(runs_dir, keep=(st.session_state.get("raven_classify_run"),) + job_runs('raven_classify'))
+        # Checkpoints are cleaned up the same way, except the ones running jobs are using
+        workspace.gc(checkpoints_dir, keep=job_checkpoints('raven_classify'), marker='journal.jsonl')
+        run = workspace.Workspace(runs_dir)
+        n_wavs = sum(data.name.endswith('.wav') for data in uploaded_data)
+        # The job records its stages into a collector of its own, shown in this session's panel
+        new_trace('raven_classify', tracing_on)
+        jobs.get_queue().submit(owner, 'raven_classify', tracing.bind(lambda job: classify_selections(
+                                    job, uploaded_data, run, model, weights, save_pngs=save_pngs, batch_size=batch_size,
+                                    backend=backend, cache=cache, index=index, multichannel=multichannel, checkpoint=checkpoint)),
+                                n_files=n_wavs, title=f"{n_wavs} recordings",
+                                info={'run_id': run.run_id, 'checkpoint': checkpoint})
+
+    job, classified = job_panel('raven_classify', owner)
+    if classified is not None:
+        st.session_state["raven_classify_run"] = job.info['run_id']
+        st.session_state["raven_classified"] = classified
+        st.session_state.pop("annotations", None)  # start annotating the new predictions from scratch
         st.success("""Predictions are complete! Go to Spectrogram Labeling section to annotate. """)
 
-        # Format the model predicted labels and confidence scores for ultimately writing to csv
-        model_info = []
-        for i,img in enumerate(images):
-            entry = {
-                'Filename': basenames[i],
-                '1st Prediction, Confidence': predictions[i][0] + ", " + str(confidences[i][0]),
-                '2nd Prediction, Confidence': predictions[i][1] + ", " + str(confidences[i][1]),
-                '3rd Prediction, Confidence': predictions[i][2] + ", " + str(confidences[i][2])
-            }
-            model_info.append(entry)
+    basenames, indices, images, predictions, confidences, model_info, tables = \
+        st.session_state.get("raven_classified", ([], [], [], [], [], [], {}))
     
     st.markdown("""<hr style="height:10px;border:none;color:#333;background-color:#333;" /> """, unsafe_allow_html=True)    
 
@@ -107,6 +187,7 @@ def main():
         if "annotations" not in st.session_state:
             st.session_state.annotations = {}
             st.session_state.files = basenames 
+            st.session_state.images = images
             st.session_state.indices = indices
 
             st.session_state.predictions = predictions
@@ -128,9 +209,6 @@ def main():
                 st.session_state.current_prediction = st.session_state.predictions[st.session_state.count]
                 st.session_state.current_confidence = st.session_state.confidences[st.session_state.count]
 
-        # Path to the current image we want classified and annotated
-        image_path = ui_dir + st.session_state.current_image 
-        
         # A countdown of how many images are left to be annotated
         if st.session_state.count < st.session_state.len:
             st.write(
@@ -148,7 +226,7 @@ def main():
         if st.session_state.count < st.session_state.len:
             st.subheader("Current spectrogram...")
             col1, col2, col3 = st.columns([1,6,1])
-            col2.image(image_path)
+            col2.image(st.session_state.images[st.session_state.count], channels='BGR')
 
             st.subheader("The model's predicted matches...", st.session_state.current_prediction)
             col2, col3, col4 = st.columns(3)
@@ -178,10 +256,13 @@ def main():
         st.header("Annotations")
         if st.session_state.count >= st.session_state.len:
             st.write(st.session_state.annotations)
-            write_to_raven(dfs, model_info, annots_dir, basenames)
+            with tracing.span('write_csv', items=len(model_info)):
+                write_to_raven(tables, model_info, annots_dir, basenames, indices)
             st.write("To access these annotations, click on your dolphin_whistles folder.")
             st.write("These are being written to... **dolphin_whistles/" + annots_dir + "**")
 
+    trace_panel('raven_classify')
+
 
 if __name__ == "__main__":
     main()
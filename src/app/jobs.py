@@ -0,0 +1,201 @@
+import re
+import time
+import uuid
+import threading
+
+
+# Process wide, like the model registry: jobs outlive the streamlit script run (and browser tab) that
+# submitted them, and every session on the server shares the same workers and loaded models
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a cancelled job at its next progress report, unwinding whatever it was running.
+    """
+
+
+class Job:
+    """
+    Job is one run of a page (ex. detection over a batch of uploads) handed to the background workers.
+
+    The job function gets the Job and reports on it as it goes with progress(), which is also where a
+    cancellation takes effect. What the function returns is held on the job until the page collects it.
+
+    Args:
+        owner (str): who submitted the job, jobs are listed and scheduled per owner
+        kind (str): which page the job is for, ex. 'detect'
+        fn (callable): the work, called with this Job
+        n_files (int): how many files the job goes through, for the progress bar
+        title (str): what the job is, as shown in the job list
+        info (dict): anything the page wants to keep with the job, ex. its workspace run id
+    """
+
+    def __init__(self, owner: str, kind: str, fn, n_files: int = 0, title: str = '', info: dict = None):
+        self.id = uuid.uuid4().hex[:8]
+        self.owner, self.kind, self.fn, self.title = owner, kind, fn, title
+        self.info = info or {}
+        self.status = 'queued'  # then starting (picked by a worker), running, and done, failed or cancelled
+        self.submitted, self.started, self.finished = time.time(), None, None
+        self.n_files, self.files_done, self.current_file = n_files, 0, None
+        self.windows = 0
+        self.result, self.error = None, None
+        self._cancel = threading.Event()
+
+    def progress(self, windows: int = 0, file: str = None, files_done: int = 0):
+        """
+        Reports progress from inside the job, cheap enough to call for every batch of windows.
+
+        Args:
+            windows (int): how many more windows were processed
+            file (str): the file being worked on now
+            files_done (int): how many more files were finished
+
+        Raises:
+            Cancelled: if the job was cancelled
+        """
+        if self._cancel.is_set():
+            raise Cancelled(self.id)
+        self.windows += windows
+        if file is not None:
+            self.current_file = file
+        self.files_done += files_done
+
+    @property
+    def windows_per_second(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.windows / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'starting', 'running')
+
+    def cancel(self):
+        """
+        Stops the job: a queued one never starts, a running one stops at its next progress report.
+        """
+        self._cancel.set()
+
+    def collect(self):
+        """
+        Hands the job's result to the page and lets go of it, so finished jobs don't hold results in memory.
+        """
+        result, self.result = self.result, None
+        self.info['collected'] = True
+        return result
+
+    def _run(self):
+        if self._cancel.is_set():
+            self.status, self.finished = 'cancelled', time.time()
+            return
+        self.status, self.started = 'running', time.time()
+        try:
+            self.result = self.fn(self)
+            self.status = 'done'
+        except Cancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.status, self.error = 'failed', repr(e)
+        finally:
+            self.finished = time.time()
+
+
+class JobQueue:
+    """
+    JobQueue runs page jobs on background threads, so pages stay responsive and a refresh doesn't lose work.
+
+    Threads rather than processes, so jobs share the loaded models, the feature cache and the uploaded
+    files with the pages. Owners take turns: the next job to start is the oldest queued job of the owner
+    who started one least recently, so one analyst queueing fifty files doesn't hold up everyone else.
+
+    Args:
+        workers (int): how many jobs run at once (each one already keeps every core busy)
+        keep_hours (float): finished jobs are forgotten this long after they finish
+    """
+
+    def __init__(self, workers: int = 1, keep_hours: float = 24):
+        self.keep_hours = keep_hours
+        self._jobs = {}
+        self._last_start = {}  # owner -> when one of their jobs last started
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True).start()
+
+    def submit(self, owner: str, kind: str, fn, n_files: int = 0, title: str = '', info: dict = None):
+        """
+        Queues fn(job) to run in the background, see Job for the arguments.
+
+        Returns:
+            (Job): the queued job
+        """
+        job = Job(owner, kind, fn, n_files=n_files, title=title, info=info)
+        with self._cond:
+            self._gc()
+            self._jobs[job.id] = job
+            self._cond.notify()
+        return job
+
+    def get(self, job_id: str):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs(self, owner: str = None, kind: str = None):
+        """
+        The jobs the queue knows about, newest first, optionally only one owner's or one page's.
+        """
+        with self._cond:
+            jobs = [job for job in self._jobs.values()
+                    if (owner is None or job.owner == owner) and (kind is None or job.kind == kind)]
+        return sorted(jobs, key=lambda job: -job.submitted)
+
+    def _next(self):
+        queued = [job for job in self._jobs.values() if job.status == 'queued']
+        if not queued:
+            return None
+        return min(queued, key=lambda job: (self._last_start.get(job.owner, 0), job.submitted))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next()
+                job.status = 'starting'  # so no other worker picks it
+                self._last_start[job.owner] = time.time()
+            job._run()
+
+    def _gc(self):
+        cutoff = time.time() - self.keep_hours * 3600
+        for job_id in [job_id for job_id,job in self._jobs.items() if job.finished is not None and job.finished < cutoff]:
+            del self._jobs[job_id]
+
+
+def owner_id(token: str = None):
+    """
+    The owner a browser session runs jobs as: token, the id the session kept from an earlier visit (ex. in
+    the page's address, so a refresh or reopened tab gets its jobs back), or a new id if it has none yet.
+
+    Args:
+        token (str): the id kept by the session, anything that isn't one (ex. a mangled url) is ignored
+
+    Returns:
+        (str): the owner id
+    """
+    if token and re.fullmatch('[0-9a-f]{32}', token):
+        return token
+    return uuid.uuid4().hex
+
+
+def get_queue(workers: int = 1):
+    """
+    Returns the process wide JobQueue, starting it on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(workers=workers)
+        return _queue
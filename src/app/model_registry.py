@@ -0,0 +1,169 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# TensorFlow (and the model zoo, which imports it) is only imported by the functions that build models, so
+# importing the registry doesn't take the seconds it takes to load
+
+# Process wide, so every upload, streamlit rerun and session shares the same loaded models. Least recently
+# used first; once more than MAX_MODELS are loaded the oldest are dropped. A page or job still holding one
+# keeps using it, its memory is freed when they're done with it
+MAX_MODELS = int(os.environ.get('DOLPHIN_MAX_MODELS', 6))
+_models = OrderedDict()
+_lock = threading.RLock()  # reentrant, building the embedder gets its classifier while holding it
+
+
+def get_detector(weights: str, model_json_path: str = 'weights/detector_model.json', warmup: bool = True):
+    """
+    Returns the detector built from model_json_path with the given weights, loading it only once.
+
+    Args:
+        weights (str): path to the .h5 weights
+        model_json_path (str): path to the json holding the detector architecture
+        warmup (bool): run a dummy batch through a freshly loaded model so the first real batch isn't slow
+
+    Returns:
+        (tf.keras.Model): the detector
+    """
+    def build():
+        import tensorflow as tf
+        with open(model_json_path, 'r') as model_json:
+            model = tf.keras.models.model_from_json(model_json.read())
+        model.load_weights(weights)
+        return model
+
+    architecture = ('json', os.path.abspath(model_json_path), _mtime(model_json_path))
+    return _get(architecture, weights, build, warmup)
+
+
+def get_classifier(model_name: str, weights: str, input_shape: tuple, n_classes: int, learning_rate: float, warmup: bool = True):
+    """
+    Returns the MODELS[model_name] classifier with the given weights, building and compiling it only once.
+
+    Args:
+        model_name (str): key into dolphin.models.MODELS, ex. mobilenetv2
+        weights (str): path to the .h5 weights
+        input_shape (tuple): shape of a single spectrogram image
+        n_classes (int): number of classes the model was trained on
+        learning_rate (float): learning rate the model is compiled with
+        warmup (bool): run a dummy batch through a freshly built model so the first real batch isn't slow
+
+    Returns:
+        (tf.keras.Model): the classifier
+    """
+    def build():
+        from tensorflow.keras import optimizers
+        from dolphin.models import MODELS
+        model = MODELS[model_name](include_top=True, weights=weights, input_shape=input_shape, classes=n_classes)
+        model.compile(optimizer=optimizers.Adam(learning_rate=learning_rate),
+                      loss='categorical_crossentropy', metrics=['acc'])
+        return model
+
+    architecture = (model_name, tuple(input_shape), n_classes)
+    return _get(architecture, weights, build, warmup)
+
+
+def get_embedder(model_name: str, weights: str, input_shape: tuple, n_classes: int, learning_rate: float, warmup: bool = True):
+    """
+    Returns the classifier cut off before its softmax layer, so it outputs a whistle embedding (the
+    penultimate layer, ex. MobileNetV2's pooled 1280 features) instead of class probabilities.
+
+    Args:
+        same as get_classifier
+
+    Returns:
+        (tf.keras.Model): the embedding model, sharing its layers with the cached classifier
+    """
+    def build():
+        import tensorflow as tf
+        classifier = get_classifier(model_name, weights, input_shape, n_classes, learning_rate, warmup=False)
+        return tf.keras.Model(inputs=classifier.input, outputs=classifier.layers[-2].output)
+
+    architecture = ('embedding', model_name, tuple(input_shape), n_classes)
+    return _get(architecture, weights, build, warmup)
+
+
+def get_tflite(weights: str, quantization: str, threads: int = None, warmup: bool = True):
+    """
+    Returns the TFLite export of a detector or classifier (see export_tflite.py), loading it only once.
+
+    Args:
+        weights (str): path to the .h5 weights the model was exported from
+        quantization (str): which export to load, 'float32', 'float16' or 'int8'
+        threads (int): CPU threads the interpreter uses, None lets TFLite decide
+        warmup (bool): run a dummy batch through a freshly loaded model so the first real batch isn't slow
+
+    Returns:
+        (tflite_backend.TFLiteModel): the model, with the same predict_on_batch as a Keras model
+    """
+    import dolphin.app.tflite_backend as tflite_backend
+
+    path = tflite_backend.tflite_path(weights, quantization)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No {quantization} TFLite model at {path}, export one with src/dolphin/app/export_tflite.py")
+    return _get(('tflite', threads), path, lambda: tflite_backend.TFLiteModel(path, threads=threads), warmup)
+
+
+def model_files(weights: str, backend: str = 'keras', model_json_path: str = None):
+    """
+    The files a get_* call with these arguments loads its model from, ex. to key results on their state.
+
+    Args:
+        weights (str): path to the .h5 weights
+        backend (str): 'keras' or the quantization of a TFLite export, see get_tflite
+        model_json_path (str): the architecture json of a Keras model built from one (the detector)
+
+    Returns:
+        (list): paths of the files
+    """
+    if backend != 'keras':
+        import dolphin.app.tflite_backend as tflite_backend
+        return [weights, tflite_backend.tflite_path(weights, backend)]
+    return [weights] + ([model_json_path] if model_json_path else [])
+
+
+def evict(weights: str = None):
+    """
+    Drops cached models so their memory can be freed, ex. after retraining in a long running process. Other
+    sessions or jobs may be using them, so the pages leave this to the MAX_MODELS cap instead.
+
+    Args:
+        weights (str): only drop the models loaded from this weights file, by default drop everything
+    """
+    with _lock:
+        for key in list(_models):
+            # TFLite exports of the weights (ex. detector_weights.int8.tflite) go with them
+            if weights is None or key[1] == os.path.abspath(weights) or \
+                    (key[0][0] == 'tflite' and key[1].startswith(os.path.splitext(os.path.abspath(weights))[0] + '.')):
+                del _models[key]
+
+
+def _get(architecture: tuple, weights: str, build, warmup: bool):
+    """
+    Looks a model up by architecture, weights path and weights mtime, building it on a miss.
+    """
+    path = os.path.abspath(weights)
+    key = (architecture, path, _mtime(weights))
+
+    with _lock:
+        if key not in _models:
+            # The weights file was overwritten since it was loaded, so the old model is stale
+            for stale in [k for k in _models if k[:2] == key[:2]]:
+                del _models[stale]
+
+            model = build()
+            # Models built without a fixed input size (ex. (None, None, 3)) have nothing to warm up with
+            if warmup and None not in tuple(model.input_shape[1:]):
+                model.predict_on_batch(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32))
+            _models[key] = model
+            while len(_models) > max(1, MAX_MODELS):
+                _models.popitem(last=False)
+
+        _models.move_to_end(key)
+        return _models[key]
+
+
+def _mtime(path: str):
+    return os.path.getmtime(path) if os.path.exists(path) else None
@@ -0,0 +1,108 @@
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import dolphin.app.tracing as tracing
+
+
+_DONE = object()
+
+
+def run(source, featurize, predict, batch_size: int = 32, workers: int = 2, max_pending: int = 4):
+    """
+    Runs decoding, feature extraction and inference as overlapping stages, streaming results back in order.
+
+    A decode thread pulls items from source, a pool of feature threads turns each item into windows,
+    and the calling thread batches the windows through predict. The stages are connected by bounded
+    queues, so a slow model holds back decoding instead of letting decoded audio and spectrograms pile
+    up in memory. The heavy work (libsndfile, resampling, FFTs, tensorflow) releases the GIL, so the
+    stages genuinely run at the same time.
+
+    Args:
+        source (iterable): the decode stage, ex. a generator of audio spans or loaded clips
+        featurize (callable): maps one source item to a list of (meta, image) pairs, image None to skip the model
+        predict (callable): maps a (n, height, width, 3) uint8 batch of images to n model outputs
+        batch_size (int): how many windows go through predict at once
+        workers (int): number of feature threads
+        max_pending (int): how many decoded items may wait for, or sit in, the feature stage
+
+    Yields:
+        ((meta, image), output): every window in source order, with its model output (None if it had no image)
+    """
+    decoded = queue.Queue(maxsize=max_pending)
+    featurized = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(q, item):
+        # Block while the next stage is full, but give up if the consumer went away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decode():
+        try:
+            for item in source:
+                if not put(decoded, item):
+                    return
+        except BaseException as e:
+            put(decoded, e)
+        put(decoded, _DONE)
+
+    def dispatch(pool):
+        # Futures are queued in submission order, which is what keeps the results in order
+        while not stop.is_set():
+            try:
+                item = decoded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE or isinstance(item, BaseException):
+                put(featurized, item)
+                return
+            try:
+                future = pool.submit(featurize_traced, item)
+            except RuntimeError:  # the pool shut down because the consumer went away
+                return
+            if not put(featurized, future):
+                return
+
+    # The stages' spans go to the caller's trace collector, which threads don't inherit
+    featurize_traced = tracing.bind(featurize)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        threads = [threading.Thread(target=tracing.bind(decode), daemon=True),
+                   threading.Thread(target=tracing.bind(dispatch), args=(pool,), daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            windows = []
+            while True:
+                item = featurized.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                windows.extend(item.result())
+
+                while len(windows) >= batch_size:
+                    yield from _predict(windows[:batch_size], predict)
+                    windows = windows[batch_size:]
+
+            if windows:
+                yield from _predict(windows, predict)
+        finally:
+            stop.set()
+
+
+def _predict(windows: list, predict):
+    # Windows without an image (ex. rejected by a prefilter) skip the model and come out with None
+    kept = [i for i,(_, img) in enumerate(windows) if img is not None]
+    outputs = [None] * len(windows)
+    if kept:
+        for i,output in zip(kept, predict(np.stack([windows[i][1] for i in kept]))):
+            outputs[i] = output
+    return zip(windows, outputs)
@@ -0,0 +1,77 @@
+import numpy as np
+
+import dolphin.app.tracing as tracing
+
+
+# Frequency band dolphin whistles sit in, in Hz
+WHISTLE_BAND = (5000, 20000)
+
+
+def scores(features: list, band: tuple = WHISTLE_BAND, smooth_sec: float = 0.05):
+    """
+    Scores how tonal each window is in the whistle band, from the spectrograms already computed for it.
+
+    Every frame's loudest bin in the band is compared to the band's median in that frame, so a
+    narrowband whistle stands out while silence and broadband noise (ex. clicks, snapping shrimp, boat
+    noise) don't. That prominence is averaged over smooth_sec, since a whistle stays tonal for many
+    frames in a row while noise only peaks now and then, and a window's score is its most tonal
+    stretch. The spectrograms are the background-removed dB ones from batch_features, so the score is
+    in dB above the background (plain noise lands around 9 dB with the default settings).
+
+    Args:
+        features (list): (feature, f, t) tuples, as returned by batch_features.spectrograms
+        band (tuple): low and high frequency of the whistle band, in Hz
+        smooth_sec (float): how long a stretch the prominence is averaged over, in seconds
+
+    Returns:
+        (np.ndarray): the score of each window, in dB
+    """
+    with tracing.span('prefilter', items=len(features)):
+        return _scores(features, band, smooth_sec)
+
+
+def _scores(features: list, band: tuple, smooth_sec: float):
+    out = np.zeros(len(features), dtype=np.float32)
+    for i,(feature, f, t) in enumerate(features):
+        rows = (f >= band[0]) & (f <= band[1])
+        if rows.sum() < 2:  # the band is above Nyquist or too narrow to compare bins in
+            out[i] = np.inf
+            continue
+        in_band = feature[rows]
+        prominence = in_band.max(axis=0) - np.median(in_band, axis=0)
+
+        k = min(len(prominence), max(1, int(round(smooth_sec / (t[1] - t[0])))) if len(t) > 1 else 1)
+        out[i] = np.convolve(prominence, np.full(k, 1 / k), mode='valid').max()
+    return out
+
+
+def keep(window_scores: np.ndarray, threshold_db: float = None):
+    """
+    Which windows go on to the CNN: all of them without a threshold, otherwise the ones at least
+    threshold_db above the background.
+    """
+    if threshold_db is None:
+        return np.ones(len(window_scores), dtype=bool)
+    return np.asarray(window_scores) >= threshold_db
+
+
+def metrics(window_scores: np.ndarray, predictions: list, threshold_db: float):
+    """
+    How much a threshold would save, and what it would cost, judged against the CNN run on every window.
+
+    Args:
+        window_scores (np.ndarray): scores() of every window
+        predictions (list): the CNN's 0/1 prediction for every window, with the prefilter off
+        threshold_db (float): the threshold to evaluate
+
+    Returns:
+        (dict): fraction of windows skipped, and recall, the fraction of the CNN's detections the prefilter keeps
+    """
+    kept = keep(window_scores, threshold_db)
+    positives = np.asarray(predictions) == 1
+    return {
+        'threshold_db': threshold_db,
+        'windows': int(len(kept)),
+        'skipped_fraction': float(1 - kept.mean()) if len(kept) else 0.0,
+        'recall': float(kept[positives].mean()) if positives.any() else 1.0,
+    }
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+
+class Results:
+    """
+    Results holds what a runner found, column by column: one row per window with its id, the file it came
+    from, its start/end time and the model's raw scores. Scores stay full precision and are only turned
+    into strings by formatted(), when they're shown.
+
+    Args:
+        classes (list): name of each score column
+        scores (np.ndarray): (n, len(classes)) scores, rows of NaN for windows that weren't scored
+            (ex. the prefilter skipped them)
+        files (list): the file each window came from
+        start (np.ndarray): start time of each window in seconds, NaN if it has none (ex. a whole clip)
+        end (np.ndarray): end time of each window in seconds, NaN if it has none
+        selection (np.ndarray): row of the selection table each window was cut for, -1 if none
+        channel (np.ndarray): channel of the recording each window was cut from, from 1 like Raven's (1 for mono)
+        score_format (str): how formatted() shows scores, ex. '.2%' for probabilities, '.3f' for similarities
+    """
+
+    def __init__(self, classes, scores, files, start=None, end=None, selection=None, channel=None, score_format: str = '.2%'):
+        self.classes = np.asarray(classes, dtype=object)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(len(files), len(self.classes))
+        n = len(self.scores)
+        self.window_id = np.arange(n, dtype=np.int64)
+        self.files = np.asarray(files, dtype=object).reshape(n)
+        self.start = np.full(n, np.nan) if start is None else np.asarray(start, dtype=np.float64)
+        self.end = np.full(n, np.nan) if end is None else np.asarray(end, dtype=np.float64)
+        self.selection = np.full(n, -1, dtype=np.int64) if selection is None else np.asarray(selection, dtype=np.int64)
+        self.channel = np.ones(n, dtype=np.int64) if channel is None else np.asarray(channel, dtype=np.int64)
+        self.score_format = score_format
+        self._top = {}
+
+    @classmethod
+    def from_outputs(cls, classes, outputs: list, files, **kwargs):
+        """
+        Stacks the model outputs of every window into the score matrix, None outputs become NaN rows.
+        """
+        scores = np.full((len(outputs), len(classes)), np.nan, dtype=np.float32)
+        scored = [i for i,output in enumerate(outputs) if output is not None]
+        if scored:
+            scores[scored] = np.stack([outputs[i] for i in scored]).reshape(len(scored), len(classes))
+        return cls(classes, scores, files, **kwargs)
+
+    @classmethod
+    def concat(cls, parts: list):
+        """
+        Stacks the results of consecutive parts of a run (ex. the checkpointed parts of a recording) into one,
+        window ids numbered as if they came from a single run. Needs at least one part.
+        """
+        first = parts[0]
+        return cls(first.classes, np.concatenate([part.scores for part in parts]),
+                   np.concatenate([part.files for part in parts]),
+                   start=np.concatenate([part.start for part in parts]), end=np.concatenate([part.end for part in parts]),
+                   selection=np.concatenate([part.selection for part in parts]),
+                   channel=np.concatenate([part.channel for part in parts]), score_format=first.score_format)
+
+    def __len__(self):
+        return len(self.scores)
+
+    @property
+    def skipped(self):
+        return np.isnan(self.scores).all(axis=1)
+
+    def subset(self, rows):
+        """
+        The results of only some windows, given by a boolean mask or indices. Window ids are kept.
+        """
+        sub = Results(self.classes, self.scores[rows], self.files[rows], start=self.start[rows], end=self.end[rows],
+                      selection=self.selection[rows], channel=self.channel[rows], score_format=self.score_format)
+        sub.window_id = self.window_id[rows]
+        return sub
+
+    def top_k(self, k: int = 3):
+        """
+        The k best scoring classes of every window, computed for all windows at once.
+
+        Returns:
+            (tuple): (n, k) class indices and (n, k) scores, best first (skipped windows have NaN scores)
+        """
+        k = min(k, len(self.classes))
+        if k not in self._top:
+            scores = np.where(np.isnan(self.scores), -np.inf, self.scores)
+            top = np.argpartition(scores, -k, axis=1)[:, -k:] if k < len(self.classes) else \
+                np.broadcast_to(np.arange(k), scores.shape).copy()
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            self._top[k] = (top, np.take_along_axis(self.scores, top, axis=1))
+        return self._top[k]
+
+    def labels(self, k: int = 3):
+        """
+        Names of the k best scoring classes of every window, (n, k).
+        """
+        return self.classes[self.top_k(k)[0]]
+
+    def above(self, threshold: float, column: int = -1):
+        """
+        Which windows scored at least threshold in one column (the last one by default, ex. the detector's
+        whistle score). Skipped windows never are.
+        """
+        return np.nan_to_num(self.scores[:, column], nan=-np.inf) >= threshold
+
+    def formatted(self, k: int = 3):
+        """
+        The k best classes and their scores as the pages show them, only call this for what's displayed.
+
+        Returns:
+            (tuple): a list of k class names and a list of k score strings per window ('skipped' for
+                windows that weren't scored)
+        """
+        top, scores = self.top_k(k)
+        names = self.classes[top].tolist()
+        confidences = [['skipped'] * top.shape[1] if np.isnan(row).all() else [format(s, self.score_format) for s in row]
+                       for row in scores]
+        return names, confidences
+
+    def to_frame(self, k: int = 3):
+        """
+        The results as a DataFrame: window id, file, channel, start and end time, selection, a score column
+        per class and the k best classes.
+        """
+        columns = {'window_id': self.window_id, 'file': self.files, 'channel': self.channel, 'start_time': self.start,
+                   'end_time': self.end, 'selection': self.selection}
+        for c,name in enumerate(self.classes):
+            columns['score_' + str(name)] = self.scores[:, c]
+        if k > 0 and len(self.classes) > 1:
+            labels = self.labels(k)
+            for j in range(labels.shape[1]):
+                columns[f'top{j + 1}'] = labels[:, j]
+        return pd.DataFrame(columns)
+
+    def save(self, path: str):
+        """
+        Saves the results losslessly to a .npz (no pickles), for load(). Window ids aren't kept.
+        """
+        np.savez(path, classes=self.classes.astype(str), scores=self.scores, files=self.files.astype(str),
+                 start=self.start, end=self.end, selection=self.selection, channel=self.channel,
+                 score_format=np.array(self.score_format))
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['classes'].tolist(), f['scores'], f['files'].tolist(), start=f['start'], end=f['end'],
+                       selection=f['selection'], channel=f['channel'], score_format=str(f['score_format']))
+
+    def to_csv(self, path: str, k: int = 3):
+        self.to_frame(k).to_csv(path, index=False)
+
+    def to_arrow(self, k: int = 3):
+        """
+        The results as a pyarrow Table (pyarrow is optional, only these exports need it).
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Exporting results to Arrow or Parquet needs pyarrow, pip install pyarrow (or use to_csv)")
+        return pa.Table.from_pandas(self.to_frame(k), preserve_index=False)
+
+    def to_parquet(self, path: str, k: int = 3):
+        table = self.to_arrow(k)
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
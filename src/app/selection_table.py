@@ -0,0 +1,173 @@
+import io
+import csv
+import numpy as np
+import pandas as pd
+
+
+# Columns every Raven selection table has
+RAVEN_COLUMNS = ['Selection', 'View', 'Channel', 'Begin Time (s)', 'End Time (s)', 'Low Freq (Hz)', 'High Freq (Hz)']
+
+
+class SelectionTable:
+    """
+    SelectionTable is a Raven selection table held by column, so tens of thousands of selections are
+    parsed, sliced and written in bulk instead of row by row.
+
+    The table keeps every column of the file (in order, extra ones included), with the begin and end
+    times also as float64 NumPy arrays for vectorized window slicing, and the channel of every
+    selection (from 1, all 1 if the table has no Channel column).
+
+    Args:
+        df (pd.DataFrame): the table
+        name (str): name of the file it came from, ex. recording.csv
+    """
+
+    def __init__(self, df: pd.DataFrame, name: str = None):
+        missing = [c for c in ('Begin Time (s)', 'End Time (s)') if c not in df.columns]
+        if missing:
+            raise ValueError(f"Selection table {name} is missing the {', '.join(missing)} column(s)")
+        self.df = df
+        self.name = name
+        self.begin = df['Begin Time (s)'].to_numpy(dtype=np.float64)
+        self.end = df['End Time (s)'].to_numpy(dtype=np.float64)
+        self.channels = df['Channel'].to_numpy(dtype=np.int64) if 'Channel' in df.columns else np.ones(len(df), dtype=np.int64)
+
+    @classmethod
+    def read(cls, data, name: str = None):
+        """
+        Parses a tab or comma delimited selection table in one go (Raven writes tabs, spreadsheets commas).
+
+        Args:
+            data (str or file-like): path to the table or the streamlit UploadedFile
+            name (str): name of the table, taken from data if not given
+        """
+        name = name or getattr(data, 'name', data)
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                raw = f.read()
+        else:
+            data.seek(0)
+            raw = data.read()
+            data.seek(0)
+        if isinstance(raw, str):
+            raw = raw.encode()
+
+        header = raw.split(b'\n', 1)[0]
+        sep = '\t' if b'\t' in header else ','
+        df = pd.read_csv(io.BytesIO(raw), sep=sep)
+        df.columns = [c.strip() for c in df.columns]
+        return cls(df, name=name)
+
+    def __len__(self):
+        return len(self.begin)
+
+    @property
+    def basename(self):
+        return self.name.rsplit('/', 1)[-1].rsplit('.', 1)[0] if self.name else None
+
+    def window_starts(self, sr: int):
+        """
+        First sample of every selection at sr, as the windows are cut (floor of begin time * sr).
+        """
+        return np.floor(self.begin * sr).astype(np.int64)
+
+    def join(self, rows: np.ndarray, fill='', **columns):
+        """
+        Adds columns holding values for some of the rows, ex. the predictions of every selection that was classified.
+
+        Args:
+            rows (np.ndarray): which row each value goes to
+            fill: value of the rows that weren't given one
+            **columns: column name -> values, one per entry of rows
+
+        Returns:
+            (SelectionTable): a new table with the columns added (or replaced)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        added = {}
+        for column, values in columns.items():
+            full = np.full(len(self), fill, dtype=object)
+            full[rows] = np.asarray(values, dtype=object)
+            added[column] = full
+        return SelectionTable(self.df.assign(**added), name=self.name)
+
+    def write(self, path: str, columns: list = None, sep: str = '\t'):
+        """
+        Writes the table in one pass, tab delimited like Raven's own tables by default.
+
+        Args:
+            path (str): file to write
+            columns (list): which columns to write and in what order, all of them by default
+            sep (str): delimiter
+        """
+        df = self.df if columns is None else self.df.reindex(columns=columns)
+        df.to_csv(path, sep=sep, index=False)
+
+
+def merge_windows(start_times: list, window_sec: float = 3, duration: float = None):
+    """
+    Merges overlapping or back to back windows into single events.
+
+    Args:
+        start_times (list): start times of the windows, in seconds
+        window_sec (float): length of each window, in seconds
+        duration (float): length of the recording, in seconds, events end there at the latest (the last
+            window is usually shorter than window_sec, and Raven flags selections past the end of the audio)
+
+    Returns:
+        (list): [begin, end] time of each event, in seconds
+    """
+    events = []
+    for start in sorted(start_times):
+        if events and start <= events[-1][1]:
+            events[-1][1] = max(events[-1][1], start + window_sec)
+        else:
+            events.append([start, start + window_sec])
+    if duration is not None:
+        for event in events:
+            event[1] = min(event[1], duration)
+    return events
+
+
+def write_detections(savedir: str, user_labels: list, fps: list, start_times: list, sr: int, window_sec: float = 3,
+                     channels: list = None, durations: list = None):
+    """
+    Takes the model predictions, user boolean labels, and filepaths and writes a Raven selection table per file.
+    Windows the user kept that overlap or touch (on the same channel) are merged into a single selection.
+
+    Args:
+        savedir (str): where to save the csvfile
+        user_labels (list): list of lists, holding the boolean values for whether user thinks there's NOT a whistle
+        fps (list): list of lists, holding the filepaths to original wav files
+        start_times (list): list of lists, holding the start times of whistles, relative to original wav file
+        window_sec (float): length of each detection window, in seconds
+        channels (list): list of lists, holding the channel of each window (from 1), all channel 1 if not given
+        durations (list): length of each file in seconds, the selections are clamped to it (None for a file leaves
+            its selections as long as the windows)
+    """
+    columns = RAVEN_COLUMNS + ['Filepath', 'Found']
+
+    for i,f in enumerate(fps):
+        fp = f[0][:-4]
+        file_channels = channels[i] if channels is not None else [1] * len(start_times[i])
+        duration = durations[i] if durations is not None else None
+
+        with open(savedir + fp + '.csv', 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=columns)
+            writer.writeheader()
+
+            # If label==True then the user said this does NOT contain a whistle, so only keep the False ones
+            kept = {}
+            for j,label in enumerate(user_labels[i]):
+                if not label:
+                    kept.setdefault(int(file_channels[j]), []).append(start_times[i][j])
+
+            # Each channel's windows are merged on their own, then all the events are numbered by time
+            events = sorted((start_time, end_time, channel) for channel, times in kept.items()
+                            for start_time, end_time in merge_windows(times, window_sec, duration))
+
+            # Write each merged event and all other info to file
+            for j,(start_time, end_time, channel) in enumerate(events):
+                writer.writerow({'Selection': j + 1, 'View': 'Spectrogram 1', 'Channel': str(channel),
+                                'Begin Time (s)': round(start_time, 3), 'End Time (s)': round(end_time, 3),
+                                'Low Freq (Hz)': 0.0, 'High Freq (Hz)': sr / 2, 'Filepath': fp, 'Found': 'whistle'})
@@ -0,0 +1,227 @@
+import io
+import os
+import cv2
+import json
+import tempfile
+import threading
+import functools
+import numpy as np
+import matplotlib.pyplot as plt
+
+import dolphin.app.tracing as tracing
+import dolphin.io_utils as io_utils
+import dolphin.app.batch_features as batch_features
+import dolphin.preprocess.feature_extraction as feature_extraction
+
+
+# pyplot isn't thread safe, and jobs and page reruns render on different threads. Only save_fig itself holds
+# it, most windows are drawn by draw_direct which needs no lock
+_save_fig_lock = threading.Lock()
+
+# How far draw_direct may land from save_fig, per pixel and channel, for it to be used (a cell right on the
+# boundary between two color map entries can round to the neighbouring one)
+MAX_PIXEL_DIFF = 8
+
+# save_fig's layout per feature shape, axes and output config, see _layout. Measuring one takes a couple of
+# seconds of save_fig calls, so features of more shapes than this (ex. unpadded clips) just use save_fig
+MAX_LAYOUTS = 8
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def compute_images(wavs: list, sr: int, cfg: dict):
+    """
+    Batched compute_image, spectrograms of all the windows are computed with shared vectorized FFTs.
+
+    Args:
+        wavs (list): time series of each window
+        sr (int): sampling rate
+        cfg (dict): the config, uses the preprocess and output sections
+
+    Returns:
+        (list): uint8 BGR image per window
+    """
+    if cfg["preprocess"]["features"] == 'spec':
+        features = batch_features.spectrograms(wavs, sr, cfg)
+        with tracing.span('render', items=len(features)):
+            return [render(feature, f, t, cfg) for feature, f, t in features]
+    with tracing.span('features', items=len(wavs), feature=cfg["preprocess"]["features"]):
+        return [compute_image(wav, sr, cfg) for wav in wavs]
+
+
+def compute_image(wav: np.ndarray, sr: int, cfg: dict):
+    """
+    Computes the configured feature for a window and renders it straight to an image array.
+
+    Args:
+        wav (np.ndarray): time series of the window
+        sr (int): sampling rate
+        cfg (dict): the config, uses the preprocess and output sections
+
+    Returns:
+        (np.ndarray): uint8 BGR image of shape (height, width, 3), see render
+    """
+    feature_type = cfg["preprocess"]["features"]
+    if feature_type == 'spec':
+        feature, f, t = feature_extraction.compute_spectrogram(wav, sr=sr, cfg=cfg, random_pad=False)
+    else:
+        if feature_type == 'melspec':
+            feature = feature_extraction.compute_melspec(wav, sr=sr, cfg=cfg)
+        elif feature_type == 'pcen':
+            melspec = feature_extraction.compute_melspec(wav, sr=sr, cfg=cfg)
+            feature = feature_extraction.compute_pcen(melspec, sr=sr, cfg=cfg)
+        f = np.linspace(0, sr / 2, feature.shape[0])
+        t = np.linspace(0, wav.shape[-1] / sr, feature.shape[1])
+
+    return render(feature, f, t, cfg)
+
+
+def render(feature: np.ndarray, f: np.ndarray, t: np.ndarray, cfg: dict):
+    """
+    Draws a feature into the image array the models take, matching cv2.imread of the PNG io_utils.save_fig
+    writes (the models were trained on those).
+
+    By default this is draw_direct, which colors the feature straight into an array laid out like
+    save_fig's. When save_fig's layout can't be reproduced within MAX_PIXEL_DIFF (see draw_direct), or
+    with "renderer": "save_fig" in the output section of the config, it's draw_save_fig instead.
+
+    Args:
+        feature (np.ndarray): the feature matrix, shape (n_freqs, n_frames)
+        f (np.ndarray): frequencies of the rows, in Hz
+        t (np.ndarray): times of the columns, in seconds
+        cfg (dict): the config, uses the output section
+
+    Returns:
+        (np.ndarray): uint8 BGR image of shape (height, width, 3)
+    """
+    if cfg["output"].get("renderer", "direct") != "save_fig":
+        image = draw_direct(feature, f, t, cfg)
+        if image is not None:
+            return image
+    return draw_save_fig(feature, f, t, cfg)
+
+
+def draw_save_fig(feature: np.ndarray, f: np.ndarray, t: np.ndarray, cfg: dict):
+    """
+    io_utils.save_fig into a PNG in memory, decoded like cv2.imread decodes the file.
+    """
+    buf = io.BytesIO()
+    with _save_fig_lock:
+        try:
+            io_utils.save_fig(feature, f, t, output_dir=buf, cfg=cfg)
+            png = buf.getvalue()
+        except (TypeError, AttributeError, ValueError):
+            # save_fig wants a path (ex. it looks at the extension), so go through a temporary file instead
+            fd, path = tempfile.mkstemp(suffix='.png')
+            os.close(fd)
+            try:
+                io_utils.save_fig(feature, f, t, output_dir=path, cfg=cfg)
+                with open(path, 'rb') as fp:
+                    png = fp.read()
+            finally:
+                os.remove(path)
+    return cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def draw_direct(feature: np.ndarray, f: np.ndarray, t: np.ndarray, cfg: dict):
+    """
+    save_fig without matplotlib: the feature is min/max normalized like pcolormesh autoscales it, colored
+    through a 256 entry lookup table of the color map and placed where save_fig puts each cell (see
+    _layout), over save_fig's own background.
+
+    Returns:
+        (np.ndarray): uint8 BGR image like draw_save_fig's, None if save_fig's layout for this shape and
+            config couldn't be reproduced within MAX_PIXEL_DIFF
+    """
+    layout = _layout(feature.shape, f, t, cfg)
+    return None if layout is None else _draw(feature, layout, cfg["output"]["color_map"])
+
+
+def _draw(feature: np.ndarray, layout: tuple, color_map: str):
+    background, mask, rows, cols = layout
+
+    # Normalize to [0, 1] like matplotlib's autoscaled Normalize, then index into the color map
+    vmin, vmax = feature.min(), feature.max()
+    scale = (feature - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(feature)
+    idx = np.clip((scale * 256).astype(np.int32), 0, 255)
+
+    image = background.copy()
+    image[mask] = _lut(color_map)[idx[rows, cols]]
+    return image
+
+
+def _layout(shape: tuple, f: np.ndarray, t: np.ndarray, cfg: dict):
+    """
+    Where save_fig draws each cell of a feature of this shape, measured once per shape, axes and config
+    by rendering probe features through save_fig itself.
+
+    Every probe has two values, so each cell comes out as the first or last color of the color map: one
+    probe per bit of the column index and one per bit of the row index tell every pixel which cell it
+    shows, and a probe drawn twice with its values swapped tells cells from background (pixels that
+    don't change, ex. margins or axes). The layout is then checked on a random feature; if draw_direct
+    lands more than MAX_PIXEL_DIFF from save_fig anywhere (ex. save_fig smooths between cells or uses
+    another color map) there is no layout and save_fig is used.
+
+    Returns:
+        (tuple): (background image, mask of the cell pixels, row and column of the cell each one shows),
+            None if draw_direct can't reproduce save_fig
+    """
+    key = (tuple(shape), np.asarray(f).tobytes(), np.asarray(t).tobytes(),
+           json.dumps(cfg["output"], sort_keys=True, default=str))
+    with _layouts_lock:
+        if key not in _layouts:
+            if len(_layouts) >= MAX_LAYOUTS:
+                return None
+            with tracing.span('render.layout'):
+                _layouts[key] = _measure_layout(shape, f, t, cfg)
+        return _layouts[key]
+
+
+def _measure_layout(shape: tuple, f: np.ndarray, t: np.ndarray, cfg: dict):
+    n_freqs, n_frames = shape
+    lut = _lut(cfg["output"]["color_map"]).astype(np.int16)
+
+    def probe(bits):
+        return draw_save_fig(np.broadcast_to(bits, shape).astype(np.float32), f, t, cfg)
+
+    def decode(image):
+        # Which of the two colors each pixel is closest to
+        image = image.astype(np.int16)
+        return (np.abs(image - lut[255]).sum(axis=-1) < np.abs(image - lut[0]).sum(axis=-1)).astype(np.int64)
+
+    cols, rows = np.arange(n_frames), np.arange(n_freqs)[:, None]
+    first, swapped = probe(cols & 1), probe(1 - (cols & 1))
+    if first is None or swapped is None or first.shape != swapped.shape:
+        return None
+    mask = np.any(first != swapped, axis=-1)
+    if not mask.any():
+        return None
+
+    col_of, row_of = np.zeros(mask.shape, dtype=np.int64), np.zeros(mask.shape, dtype=np.int64)
+    col_of |= decode(first)
+    for bit in range(1, max(1, (n_frames - 1).bit_length())):
+        col_of |= decode(probe((cols >> bit) & 1)) << bit
+    for bit in range(max(1, (n_freqs - 1).bit_length())):
+        row_of |= decode(probe((rows >> bit) & 1)) << bit
+    if col_of[mask].max() >= n_frames or row_of[mask].max() >= n_freqs:
+        return None
+
+    background = np.where(mask[..., None], 0, first).astype(np.uint8)
+    layout = (background, mask, row_of[mask].astype(np.int32), col_of[mask].astype(np.int32))
+
+    # Check the layout where it matters, on a feature with every value different
+    check = np.random.default_rng(0).standard_normal(shape).astype(np.float32)
+    expected = draw_save_fig(check, f, t, cfg)
+    image = _draw(check, layout, cfg["output"]["color_map"])
+    if image.shape != expected.shape or int(np.abs(image.astype(np.int16) - expected).max()) > MAX_PIXEL_DIFF:
+        return None
+    return layout
+
+
+@functools.lru_cache(maxsize=None)
+def _lut(color_map: str):
+    """
+    256 entry BGR lookup table for a matplotlib color map.
+    """
+    rgb = np.round(plt.get_cmap(color_map, 256)(np.arange(256))[:, :3] * 255).astype(np.uint8)
+    return np.ascontiguousarray(rgb[:, ::-1])
@@ -0,0 +1,19 @@
+import os
+import sys
+import json
+import pytest
+
+# The tests import dolphin.app like the app and scripts do, from the src directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
+
+
+@pytest.fixture(scope='session')
+def cfg():
+    """
+    The config the app runs with (config.json in the directory pytest runs from, or $DOLPHIN_CONFIG).
+    """
+    fp = os.environ.get('DOLPHIN_CONFIG', 'config.json')
+    if not os.path.exists(fp):
+        pytest.skip(f"no config at {fp}, run from the dolphin_whistles directory")
+    with open(fp, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,151 @@
+"""
+Block-wise, resumed, segment and memory-mapped reads of audio_stream against loading the whole file with
+librosa.load, on short generated wavs.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import io
+import numpy as np
+import pytest
+import librosa
+import soundfile as sf
+
+import dolphin.app.tracing as tracing
+import dolphin.app.audio_stream as audio_stream
+from dolphin.app.batch_detect import open_named
+
+
+SR = 60000
+# Resampling a block with its margins lands within float32 rounding of resampling the whole file
+ATOL = 1e-5
+
+
+def write_wav(tmp_path, orig_sr: int, seconds: float = 2.3, channels: int = 1, subtype: str = 'PCM_16', seed: int = 0):
+    """
+    A sweep plus noise, so every block has something the resampling filter can get wrong.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * orig_sr)) / orig_sr
+    y = 0.3 * np.sin(2 * np.pi * (3000 * t + 2000 * t ** 2))[:, None] + 0.05 * rng.standard_normal((len(t), channels))
+    fp = str(tmp_path / f'rec_{orig_sr}_{channels}_{subtype}.wav')
+    sf.write(fp, y, orig_sr, subtype=subtype)
+    return fp
+
+
+def reference(fp: str, mono: bool = True):
+    y, _ = librosa.load(fp, sr=SR, mono=mono)
+    return y if mono else np.atleast_2d(y)
+
+
+@pytest.mark.parametrize('orig_sr', [SR, 44100, 48000, 96000, 192000])
+@pytest.mark.parametrize('start', [0, 12345])
+def test_iter_samples_matches_load(tmp_path, orig_sr, start):
+    fp = write_wav(tmp_path, orig_sr)
+    expected = reference(fp)
+
+    # Half second blocks, so the file ends in a partial one
+    blocks = list(audio_stream.iter_samples(fp, SR, block_sec=0.5, start=start))
+    assert len(blocks) > 2
+    y = np.concatenate(blocks)
+    assert y.dtype == np.float32
+    assert y.shape == expected[start:].shape
+    np.testing.assert_allclose(y, expected[start:], atol=ATOL)
+
+
+@pytest.mark.parametrize('orig_sr', [44100, 96000, 192000])
+def test_polyphase_blocks_match_whole_file(tmp_path, orig_sr):
+    # librosa has no polyphase resampler to compare against, so the whole file through the same one
+    fp = write_wav(tmp_path, orig_sr)
+    expected, _ = audio_stream.load(fp, SR, res_type='polyphase')
+
+    y = np.concatenate(list(audio_stream.iter_samples(fp, SR, block_sec=0.5, res_type='polyphase')))
+    assert y.shape == expected.shape
+    np.testing.assert_allclose(y, expected, atol=ATOL)
+
+
+@pytest.mark.parametrize('orig_sr', [SR, 44100, 96000])
+def test_iter_samples_multichannel_matches_load(tmp_path, orig_sr):
+    fp = write_wav(tmp_path, orig_sr, channels=2)
+    expected = reference(fp, mono=False)
+
+    y = np.concatenate(list(audio_stream.iter_samples(fp, SR, block_sec=0.5, mono=False)), axis=-1)
+    assert y.shape == expected.shape
+    np.testing.assert_allclose(y, expected, atol=ATOL)
+
+
+@pytest.mark.parametrize('orig_sr', [SR, 44100, 96000, 192000])
+def test_read_segments_matches_load(tmp_path, orig_sr):
+    fp = write_wav(tmp_path, orig_sr)
+    expected = reference(fp)
+
+    # Overlapping, far apart, unsorted, running off either end, and one past the end of the file
+    length = SR // 2
+    starts = [SR, 5, SR + 100, -200, len(expected) - 1000, 2 * SR - 7, len(expected) + 50]
+    segments = audio_stream.read_segments(fp, SR, starts, length, merge_gap_sec=0.1)
+    for start, segment in zip(starts, segments):
+        want = expected[max(0, start) : max(0, min(start + length, len(expected)))]
+        assert segment.shape == want.shape
+        np.testing.assert_allclose(segment, want, atol=ATOL)
+
+
+@pytest.mark.parametrize('channels', [1, 2, 4])
+def test_map_pcm16_matches_load(tmp_path, channels):
+    fp = write_wav(tmp_path, SR, channels=channels)
+    pcm = audio_stream.map_pcm16(fp, SR)
+    assert pcm is not None and pcm.shape == (sf.info(fp).frames, channels)
+
+    # Nothing is resampled, so the mapped samples are exactly what decoding gives
+    for mono in (True, False):
+        expected = reference(fp, mono=mono)
+        assert np.array_equal(audio_stream.pcm_to_float(pcm, mono=mono), expected)
+        assert np.array_equal(audio_stream.load(fp, SR, mono=mono)[0], expected)
+
+
+def test_map_pcm16_only_maps_pcm16_at_sr(tmp_path):
+    assert audio_stream.map_pcm16(write_wav(tmp_path, 44100), SR) is None
+    assert audio_stream.map_pcm16(write_wav(tmp_path, SR, subtype='PCM_24'), SR) is None
+    assert audio_stream.map_pcm16(write_wav(tmp_path, SR, subtype='FLOAT'), SR) is None
+
+
+@pytest.mark.parametrize('mono', [True, False])
+def test_mapped_spans_and_segments_match_decoded(tmp_path, mono):
+    fp = write_wav(tmp_path, SR, channels=2)
+    span_len, span_step = SR, SR // 2
+
+    for start in (0, 777):
+        mapped = list(audio_stream.iter_spans(fp, SR, span_len, span_step, mono=mono, start=start))
+        decoded = list(audio_stream.iter_spans(fp, SR, span_len, span_step, mono=mono, start=start, mmap=False))
+        assert [s for s, _ in mapped] == [s for s, _ in decoded]
+        for (_, a), (_, b) in zip(mapped, decoded):
+            assert np.array_equal(a, b)
+
+    starts = [10, -50, SR, 3 * SR]
+    for a, b in zip(audio_stream.read_segments(fp, SR, starts, SR // 3, mono=mono),
+                    audio_stream.read_segments(fp, SR, starts, SR // 3, mono=mono, mmap=False)):
+        assert np.array_equal(a, b)
+
+
+def test_map_pcm16_views_uploads_in_place(tmp_path):
+    fp = write_wav(tmp_path, SR)
+    with open(fp, 'rb') as f:
+        upload = io.BytesIO(f.read())
+    pcm = audio_stream.map_pcm16(upload, SR)
+    assert pcm is not None and not pcm.flags.owndata
+    assert np.array_equal(audio_stream.pcm_to_float(pcm), reference(fp))
+
+
+@pytest.mark.parametrize('mono', [True, False])
+def test_batch_recordings_are_mapped(tmp_path, mono):
+    fp = write_wav(tmp_path, SR, channels=2)
+    with open_named(fp) as data:
+        pcm = audio_stream.map_pcm16(data, SR)
+        assert isinstance(pcm, np.memmap) and data.tell() == 0
+
+    # Every window batch detection reads comes out of the map, and matches reading the path
+    with tracing.collect(tracing.Collector()) as trace, open_named(fp) as data:
+        spans = list(audio_stream.iter_spans(data, SR, SR, SR // 2, mono=mono))
+    decodes = [e for e in trace.events() if e['name'] == 'decode']
+    assert decodes and all(e['args'].get('source') == 'mmap' for e in decodes)
+    for (s, a), (t, b) in zip(spans, audio_stream.iter_spans(fp, SR, SR, SR // 2, mono=mono, mmap=False)):
+        assert s == t and np.array_equal(a, b)
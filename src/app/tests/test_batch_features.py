@@ -0,0 +1,95 @@
+"""
+Parity of the batched spectrogram stage with compute_spectrogram run on each window on its own.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import numpy as np
+import pytest
+
+feature_extraction = pytest.importorskip('dolphin.preprocess.feature_extraction')
+import dolphin.app.batch_features as batch_features
+
+
+def tonal(sr: int, seconds: float, seed: int = 0):
+    """
+    Whistle-like sweeps and a steady tone over noise, so contrast and dynamic range both have work to do.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    y = 0.2 * np.sin(2 * np.pi * (6000 * t + 800 * t ** 2)) + 0.1 * np.sin(2 * np.pi * 12000 * t)
+    return (y + 0.02 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def reference(wavs, sr, cfg):
+    return [feature_extraction.compute_spectrogram(wav, sr=sr, cfg=cfg, random_pad=False) for wav in wavs]
+
+
+def assert_matches(features, expected):
+    assert len(features) == len(expected)
+    for (feature, f, t), (ref, ref_f, ref_t) in zip(features, expected):
+        ref = np.asarray(ref)
+        assert feature.shape == ref.shape
+        np.testing.assert_allclose(f, ref_f)
+        np.testing.assert_allclose(t, ref_t)
+        assert float(np.abs(feature - ref).max()) <= batch_features.ATOL_DB
+
+
+def test_spectrograms_match_per_window(cfg):
+    sr = cfg['preprocess']['sampling_rate']
+    window = int(cfg['preprocess']['spectrogram_max_length'] * sr)
+    y = tonal(sr, 4 * window / sr + 1.3)
+
+    # The last window is short and gets zero padded, like chunk() leaves it
+    wavs = [y[i : i + window] for i in range(0, len(y), window)]
+    assert len(wavs[-1]) < window
+    assert_matches(batch_features.spectrograms(wavs, sr, cfg, batch_size=3), reference(wavs, sr, cfg))
+
+
+def test_sliding_spectrograms_match_per_window(cfg):
+    sr = cfg['preprocess']['sampling_rate']
+    window = int(cfg['preprocess']['spectrogram_max_length'] * sr)
+    hop = batch_features.frame_aligned_hop(window // 2, sr, cfg)
+    n_windows = 6
+    y = tonal(sr, ((n_windows - 1) * hop + window // 3) / sr, seed=1)  # the last windows run past the end
+
+    wavs = [y[i * hop : i * hop + window] for i in range(n_windows)]
+    assert_matches(batch_features.sliding_spectrograms(y, sr, cfg, hop, n_windows), reference(wavs, sr, cfg))
+
+
+def test_multichannel_sliding_spectrograms_match_per_channel(cfg):
+    sr = cfg['preprocess']['sampling_rate']
+    window = int(cfg['preprocess']['spectrogram_max_length'] * sr)
+    hop = batch_features.frame_aligned_hop(window, sr, cfg)
+    y = np.stack([tonal(sr, 3 * window / sr, seed=c) for c in range(2)])
+
+    wavs = [y[c, i * hop : i * hop + window] for i in range(3) for c in range(2)]
+    assert_matches(batch_features.sliding_spectrograms(y, sr, cfg, hop, 3), reference(wavs, sr, cfg))
+
+
+def test_batched_path_is_used(cfg):
+    # Otherwise the tests above only compare compute_spectrogram with itself
+    assert batch_features._probe(cfg, cfg['preprocess']['sampling_rate'])[1]
+
+
+def test_falls_back_to_compute_spectrogram_on_mismatch(cfg, monkeypatch):
+    sr = cfg['preprocess']['sampling_rate']
+    window = int(cfg['preprocess']['spectrogram_max_length'] * sr)
+    compute_spectrogram = feature_extraction.compute_spectrogram
+
+    def brighter(wav, **kwargs):
+        # Post-processing the batched path doesn't know about
+        feature, f, t = compute_spectrogram(wav, **kwargs)
+        return np.asarray(feature) + 1.0, f, t
+
+    monkeypatch.setattr(feature_extraction, 'compute_spectrogram', brighter)
+    monkeypatch.setattr(batch_features, '_probes', {})
+    with pytest.warns(UserWarning, match='a window at a time'):
+        assert not batch_features._probe(cfg, sr)[1]
+
+    hop = batch_features.frame_aligned_hop(window // 2, sr, cfg)
+    y = np.stack([tonal(sr, 2 * window / sr, seed=c) for c in range(2)])
+    wavs = [y[0, i : i + window] for i in range(0, y.shape[-1], window)]
+    assert_matches(batch_features.spectrograms(wavs, sr, cfg), reference(wavs, sr, cfg))
+    sliding = [y[c, i * hop : i * hop + window] for i in range(3) for c in range(2)]
+    assert_matches(batch_features.sliding_spectrograms(y, sr, cfg, hop, 3), reference(sliding, sr, cfg))
@@ -0,0 +1,48 @@
+"""
+Checkpoint keys follow the files the results came from: retrained weights or a rebuilt index written over
+the old ones don't resume the old results.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import os
+import numpy as np
+
+from dolphin.app.checkpoint import Checkpoint
+from dolphin.app.results import Results
+
+
+def write(fp, content: bytes, mtime_ns: int):
+    with open(fp, 'wb') as f:
+        f.write(content)
+    os.utime(fp, ns=(mtime_ns, mtime_ns))
+
+
+def test_rewritten_weights_miss_the_checkpoint(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoints'))
+    audio, weights = str(tmp_path / 'rec.wav'), str(tmp_path / 'detector_weights.h5')
+    write(audio, b'RIFF' + bytes(100), 1_600_000_000 * 10 ** 9)
+    write(weights, b'old weights', 1_600_000_000 * 10 ** 9)
+    cfg = {'preprocess': {'sampling_rate': 60000}}
+
+    key = checkpoint.key(audio, cfg, weights=checkpoint.file_state(weights), threshold=0.5)
+    checkpoint.commit(key, Results(['whistle'], np.array([[0.9]]), ['rec.wav']), stop=1, done=True)
+    assert checkpoint.key(audio, cfg, weights=checkpoint.file_state(weights), threshold=0.5) == key
+    assert checkpoint.finished(key)
+
+    # Retrained in place: same path, same size, only a later mtime
+    write(weights, b'new weights', 1_600_000_100 * 10 ** 9)
+    retrained = checkpoint.key(audio, cfg, weights=checkpoint.file_state(weights), threshold=0.5)
+    assert retrained != key
+    assert not checkpoint.parts(retrained) and not checkpoint.finished(retrained)
+
+    # Rebuilt with a different size at the same mtime
+    write(weights, b'newer weights', 1_600_000_100 * 10 ** 9)
+    assert checkpoint.key(audio, cfg, weights=checkpoint.file_state(weights), threshold=0.5) not in (key, retrained)
+
+
+def test_file_state_of_missing_files(tmp_path):
+    fp = str(tmp_path / 'index.json')
+    assert Checkpoint.file_state(fp) == [None]
+    write(fp, b'{}', 10 ** 9)
+    assert Checkpoint.file_state(fp, fp + '.missing') == [(os.path.abspath(fp), 2, 10 ** 9), None]
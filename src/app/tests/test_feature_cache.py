@@ -0,0 +1,54 @@
+"""
+FeatureCache stays within its budget without walking the whole cache directory on every put, and puts
+of the same entry from several threads don't trip over each other.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import os
+import threading
+import numpy as np
+
+import dolphin.app.feature_cache as feature_cache
+
+
+def cached_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, entry, fn))
+               for entry in os.listdir(directory) for fn in os.listdir(os.path.join(directory, entry)))
+
+
+def test_puts_stay_in_budget_without_rescanning(tmp_path, monkeypatch):
+    monkeypatch.setattr(feature_cache, '_sizes', {})
+    scans = []
+    evict = feature_cache.FeatureCache.evict
+    monkeypatch.setattr(feature_cache.FeatureCache, 'evict', lambda self: scans.append(1) or evict(self))
+
+    images = np.zeros((1, 100, 100, 3), dtype=np.uint8)  # about 30 kB an entry
+    budget = 3_000_000
+    for i in range(1000):
+        # A new FeatureCache every time, like a page rerun
+        feature_cache.FeatureCache(str(tmp_path), max_bytes=budget).put(f'entry{i}', images, {'i': i})
+        assert cached_bytes(tmp_path) <= budget
+
+    assert len(scans) < 1000 / 5
+    assert feature_cache.FeatureCache(str(tmp_path), max_bytes=budget).get('entry999')[1] == {'i': 999}
+
+
+def test_concurrent_puts_of_one_entry(tmp_path):
+    cache = feature_cache.FeatureCache(str(tmp_path), max_bytes=10 ** 9)
+    images = np.arange(2 * 8 * 8 * 3, dtype=np.uint8).reshape(2, 8, 8, 3)
+    errors = []
+
+    def put():
+        try:
+            cache.put('same', images, {'n': 2})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put) for _ in range(16)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    assert not errors
+    assert np.array_equal(cache.get('same')[0], images)
+    assert os.listdir(tmp_path) == ['same']
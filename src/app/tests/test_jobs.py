@@ -0,0 +1,50 @@
+"""
+Jobs outlive the browser session that started them: another session with the same owner id (ex. the tab
+after a refresh) lists, loads and cancels them.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import time
+import threading
+
+import dolphin.app.jobs as jobs
+
+
+def wait_for(job, statuses, timeout: float = 10):
+    deadline = time.time() + timeout
+    while job.status not in statuses:
+        assert time.time() < deadline, f"job stuck in {job.status}"
+        time.sleep(0.01)
+
+
+def test_owner_id_kept_across_sessions():
+    owner = jobs.owner_id(None)
+    assert jobs.owner_id(owner) == owner
+    for mangled in ('', 'analyst', owner[:-1], owner.upper(), owner + '0'):
+        assert jobs.owner_id(mangled) != owner
+
+
+def test_second_session_lists_loads_and_cancels():
+    queue = jobs.JobQueue(workers=1)
+    first = jobs.owner_id(None)  # the session that submits, then is refreshed away
+
+    done = queue.submit(first, 'detect', lambda job: 'detections', n_files=1, title='done')
+    wait_for(done, ('done',))
+
+    started = threading.Event()
+    def forever(job):
+        started.set()
+        while True:
+            job.progress(windows=1)
+            time.sleep(0.01)
+    running = queue.submit(first, 'detect', forever, n_files=1, title='running')
+    assert started.wait(10)
+
+    second = jobs.owner_id(first)  # the refreshed tab, same id from the address
+    assert {job.id for job in queue.jobs(owner=second, kind='detect')} == {done.id, running.id}
+    assert queue.jobs(owner=jobs.owner_id(None), kind='detect') == []
+
+    assert queue.get(done.id).collect() == 'detections'
+    queue.get(running.id).cancel()
+    wait_for(running, ('cancelled',))
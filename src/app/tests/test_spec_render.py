@@ -0,0 +1,75 @@
+"""
+Parity of the in-memory renderers with what the models were trained on: io_utils.save_fig written to a
+PNG and read back with cv2.imread.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+io_utils = pytest.importorskip('dolphin.io_utils')
+feature_extraction = pytest.importorskip('dolphin.preprocess.feature_extraction')
+import dolphin.app.spec_render as spec_render
+
+
+def whistle(sr: int, seconds: float = 3, seed: int = 0):
+    """
+    A rising sweep in noise, so the spectrogram has both structure and a background.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    sweep = 0.3 * np.sin(2 * np.pi * (5000 * t + 1500 * t ** 2))
+    return (sweep + 0.05 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def saved_png(feature, f, t, cfg, tmp_path):
+    fp = str(tmp_path / 'window.png')
+    io_utils.save_fig(feature, f, t, output_dir=fp, cfg=cfg)
+    return cv2.imread(fp)
+
+
+@pytest.fixture
+def spectrogram(cfg):
+    sr = cfg['preprocess']['sampling_rate']
+    return feature_extraction.compute_spectrogram(whistle(sr), sr=sr, cfg=cfg, random_pad=False)
+
+
+def test_save_fig_renderer_matches_png(cfg, spectrogram, tmp_path):
+    expected = saved_png(*spectrogram, cfg, tmp_path)
+    image = spec_render.draw_save_fig(*spectrogram, cfg)
+    assert image.shape == expected.shape
+    assert np.array_equal(image, expected)
+
+
+def test_direct_renderer_matches_png(cfg, spectrogram, tmp_path):
+    expected = saved_png(*spectrogram, cfg, tmp_path)
+    image = spec_render.draw_direct(*spectrogram, cfg)
+    assert image is not None, "save_fig's layout couldn't be reproduced, every window would go through save_fig"
+    assert image.shape == expected.shape
+    assert int(np.abs(image.astype(np.int16) - expected).max()) <= spec_render.MAX_PIXEL_DIFF
+
+
+def test_render_matches_png(cfg, spectrogram, tmp_path):
+    expected = saved_png(*spectrogram, cfg, tmp_path)
+    image = spec_render.render(*spectrogram, cfg)
+    assert image.shape == expected.shape
+    assert int(np.abs(image.astype(np.int16) - expected).max()) <= spec_render.MAX_PIXEL_DIFF
+
+
+def test_direct_renderer_falls_back_when_save_fig_smooths(cfg, spectrogram, monkeypatch):
+    import matplotlib.pyplot as plt
+
+    def smoothed(feature, f, t, output_dir, cfg):
+        fig = plt.figure(figsize=(6, 3))
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.axis('off')
+        ax.imshow(feature, cmap=cfg['output']['color_map'], aspect='auto', interpolation='bilinear', origin='lower')
+        fig.savefig(output_dir, format='png')
+        plt.close(fig)
+
+    monkeypatch.setattr(io_utils, 'save_fig', smoothed)
+    monkeypatch.setattr(spec_render, '_layouts', {})
+    assert spec_render.draw_direct(*spectrogram, cfg) is None
+    assert np.array_equal(spec_render.render(*spectrogram, cfg), spec_render.draw_save_fig(*spectrogram, cfg))
@@ -0,0 +1,42 @@
+"""
+A memory-mapped WindowStore grows without resizing files it has mapped (which Windows refuses), and
+keeps every window, and the views handed out of it, intact while it does.
+
+Run from the dolphin_whistles directory:
+    python -m pytest src/dolphin/app/tests
+"""
+import os
+import numpy as np
+import pytest
+
+from dolphin.app.window_store import WindowStore
+
+
+def window(i: int):
+    return np.full((4, 5, 3), i % 256, dtype=np.uint8)
+
+
+@pytest.mark.parametrize('memory_mapped', [False, True])
+def test_grows_without_resizing_mapped_files(tmp_path, memory_mapped):
+    directory = tmp_path / 'windows'
+    store = WindowStore(str(directory / 'rec.u8') if memory_mapped else None, capacity=3)
+
+    sizes, views = {}, []
+    for i in range(40):
+        store.append(window(i))
+        views.append(store[i])
+        if memory_mapped:
+            for fn in os.listdir(directory):
+                # A file keeps the size it was mapped with
+                assert sizes.setdefault(fn, os.path.getsize(directory / fn)) == os.path.getsize(directory / fn)
+
+    expected = np.stack([window(i) for i in range(40)])
+    assert np.array_equal(store[5:31], expected[5:31])
+    assert np.array_equal(np.stack(list(store)), expected)
+    assert np.array_equal(store.array, expected)
+    assert all(np.array_equal(view, window(i)) for i, view in enumerate(views))
+
+    # Appending after array was taken still works, and leaves what array showed alone
+    shown = store.array
+    store.append(window(40))
+    assert np.array_equal(store[40], window(40)) and np.array_equal(shown, expected)
@@ -0,0 +1,116 @@
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+
+import dolphin.app.window_store as window_store
+
+
+# Inference backends the runners can pick from, 'keras' being the original .h5 model
+BACKENDS = ('keras', 'float32', 'float16', 'int8')
+
+
+def tflite_path(weights: str, quantization: str):
+    """
+    Where the TFLite export of a weights file lives, ex. weights/detector_weights.int8.tflite.
+    """
+    return os.path.splitext(weights)[0] + '.' + quantization + '.tflite'
+
+
+def export(model: tf.keras.Model, path: str, quantization: str = 'float16', calibration=None):
+    """
+    Converts a Keras model to TFLite.
+
+    float16 halves the model size and runs on the float kernels. int8 quantizes weights and activations,
+    which needs calibration windows to measure the activations' ranges on; they should be real
+    spectrogram windows from the recordings the model will see, not random noise. The model's input
+    and output stay float32 either way, so the runners use every backend the same way.
+
+    Args:
+        model (tf.keras.Model): the loaded detector or classifier
+        path (str): .tflite file to write
+        quantization (str): 'float32', 'float16' or 'int8'
+        calibration (iterable): uint8 windows of the model's input shape, required for int8
+
+    Returns:
+        (int): size of the written model, in bytes
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration windows")
+        windows = list(calibration)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([window_store.normalize(img[np.newaxis])] for img in windows)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != 'float32':
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {BACKENDS[1:]}")
+
+    flatbuffer = converter.convert()
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+class TFLiteModel:
+    """
+    TFLiteModel runs a .tflite export behind the same predict_on_batch / input_shape interface as a
+    Keras model, so model_registry and the runners treat both alike.
+
+    Args:
+        path (str): the .tflite file
+        threads (int): CPU threads the interpreter uses, None lets TFLite decide
+    """
+
+    def __init__(self, path: str, threads: int = None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(int(d) for d in self._input['shape'][1:])
+        self._batch_size = int(self._input['shape'][0])
+
+        # An interpreter holds its tensors, so two threads can't run batches through it at once
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, batch: np.ndarray):
+        """
+        Args:
+            batch (np.ndarray): float32 windows scaled to [0, 1], shape (n, height, width, 3)
+
+        Returns:
+            (np.ndarray): float32 model outputs, shape (n, n_outputs)
+        """
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], (len(batch),) + self.input_shape[1:])
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+
+            self.interpreter.set_tensor(self._input['index'], _quantize(batch, self._input))
+            self.interpreter.invoke()
+            return _dequantize(self.interpreter.get_tensor(self._output['index']), self._output)
+
+
+def _quantize(x: np.ndarray, details: dict):
+    """
+    Casts a float batch to the input tensor's type, applying its quantization if it's an integer tensor.
+    """
+    if np.issubdtype(details['dtype'], np.integer):
+        scale, zero_point = details['quantization']
+        info = np.iinfo(details['dtype'])
+        return np.clip(np.round(x / scale + zero_point), info.min, info.max).astype(details['dtype'])
+    return np.asarray(x, dtype=details['dtype'])
+
+
+def _dequantize(y: np.ndarray, details: dict):
+    if np.issubdtype(details['dtype'], np.integer):
+        scale, zero_point = details['quantization']
+        return ((y.astype(np.float32) - zero_point) * scale).astype(np.float32)
+    return y.astype(np.float32, copy=True)  # get_tensor's buffer is reused by the next invoke
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import contextvars
+try:
+    import resource
+except ImportError:  # Windows, peak memory isn't recorded there
+    resource = None
+
+
+# The collector spans are recorded into, per thread and per job rather than per process, so one
+# analyst's run (or their checkbox) never mixes with or switches off another's. None records nothing;
+# span() then hands back one shared do-nothing object, so instrumented code costs a context variable
+# lookup per span
+_current = contextvars.ContextVar('dolphin_trace', default=None)
+
+
+class Collector:
+    """
+    Collector holds the spans of one run, ex. a detection job or a batch detection file.
+
+    It's made active with collect() around the code to trace, and bind() carries it over to the threads
+    that code starts. Only the first max_events spans are kept, the rest are counted as dropped.
+
+    Args:
+        enabled (bool): record spans, a disabled collector costs the same as none
+        max_events (int): bound on the spans kept
+    """
+
+    def __init__(self, enabled: bool = True, max_events: int = 100000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.dropped = 0
+        self._events = []
+        self._lock = threading.Lock()
+
+    def record(self, event: dict):
+        with self._lock:
+            if len(self._events) < self.max_events:
+                self._events.append(event)
+            else:
+                self.dropped += 1
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def summary(self):
+        """
+        Totals of every span name, slowest first.
+
+        Returns:
+            (list): a dict per name with how many spans there were, their total and longest duration in ms,
+                the items they went through, items per second and the peak RSS in MB seen by the end of them
+        """
+        totals = {}
+        for e in self.events():
+            t = totals.setdefault(e['name'], {'name': e['name'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                              'items': 0, 'peak_rss_mb': 0.0})
+            t['count'] += 1
+            t['total_ms'] += e['dur'] / 1e6
+            t['max_ms'] = max(t['max_ms'], e['dur'] / 1e6)
+            t['items'] += e['items']
+            t['peak_rss_mb'] = max(t['peak_rss_mb'], _maxrss_mb(e['maxrss']))
+
+        for t in totals.values():
+            t['items_per_second'] = t['items'] / (t['total_ms'] / 1000) if t['total_ms'] > 0 else 0.0
+        return sorted(totals.values(), key=lambda t: -t['total_ms'])
+
+    def chrome_trace(self):
+        """
+        The recorded spans in the Chrome trace event format, for chrome://tracing or https://ui.perfetto.dev.
+
+        Returns:
+            (dict): the trace, json serializable
+        """
+        recorded = self.events()
+        origin = min((e['start'] for e in recorded), default=0)
+        trace = [{'name': e['name'], 'ph': 'X', 'ts': (e['start'] - origin) / 1000, 'dur': e['dur'] / 1000,
+                  'pid': os.getpid(), 'tid': e['tid'],
+                  'args': {'items': e['items'], 'peak_rss_mb': round(_maxrss_mb(e['maxrss']), 1), **e['args']}}
+                 for e in recorded]
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'dropped_spans': self.dropped}}
+
+    def export(self, path: str):
+        """
+        Writes chrome_trace() to a json file.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+
+@contextlib.contextmanager
+def collect(collector):
+    """
+    Records the spans of the with block, on this thread and the ones it starts through bind(), into collector
+    (None records nothing).
+    """
+    token = _current.set(collector)
+    try:
+        yield collector
+    finally:
+        _current.reset(token)
+
+
+def activate(collector):
+    """
+    Makes collector the current one for the rest of this thread's context, ex. a streamlit script run.
+    """
+    _current.set(collector)
+
+
+def bind(fn):
+    """
+    Wraps fn so it records into the collector that is current now, wherever it's called from (threads
+    don't inherit it).
+    """
+    collector = _current.get()
+    if collector is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        with collect(collector):
+            return fn(*args, **kwargs)
+    return bound
+
+
+def enabled():
+    """
+    Whether spans on this thread are recorded.
+    """
+    collector = _current.get()
+    return collector is not None and collector.enabled
+
+
+def span(name: str, items: int = 0, **args):
+    """
+    Times a block of code, ex.
+
+        with tracing.span('render', items=len(features)):
+            images = [render(...) for ... in features]
+
+    Args:
+        name (str): what the block does, spans with the same name are summed up in Collector.summary()
+        items (int): how many things (windows, files, samples) the block went through, can be set later
+            with .add()
+        **args: anything else worth seeing in the trace viewer
+
+    Returns:
+        (context manager): records the span on exit into the current collector, does nothing without an enabled one
+    """
+    collector = _current.get()
+    if collector is None or not collector.enabled:
+        return _NOOP
+    return _Span(collector, name, items, args)
+
+
+class _Span:
+
+    __slots__ = ('collector', 'name', 'items', 'args', 'start')
+
+    def __init__(self, collector: Collector, name: str, items: int, args: dict):
+        self.collector, self.name, self.items, self.args = collector, name, items, args
+
+    def add(self, items: int):
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        # The process' peak RSS so far, one cheap syscall (ru_maxrss is in KB on Linux, bytes on macOS)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+        event = {'name': self.name, 'start': self.start, 'dur': end - self.start, 'tid': threading.get_ident(),
+                 'items': self.items, 'maxrss': maxrss, 'args': self.args}
+        self.collector.record(event)
+        return False
+
+
+class _NoopSpan:
+
+    __slots__ = ()
+
+    def add(self, items: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def _maxrss_mb(maxrss: int):
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
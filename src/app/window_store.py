@@ -0,0 +1,150 @@
+import os
+import bisect
+import numpy as np
+
+
+class WindowStore:
+    """
+    WindowStore holds every spectrogram window of a run in uint8 arrays, optionally memory-mapped to
+    files so a multi-hour recording doesn't have to fit in RAM.
+
+    Windows are stored once, as the uint8 BGR images they're rendered as. The model gets float32
+    copies of one batch at a time (see normalized), and display code indexes the store, which hands
+    out views of the same memory rather than copies.
+
+    A memory-mapped store never resizes a file it has mapped (Windows can't, and views handed out keep
+    the maps alive): it grows by mapping another file (path, then path.1, path.2, ...), each as large as
+    the store so far. array joins them into one file the first time it's asked for after a growth.
+
+    Args:
+        path (str): file to memory-map the windows to, None keeps them in memory
+        capacity (int): how many windows to make room for up front, the store doubles as it fills
+    """
+
+    def __init__(self, path: str = None, capacity: int = 64):
+        self.path = path
+        self.capacity = capacity
+        self.shape = None  # (height, width, channels) of every window, set by the first append
+        self._chunks = []  # arrays of room for windows, filled in order
+        self._starts = []  # index of the first window of each chunk
+        self._files = []  # the file of each chunk, if memory-mapped
+        self._n_files = 0
+        self._len = 0
+
+    def append(self, img: np.ndarray):
+        """
+        Copies one uint8 window to the end of the store.
+        """
+        if not self._chunks:
+            self.shape = img.shape
+            self._grow(max(1, self.capacity))
+        elif img.shape != self.shape:
+            raise ValueError(f"Window of shape {img.shape} doesn't match the store's {self.shape}")
+        elif self._len == self._starts[-1] + len(self._chunks[-1]):
+            self._grow(self._len)
+
+        self._chunks[-1][self._len - self._starts[-1]] = img
+        self._len += 1
+
+    def extend(self, imgs):
+        for img in imgs:
+            self.append(img)
+
+    @property
+    def array(self):
+        """
+        (n_windows, height, width, channels) uint8 view of every window stored so far.
+        """
+        if not self._chunks:
+            return np.zeros((0, 0, 0, 3), dtype=np.uint8)
+        if len(self._chunks) > 1:
+            self._join()
+        return self._chunks[0][: self._len]
+
+    def normalized(self, start: int, stop: int):
+        """
+        Windows [start, stop) scaled to [0, 1] as a float32 batch, ready for the model.
+        """
+        return normalize(self[start:stop])
+
+    def flush(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, np.memmap):
+                chunk.flush()
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        """
+        A window, or a slice of them: views, unless a slice spans chunks (then it's a copy).
+        """
+        if isinstance(i, (int, np.integer)):
+            if not -self._len <= i < self._len:
+                raise IndexError(f"Window {i} out of range of {self._len}")
+            i = int(i) % self._len
+            chunk = bisect.bisect_right(self._starts, i) - 1
+            return self._chunks[chunk][i - self._starts[chunk]]
+        if isinstance(i, slice) and i.indices(self._len)[2] == 1:
+            start, stop, _ = i.indices(self._len)
+            parts = [chunk[max(0, start - first) : stop - first] for chunk, first in zip(self._chunks, self._starts)
+                     if first < stop and start < first + len(chunk)]
+            if len(parts) == 1:
+                return parts[0]
+            if len(parts) > 1:
+                return np.concatenate(parts)
+        return self.array[i]
+
+    def __iter__(self):
+        for chunk, first in zip(self._chunks, self._starts):
+            yield from chunk[: max(0, self._len - first)]
+
+    def _grow(self, capacity: int):
+        """
+        Makes room for capacity more windows, keeping the ones already stored where they are.
+        """
+        if self.path is None:
+            data = np.empty((self._len + capacity,) + tuple(self.shape), dtype=np.uint8)
+            if self._chunks:
+                data[: self._len] = self._chunks[0][: self._len]
+            self._chunks, self._starts = [data], [0]
+            return
+
+        self._chunks.append(self._map(capacity))
+        self._starts.append(self._len)
+
+    def _join(self):
+        """
+        Copies the windows of every chunk into one new file of just their size, and lets go of the old ones.
+        """
+        old = list(self._files)
+        data = self._map(self._len)
+        for chunk, first in zip(self._chunks, self._starts):
+            data[first : first + len(chunk[: self._len - first])] = chunk[: self._len - first]
+        data.flush()
+        self._chunks, self._starts, self._files = [data], [0], self._files[-1:]
+
+        for fp in old:
+            try:
+                os.remove(fp)
+            except OSError:  # still mapped by a view handed out earlier (Windows), workspace cleanup gets it
+                pass
+
+    def _map(self, capacity: int):
+        """
+        A new file of room for capacity windows, path for the first and path.1, path.2, ... after it.
+        """
+        path = self.path if self._n_files == 0 else f'{self.path}.{self._n_files}'
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._n_files += 1
+        self._files.append(path)
+        return np.memmap(path, dtype=np.uint8, mode='w+', shape=(capacity,) + tuple(self.shape))
+
+
+def normalize(batch: np.ndarray):
+    """
+    Scales a uint8 batch of windows to [0, 1] in float32, half the memory of the float64 img / 255.
+    """
+    return np.divide(batch, np.float32(255), dtype=np.float32)
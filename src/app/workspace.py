@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import uuid
+import shutil
+
+import dolphin.app.tracing as tracing
+
+
+class Workspace:
+    """
+    Workspace is the directory of one run of a page: the spectrograms it exported and a manifest of
+    exactly the windows it produced. Runs never share a directory, so nothing from an earlier session
+    can leak into the windows of a later one, and old runs can be deleted as a whole (see gc).
+
+    Layout:
+        <root>/<run_id>/manifest.json
+        <root>/<run_id>/spectrograms/
+    """
+
+    def __init__(self, root: str, run_id: str = None):
+        self.run_id = run_id or time.strftime('%Y%m%d-%H%M%S') + '_' + uuid.uuid4().hex[:8]
+        self.path = os.path.join(root, self.run_id, '')
+        self.spectrogram_dir = os.path.join(self.path, 'spectrograms', '')
+        self.manifest_path = self.path + 'manifest.json'
+        if not os.path.exists(self.spectrogram_dir):
+            os.makedirs(self.spectrogram_dir)
+
+    def write_results(self, results, name: str = 'results.csv'):
+        """
+        Saves a runner's Results (see results.py) in the workspace, in one bulk write.
+
+        Returns:
+            (str): the file's name in the workspace, ex. for write_manifest
+        """
+        tmp = self.path + name + '.tmp'
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        with tracing.span('write_results', items=len(results)):
+            if name.endswith('.parquet'):
+                results.to_parquet(tmp)
+            else:
+                results.to_csv(tmp)
+        os.replace(tmp, self.path + name)
+        return name
+
+    def write_manifest(self, windows, **info):
+        """
+        Records the windows of the run, replacing any earlier manifest of it.
+
+        Args:
+            windows (list or str): a json serializable dict per window, ex. its image name, source file and
+                prediction, or the name(s) of the results file(s) holding them (see write_results)
+            **info: anything else worth keeping about the run, ex. the weights and threshold used
+        """
+        manifest = {'run_id': self.run_id, 'created': time.time(), 'windows': windows, **info}
+
+        # Written under a temporary name and renamed, so gc and readers never see half a manifest
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=4, default=str)
+        os.replace(tmp, self.manifest_path)
+
+    def read_manifest(self):
+        """
+        Returns:
+            (dict): the manifest written by write_manifest, or None if the run hasn't written one yet
+        """
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+def gc(root: str, max_age_days: float = 7, max_bytes: int = 2 * 1024 ** 3, keep: tuple = (), recent_hours: float = 24,
+       marker: str = 'manifest.json'):
+    """
+    Deletes old workspaces under root: every run older than max_age_days, then the oldest remaining
+    runs until they all fit in max_bytes. Runs touched in the last recent_hours are never deleted, even
+    over budget, so a run another session is still working on survives its job being forgotten (or a
+    server restart). This walks every run, so it's meant for when a new run starts, not every rerun.
+
+    Args:
+        root (str): directory holding the workspaces
+        max_age_days (float): runs last touched longer ago than this are deleted
+        max_bytes (int): disk budget of all the runs together
+        keep (tuple): run ids never to delete, ex. the runs still open in a session
+        recent_hours (float): runs touched more recently than this are kept
+        marker (str): file in each run whose modification time also counts as touching it (see touch)
+
+    Returns:
+        (list): the run ids that were deleted
+    """
+    if not os.path.isdir(root):
+        return []
+
+    runs = []
+    for run_id in os.listdir(root):
+        path = os.path.join(root, run_id)
+        if run_id in keep or not os.path.isdir(path):
+            continue
+        try:
+            touched = os.path.getmtime(path)
+            if os.path.exists(os.path.join(path, marker)):
+                touched = max(touched, os.path.getmtime(os.path.join(path, marker)))
+            runs.append((touched, _size(path), run_id))
+        except OSError:  # deleted by another session while we looked
+            continue
+
+    deleted = []
+    total = sum(size for _, size, _ in runs)
+    now = time.time()
+    oldest, recent = now - max_age_days * 24 * 3600, now - recent_hours * 3600
+    for touched, size, run_id in sorted(runs):
+        if (touched >= oldest and total <= max_bytes) or touched >= recent:
+            break
+        shutil.rmtree(os.path.join(root, run_id), ignore_errors=True)
+        total -= size
+        deleted.append(run_id)
+
+    return deleted
+
+
+def touch(root: str, run_id: str, marker: str = 'manifest.json'):
+    """
+    Marks a run as still in use (ex. a session is verifying its windows), so gc keeps it for recent_hours more.
+    """
+    if not run_id:
+        return
+    path = os.path.join(root, run_id)
+    try:
+        os.utime(os.path.join(path, marker) if os.path.exists(os.path.join(path, marker)) else path)
+    except OSError:  # already deleted
+        pass
+
+
+def _size(path: str):
+    return sum(os.path.getsize(os.path.join(dirpath, fn)) for dirpath, _, files in os.walk(path) for fn in files)